@@ -0,0 +1,54 @@
+"""
+Cart badge count kept in the session.
+
+The header badge is rendered on every page. The cart views store the count in
+the session whenever they change the cart, so rendering the badge reads the
+session and does not query the database. The database is only consulted when
+the session has no count for the current user, or the stored count is older
+than ``CART_COUNT_MAX_AGE`` seconds. That bounds staleness when the same cart
+is changed from another device.
+"""
+import time
+
+from django.conf import settings
+
+from .models import Cart
+from .storage import get_cart_store
+
+
+SESSION_KEY = 'cart_count'
+
+
+def remember_cart_count(request, cart, user=None):
+    """
+    Store the cart's item count in the session after a cart change
+
+    Pass ``user`` where ``request.user`` may not be set yet, e.g. in
+    ``user_logged_in`` receivers.
+    """
+    user = user or request.user
+    request.session[SESSION_KEY] = {
+        'user': user.pk if user.is_authenticated else None,
+        'count': cart.item_count,
+        'at': int(time.time()),
+    }
+
+
+def cart_count(request):
+    """Return the badge count, from the session when it is fresh"""
+    user_id = request.user.pk if request.user.is_authenticated else None
+    stored = request.session.get(SESSION_KEY)
+    max_age = getattr(settings, 'CART_COUNT_MAX_AGE', 300)
+    if stored and stored.get('user') == user_id and time.time() - stored.get('at', 0) < max_age:
+        return stored['count']
+
+    if user_id is not None:
+        count = Cart.objects.filter(customer_id=user_id, is_active=True).values_list(
+            'item_count', flat=True
+        ).first() or 0
+    else:
+        count = get_cart_store().count(request)
+    # Do not start a session for visitors who have none
+    if user_id is not None or request.session.session_key:
+        request.session[SESSION_KEY] = {'user': user_id, 'count': count, 'at': int(time.time())}
+    return count
@@ -1,26 +1,11 @@
-from .models import Cart
+from django.utils.functional import SimpleLazyObject
+
+from .badge import cart_count
 
 
 def cart_context(request):
     """Add cart information to all templates"""
-    cart_count = 0
-    
-    if request.user.is_authenticated:
-        try:
-            cart = Cart.objects.get(customer=request.user, is_active=True)
-            cart_count = cart.total_items
-        except Cart.DoesNotExist:
-            cart_count = 0
-    else:
-        # Handle anonymous users
-        session_key = request.session.session_key
-        if session_key:
-            try:
-                cart = Cart.objects.get(session_key=session_key, customer=None, is_active=True)
-                cart_count = cart.total_items
-            except Cart.DoesNotExist:
-                cart_count = 0
-    
+    # Evaluated only by templates that render the badge
     return {
-        'cart_count': cart_count,
-    }
\ No newline at end of file
+        'cart_count': SimpleLazyObject(lambda: cart_count(request)),
+    }
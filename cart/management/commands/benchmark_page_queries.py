@@ -0,0 +1,66 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from cart.badge import SESSION_KEY
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Count database queries per page for a visitor with a non-empty cart'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=5, help='Requests per page to average over')
+
+    def get_client(self):
+        host = next((h for h in settings.ALLOWED_HOSTS if h and h != '*' and not h.startswith('.')), 'testserver')
+        return Client(SERVER_NAME=host)
+
+    def count_queries(self, client, url, cold):
+        if cold:
+            session = client.session
+            session.pop(SESSION_KEY, None)
+            session.save()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url, secure=not settings.DEBUG)
+        if response.status_code != 200:
+            raise CommandError(f'{url} returned {response.status_code}')
+        cart_queries = sum(1 for query in queries.captured_queries if '"cart_cart"' in query['sql'])
+        return len(queries), cart_queries
+
+    def handle(self, *args, **options):
+        product = Product.objects.filter(status='active').order_by('pk').first()
+        if product is None:
+            raise CommandError('Needs at least one active product')
+
+        client = self.get_client()
+        client.post(
+            reverse('cart:add'), json.dumps({'product_id': product.pk, 'quantity': 2}),
+            content_type='application/json', secure=not settings.DEBUG,
+        )
+
+        pages = [
+            ('Home', reverse('core:home')),
+            ('Catalog', reverse('products:catalog')),
+            ('Product detail', reverse('products:detail', kwargs={'slug': product.slug})),
+        ]
+
+        self.stdout.write('Average queries per request')
+        self.stdout.write(f'{"Page":<16}{"Session miss":>14}{"Session hit":>14}{"Cart queries saved":>20}')
+        for name, url in pages:
+            results = {}
+            for cold in (True, False):
+                runs = [self.count_queries(client, url, cold) for _ in range(options['requests'])]
+                results[cold] = (
+                    sum(total for total, cart in runs) / len(runs),
+                    sum(cart for total, cart in runs) / len(runs),
+                )
+            self.stdout.write(
+                f'{name:<16}{results[True][0]:>14.1f}{results[False][0]:>14.1f}'
+                f'{results[True][1] - results[False][1]:>20.1f}'
+            )
@@ -0,0 +1,45 @@
+# Generated by Django 5.0.14 on 2026-10-17 01:46
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import Case, ExpressionWrapper, F, OuterRef, Subquery, Sum, When
+from django.db.models.functions import Coalesce
+
+
+def fill_cart_totals(apps, schema_editor):
+    Cart = apps.get_model('cart', 'Cart')
+    CartItem = apps.get_model('cart', 'CartItem')
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    unit_price = Case(When(variant__price__gt=0, then=F('variant__price')), default=F('product__price'))
+    lines = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    Cart.objects.update(
+        item_count=Coalesce(Subquery(lines.annotate(total=Sum('quantity')).values('total')), 0),
+        subtotal=Coalesce(
+            Subquery(lines.annotate(
+                total=Sum(ExpressionWrapper(F('quantity') * unit_price, output_field=amount))
+            ).values('total')),
+            Decimal('0.00'),
+            output_field=amount,
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12),
+        ),
+        migrations.RunPython(fill_cart_totals, migrations.RunPython.noop),
+    ]
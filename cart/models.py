@@ -1,5 +1,9 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, ExpressionWrapper, F, OuterRef, Subquery, Sum, When
+from django.db.models.functions import Coalesce
 from django.core.validators import MinValueValidator
+from django.utils import timezone
+from decimal import Decimal
 import uuid
 from core.models import TimeStampedModel
 from customers.models import Customer
@@ -17,6 +21,10 @@ class Cart(TimeStampedModel):
     # Cart metadata
     is_active = models.BooleanField(default=True)
     
+    # Running totals, kept in step with every CartItem change
+    item_count = models.PositiveIntegerField(default=0)
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    
     def __str__(self):
         if self.customer:
             return f"Cart for {self.customer.email}"
@@ -24,48 +32,197 @@ class Cart(TimeStampedModel):
     
     @property
     def total_items(self):
-        return self.items.aggregate(
-            total=models.Sum('quantity')
-        )['total'] or 0
-    
-    @property
-    def subtotal(self):
-        total = 0
-        for item in self.items.all():
-            total += item.total_price
-        return total
+        return self.item_count
     
     @property
     def is_empty(self):
-        return self.items.count() == 0
+        return self.item_count == 0
+    
+    def lock(self):
+        """Lock the cart row until the transaction ends, so changes to it run one at a time"""
+        Cart.objects.select_for_update().filter(pk=self.pk).values_list('pk').first()
+    
+    def _adjust_totals(self, quantity, amount):
+        """Shift the stored totals by a change in lines and reload them"""
+        Cart.objects.filter(pk=self.pk).update(
+            item_count=F('item_count') + quantity,
+            subtotal=F('subtotal') + amount,
+        )
+        self.refresh_from_db(fields=['item_count', 'subtotal'])
     
     def add_item(self, product, variant=None, quantity=1):
         """Add or update item in cart"""
-        item, created = CartItem.objects.get_or_create(
-            cart=self,
-            product=product,
-            variant=variant,
-            defaults={'quantity': quantity}
-        )
+        with transaction.atomic():
+            self.lock()
+            item, created = CartItem.objects.get_or_create(
+                cart=self,
+                product=product,
+                variant=variant,
+                defaults={'quantity': quantity}
+            )
+            
+            if not created:
+                item.quantity += quantity
+                item.save()
+            
+            item.product, item.variant = product, variant
+            self._adjust_totals(quantity, item.unit_price * quantity)
         
-        if not created:
-            item.quantity += quantity
+        return item
+    
+    def update_item_quantity(self, item, quantity):
+        """Set the quantity of one of this cart's items"""
+        with transaction.atomic():
+            self.lock()
+            # ``item`` may have been read before another request changed it
+            current = self.items.filter(pk=item.pk).values_list('quantity', flat=True).first()
+            if current is None:
+                raise CartItem.DoesNotExist(f'Cart item {item.pk} not found')
+            change = quantity - current
+            item.quantity = quantity
             item.save()
-        
+            self._adjust_totals(change, item.unit_price * change)
         return item
     
+    def delete_item(self, item):
+        """Remove one of this cart's items"""
+        with transaction.atomic():
+            self.lock()
+            current = self.items.filter(pk=item.pk).values_list('quantity', flat=True).first()
+            if current is None:
+                return
+            item.delete()
+            self._adjust_totals(-current, -item.unit_price * current)
+    
     def remove_item(self, product, variant=None):
         """Remove item from cart"""
         try:
-            item = self.items.get(product=product, variant=variant)
-            item.delete()
-            return True
+            item = self.items.select_related('product', 'variant').get(product=product, variant=variant)
         except CartItem.DoesNotExist:
             return False
+        self.delete_item(item)
+        return True
+    
+    def get_item(self, item_id):
+        """Return one item with its product and variant loaded"""
+        return self.items.select_related('product', 'variant').get(pk=item_id)
+    
+    def get_items(self):
+        """Return the items for display"""
+        return self.items.select_related('product__primary_image', 'variant')
     
     def clear(self):
         """Clear all items from cart"""
-        self.items.all().delete()
+        with transaction.atomic():
+            self.items.all().delete()
+            Cart.objects.filter(pk=self.pk).update(item_count=0, subtotal=0)
+            self.item_count, self.subtotal = 0, Decimal('0.00')
+    
+    def apply_batch(self, adds=(), quantities=None, removals=()):
+        """
+        Apply many changes in one transaction
+        
+        ``adds`` holds ``(product, variant, quantity)`` tuples, ``quantities``
+        maps item ids to new quantities and ``removals`` lists item ids.
+        Unknown item ids raise ``CartItem.DoesNotExist`` and nothing is saved.
+        """
+        quantities = quantities or {}
+        removals = set(removals)
+        with transaction.atomic():
+            self.lock()
+            items = self.items.in_bulk(set(quantities) | removals)
+            missing = (set(quantities) | removals) - set(items)
+            if missing:
+                raise CartItem.DoesNotExist(f'Cart items not found: {sorted(missing)}')
+            
+            if removals:
+                self.items.filter(pk__in=removals).delete()
+            changed = []
+            now = timezone.now()
+            for item_id, quantity in quantities.items():
+                if item_id not in removals:
+                    item = items[item_id]
+                    item.quantity, item.updated_at = quantity, now
+                    changed.append(item)
+            if changed:
+                CartItem.objects.bulk_update(changed, ['quantity', 'updated_at'])
+            
+            if adds:
+                self.merge_lines(
+                    (product.pk, variant.pk if variant else None, quantity) for product, variant, quantity in adds
+                )
+            else:
+                Cart.recalculate_totals(Cart.objects.filter(pk=self.pk))
+                self.refresh_from_db(fields=['item_count', 'subtotal'])
+    
+    def as_lines(self):
+        """Return the items as ``(product_id, variant_id, quantity)`` tuples"""
+        return list(self.items.values_list('product_id', 'variant_id', 'quantity'))
+    
+    def merge_lines(self, lines):
+        """
+        Fold ``(product_id, variant_id, quantity)`` lines into this cart
+        
+        Quantities add to matching items. All lines are written with one bulk
+        upsert. Existing items are matched on their id rather than on
+        ``unique_together``, because NULL variants never conflict there.
+        Lines for products or variants that no longer exist are dropped.
+        """
+        quantities = {}
+        for product_id, variant_id, quantity in lines:
+            key = (product_id, variant_id)
+            quantities[key] = quantities.get(key, 0) + quantity
+        if not quantities:
+            return
+        
+        product_ids = set(Product.objects.filter(
+            pk__in={product_id for product_id, variant_id in quantities}, status='active'
+        ).values_list('pk', flat=True))
+        variant_ids = {variant_id for product_id, variant_id in quantities if variant_id}
+        if variant_ids:
+            variant_ids = set(ProductVariant.objects.filter(pk__in=variant_ids).values_list('pk', flat=True))
+        
+        with transaction.atomic():
+            # Serialize concurrent merges into the same cart
+            self.lock()
+            existing = {
+                (item.product_id, item.variant_id): item
+                for item in self.items.filter(product_id__in=product_ids)
+            }
+            items = []
+            for (product_id, variant_id), quantity in quantities.items():
+                if product_id not in product_ids or (variant_id and variant_id not in variant_ids):
+                    continue
+                current = existing.get((product_id, variant_id))
+                items.append(CartItem(
+                    id=current.pk if current else None,
+                    cart=self,
+                    product_id=product_id,
+                    variant_id=variant_id,
+                    quantity=quantity + (current.quantity if current else 0),
+                ))
+            CartItem.objects.bulk_create(
+                items, update_conflicts=True, unique_fields=['id'], update_fields=['quantity', 'updated_at']
+            )
+            Cart.recalculate_totals(Cart.objects.filter(pk=self.pk))
+        self.refresh_from_db(fields=['item_count', 'subtotal'])
+    
+    @classmethod
+    def recalculate_totals(cls, carts):
+        """
+        Recompute the stored totals of ``carts``, a queryset, in one UPDATE
+        
+        Used when prices change or items disappear outside the cart methods.
+        """
+        lines = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+        return carts.update(
+            item_count=Coalesce(Subquery(lines.annotate(total=Sum('quantity')).values('total')), 0),
+            subtotal=Coalesce(
+                Subquery(lines.annotate(total=Sum(CartItem.line_total_expression())).values('total')),
+                Decimal('0.00'),
+                output_field=models.DecimalField(max_digits=12, decimal_places=2),
+            ),
+        )
     
     class Meta:
         db_table = 'cart_cart'
@@ -98,6 +255,14 @@ class CartItem(TimeStampedModel):
         """Calculate total price for this item"""
         return self.unit_price * self.quantity
     
+    @staticmethod
+    def line_total_expression():
+        """SQL counterpart of ``total_price``, for aggregating over items"""
+        unit_price = Case(When(variant__price__gt=0, then=F('variant__price')), default=F('product__price'))
+        return ExpressionWrapper(
+            F('quantity') * unit_price, output_field=models.DecimalField(max_digits=12, decimal_places=2)
+        )
+    
     @property
     def is_available(self):
         """Check if item is still available"""
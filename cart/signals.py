@@ -0,0 +1,70 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from products.models import Product, ProductVariant
+from .badge import remember_cart_count
+from .models import Cart
+from .storage import get_cart_store
+
+
+@receiver(pre_save, sender=Product)
+@receiver(pre_save, sender=ProductVariant)
+def note_price_change(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Note whether the save changes the price; stock and counter saves leave carts alone"""
+    instance._price_changed = False
+    if raw or instance.pk is None or (update_fields is not None and 'price' not in update_fields):
+        return
+    price = sender.objects.filter(pk=instance.pk).values_list('price', flat=True).first()
+    instance._price_changed = price != instance.price
+
+
+@receiver(post_save, sender=Product)
+def reprice_carts_for_product(sender, instance, raw=False, **kwargs):
+    """Keep stored cart subtotals in line with the product price"""
+    if raw or not getattr(instance, '_price_changed', False):
+        return
+    Cart.recalculate_totals(Cart.objects.filter(items__product=instance))
+
+
+@receiver(post_save, sender=ProductVariant)
+def reprice_carts_for_variant(sender, instance, raw=False, **kwargs):
+    if raw or not getattr(instance, '_price_changed', False):
+        return
+    Cart.recalculate_totals(Cart.objects.filter(items__variant=instance))
+
+
+@receiver(pre_delete, sender=Product)
+@receiver(pre_delete, sender=ProductVariant)
+def collect_carts_before_delete(sender, instance, **kwargs):
+    """Remember which carts lose items to the cascade"""
+    lookup = 'items__product' if sender is Product else 'items__variant'
+    instance._affected_cart_ids = list(Cart.objects.filter(**{lookup: instance}).values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=ProductVariant)
+def recalculate_carts_after_delete(sender, instance, **kwargs):
+    cart_ids = getattr(instance, '_affected_cart_ids', None)
+    if cart_ids:
+        Cart.recalculate_totals(Cart.objects.filter(pk__in=cart_ids))
+
+
+@receiver(user_logged_in)
+def merge_anonymous_cart(sender, request, user, **kwargs):
+    """Fold the visitor's anonymous cart into the customer's cart on login"""
+    if request is None or not hasattr(request, 'session'):
+        return
+    store = get_cart_store()
+    anonymous = store.get_cart(request, create=False)
+    if anonymous is None:
+        return
+    
+    with transaction.atomic():
+        cart, created = Cart.objects.get_or_create(customer=user, defaults={'is_active': True})
+        cart.merge_lines(anonymous.as_lines())
+        if isinstance(anonymous, Cart):
+            anonymous.delete()
+    store.discard(request)
+    remember_cart_count(request, cart, user=user)
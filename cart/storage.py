@@ -0,0 +1,423 @@
+"""
+Storage for anonymous shopping carts.
+
+Signed-in customers always get a ``Cart`` row. Where an anonymous visitor's
+cart lives depends on ``CART_ANONYMOUS_STORE``:
+
+* ``CacheCartStore`` (the default) keeps it in the cache, which is Redis in
+  production and locmem in tests, and expires it after ``CART_ANONYMOUS_TTL``
+  seconds. Visitors who never check out or sign in never create rows.
+  ``CachedCart`` offers the same API as ``Cart``, so views do not care which
+  one they have. The cart is written to the database on checkout, and folded
+  into the customer's cart on login.
+* ``DatabaseCartStore`` creates a ``Cart`` row per session, as before.
+
+The cart's cache token, or its row id once it is persisted, is kept in the
+session data rather than derived from the session key. That way it survives
+the key rotation on login.
+"""
+import json
+import uuid
+from decimal import Decimal
+from functools import cached_property, lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from products.models import Product, ProductVariant
+from .models import Cart, CartItem
+
+
+SESSION_TOKEN_KEY = 'cart_token'
+SESSION_CART_KEY = 'cart_id'
+
+
+class CachedCart:
+    """
+    Anonymous cart held in the cache, with the same API as ``Cart``
+
+    ``lines`` maps line ids to ``{'product', 'variant', 'quantity', 'price'}``.
+    The unit price is captured when a line changes and refreshed whenever the
+    items are loaded, so ``subtotal`` needs no queries. Every change goes
+    through the store one line at a time (see ``CacheCartStore``).
+    """
+    customer = None
+    is_active = True
+
+    def __init__(self, store, token, data=None):
+        self.store = store
+        self.token = token
+        data = data or {}
+        self.lines = data.get('lines', {})
+        self.next_id = data.get('next_id', 1)
+
+    def __str__(self):
+        return f"Anonymous cart ({self.token[:8]}...)"
+
+    def to_dict(self):
+        return {'lines': self.lines, 'next_id': self.next_id}
+
+    @property
+    def item_count(self):
+        return sum(line['quantity'] for line in self.lines.values())
+
+    @property
+    def total_items(self):
+        return self.item_count
+
+    @property
+    def subtotal(self):
+        return sum(
+            (Decimal(line['price']) * line['quantity'] for line in self.lines.values()), Decimal('0.00')
+        )
+
+    @property
+    def is_empty(self):
+        return not self.lines
+
+    def _find_line(self, product_id, variant_id):
+        for line_id, line in self.lines.items():
+            if line['product'] == product_id and line['variant'] == variant_id:
+                return line_id
+        return None
+
+    def _make_item(self, line_id, product, variant):
+        return CartItem(id=line_id, product=product, variant=variant, quantity=self.lines[line_id]['quantity'])
+
+    def _add_lines(self, adds):
+        """Add ``(product, variant, quantity)`` tuples; returns their items"""
+        adds = list(adds)
+        line_ids = self.store.add_lines(self, [
+            (product.pk, variant.pk if variant else None, quantity,
+             str(CartItem(product=product, variant=variant).unit_price))
+            for product, variant, quantity in adds
+        ])
+        return [
+            self._make_item(line_id, product, variant) for line_id, (product, variant, quantity) in zip(line_ids, adds)
+        ]
+
+    def add_item(self, product, variant=None, quantity=1):
+        """Add or update item in cart"""
+        return self._add_lines([(product, variant, quantity)])[0]
+
+    def update_item_quantity(self, item, quantity):
+        """Set the quantity of one of this cart's items"""
+        item.quantity = quantity
+        self.store.set_lines(self, {item.id: {'quantity': quantity, 'price': str(item.unit_price)}})
+        return item
+
+    def delete_item(self, item):
+        """Remove one of this cart's items"""
+        self.store.delete_lines(self, [item.id])
+
+    def remove_item(self, product, variant=None):
+        """Remove item from cart"""
+        line_id = self._find_line(product.pk, variant.pk if variant else None)
+        if line_id is None:
+            return False
+        self.store.delete_lines(self, [line_id])
+        return True
+
+    def clear(self):
+        """Clear all items from cart"""
+        self.store.clear(self)
+
+    def apply_batch(self, adds=(), quantities=None, removals=()):
+        """Apply many changes, with the same arguments as ``Cart.apply_batch``"""
+        quantities = quantities or {}
+        removals = set(removals)
+        missing = (set(quantities) | removals) - set(self.lines)
+        if missing:
+            raise CartItem.DoesNotExist(f'Cart items not found: {sorted(missing)}')
+
+        if removals:
+            self.store.delete_lines(self, removals)
+        quantities = {
+            line_id: {'quantity': quantity} for line_id, quantity in quantities.items() if line_id not in removals
+        }
+        if quantities:
+            self.store.set_lines(self, quantities)
+        if adds:
+            self._add_lines(adds)
+
+    def as_lines(self):
+        """Return the lines as ``(product_id, variant_id, quantity)`` tuples"""
+        return [(line['product'], line['variant'], line['quantity']) for line in self.lines.values()]
+
+    def get_item(self, item_id):
+        """Return one item with its product and variant loaded"""
+        try:
+            line_id = int(item_id)
+        except (TypeError, ValueError):
+            raise CartItem.DoesNotExist('Cart item not found')
+        line = self.lines.get(line_id)
+        if line is None:
+            raise CartItem.DoesNotExist('Cart item not found')
+        product = Product.objects.filter(pk=line['product']).first()
+        variant = ProductVariant.objects.filter(pk=line['variant']).first() if line['variant'] else None
+        if product is None:
+            raise CartItem.DoesNotExist('Cart item not found')
+        return self._make_item(line_id, product, variant)
+
+    def get_items(self):
+        """Return unsaved ``CartItem`` objects for display, refreshing prices"""
+        products = Product.objects.select_related('category', 'primary_image').in_bulk(
+            {line['product'] for line in self.lines.values()}
+        )
+        variant_ids = {line['variant'] for line in self.lines.values() if line['variant']}
+        variants = ProductVariant.objects.in_bulk(variant_ids) if variant_ids else {}
+
+        items, gone, prices = [], [], {}
+        for line_id, line in self.lines.items():
+            product = products.get(line['product'])
+            variant = variants.get(line['variant']) if line['variant'] else None
+            if product is None or (line['variant'] and variant is None):
+                gone.append(line_id)
+                continue
+            item = self._make_item(line_id, product, variant)
+            prices[line_id] = {'price': str(item.unit_price)}
+            items.append(item)
+        if gone:
+            self.store.delete_lines(self, gone)
+        if prices:
+            self.store.set_lines(self, prices)
+        return items
+
+
+class DatabaseCartStore:
+    """
+    Keep anonymous carts as ``Cart`` rows keyed by session
+    """
+
+    def get_cart(self, request, create=True):
+        cart_id = request.session.get(SESSION_CART_KEY)
+        if cart_id:
+            cart = Cart.objects.filter(pk=cart_id, customer=None, is_active=True).first()
+            if cart is not None:
+                return cart
+        if not create:
+            return None
+
+        session_key = request.session.session_key
+        if not session_key:
+            request.session.create()
+            session_key = request.session.session_key
+        cart, created = Cart.objects.get_or_create(
+            session_key=session_key,
+            customer=None,
+            defaults={'is_active': True}
+        )
+        request.session[SESSION_CART_KEY] = cart.pk
+        return cart
+
+    def persist(self, request):
+        """Return the anonymous cart as a database row"""
+        return self.get_cart(request)
+
+    def discard(self, request):
+        """Forget the anonymous cart once its items have moved elsewhere"""
+        request.session.pop(SESSION_CART_KEY, None)
+
+    def count(self, request):
+        """Item count of the current anonymous cart"""
+        cart_id = request.session.get(SESSION_CART_KEY)
+        if cart_id:
+            carts = Cart.objects.filter(pk=cart_id)
+        elif request.session.session_key:
+            carts = Cart.objects.filter(session_key=request.session.session_key, customer=None, is_active=True)
+        else:
+            return 0
+        return carts.values_list('item_count', flat=True).first() or 0
+
+
+class CacheCartStore(DatabaseCartStore):
+    """
+    Keep anonymous carts in the cache until checkout or login
+
+    On django-redis a cart is a Redis hash with a few fields per line, and
+    each change is one HINCRBY/HSET/HDEL plus EXPIRE. Concurrent requests from
+    the same visitor (several tabs, the batch endpoint and a single add) then
+    never overwrite each other's lines or quantities. Other caches, such as
+    locmem in tests, store the cart as one dict, read and written whole.
+
+    Hash fields: ``next`` allocates line ids, ``k:<product>:<variant>`` maps a
+    product to its line id, ``q:<id>`` is the line's quantity and ``l:<id>``
+    holds its product, variant and unit price as JSON.
+    """
+    key_prefix = 'cart:anonymous'
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'CART_ANONYMOUS_TTL', 14 * 24 * 60 * 60)
+
+    @cached_property
+    def redis(self):
+        """The raw Redis client behind the cache, or None for other cache backends"""
+        if not type(cache).__module__.startswith('django_redis'):
+            return None
+        from django_redis import get_redis_connection
+        return get_redis_connection('default')
+
+    def cache_key(self, token):
+        return f'{self.key_prefix}:{token}'
+
+    def hash_key(self, token):
+        return cache.make_key(self.cache_key(token))
+
+    def load(self, token):
+        """The stored ``{'lines', 'next_id'}`` of a cart, or None"""
+        if self.redis is None:
+            return cache.get(self.cache_key(token))
+        fields = {key.decode(): value for key, value in self.redis.hgetall(self.hash_key(token)).items()}
+        if not fields:
+            return None
+        lines = {}
+        for key, value in fields.items():
+            if key.startswith('l:') and f'q:{key[2:]}' in fields:
+                line_id = int(key[2:])
+                lines[line_id] = dict(json.loads(value), quantity=int(fields[f'q:{line_id}']))
+        return {'lines': lines}
+
+    def save(self, cart):
+        if self.redis is None:
+            cache.set(self.cache_key(cart.token), cart.to_dict(), self.timeout)
+        else:
+            self.redis.expire(self.hash_key(cart.token), self.timeout)
+
+    def _line_id(self, key, product_id, variant_id):
+        field = f"k:{product_id}:{variant_id or ''}"
+        line_id = self.redis.hget(key, field)
+        if line_id is None:
+            # Two requests may add the same product at once; the first id wins
+            self.redis.hsetnx(key, field, self.redis.hincrby(key, 'next', 1))
+            line_id = self.redis.hget(key, field)
+        return int(line_id)
+
+    def add_lines(self, cart, adds):
+        """Add ``(product_id, variant_id, quantity, price)`` lines; returns their line ids"""
+        line_ids = []
+        if self.redis is None:
+            for product_id, variant_id, quantity, price in adds:
+                line_id = cart._find_line(product_id, variant_id)
+                if line_id is None:
+                    line_id = cart.next_id
+                    cart.next_id += 1
+                    cart.lines[line_id] = {'product': product_id, 'variant': variant_id, 'quantity': 0}
+                cart.lines[line_id]['quantity'] += quantity
+                cart.lines[line_id]['price'] = price
+                line_ids.append(line_id)
+            self.save(cart)
+            return line_ids
+
+        key = self.hash_key(cart.token)
+        for product_id, variant_id, quantity, price in adds:
+            line_id = self._line_id(key, product_id, variant_id)
+            pipe = self.redis.pipeline()
+            pipe.hincrby(key, f'q:{line_id}', quantity)
+            pipe.hset(key, f'l:{line_id}', json.dumps({'product': product_id, 'variant': variant_id, 'price': price}))
+            pipe.expire(key, self.timeout)
+            total = pipe.execute()[0]
+            cart.lines[line_id] = {'product': product_id, 'variant': variant_id, 'quantity': total, 'price': price}
+            line_ids.append(line_id)
+        return line_ids
+
+    def set_lines(self, cart, changes):
+        """Set the ``quantity`` and/or ``price`` of lines, given as ``{line_id: {field: value}}``"""
+        for line_id, change in changes.items():
+            cart.lines[line_id].update(change)
+        if self.redis is None:
+            self.save(cart)
+            return
+        key = self.hash_key(cart.token)
+        pipe = self.redis.pipeline()
+        for line_id, change in changes.items():
+            line = cart.lines[line_id]
+            if 'quantity' in change:
+                pipe.hset(key, f'q:{line_id}', change['quantity'])
+            if 'price' in change:
+                pipe.hset(key, f'l:{line_id}', json.dumps(
+                    {'product': line['product'], 'variant': line['variant'], 'price': change['price']}
+                ))
+        pipe.expire(key, self.timeout)
+        pipe.execute()
+
+    def delete_lines(self, cart, line_ids):
+        lines = [(line_id, cart.lines.pop(line_id)) for line_id in line_ids if line_id in cart.lines]
+        if self.redis is None:
+            self.save(cart)
+        elif lines:
+            fields = []
+            for line_id, line in lines:
+                fields += [f'q:{line_id}', f'l:{line_id}', f"k:{line['product']}:{line['variant'] or ''}"]
+            self.redis.hdel(self.hash_key(cart.token), *fields)
+
+    def clear(self, cart):
+        cart.lines = {}
+        if self.redis is None:
+            self.save(cart)
+        else:
+            self.redis.delete(self.hash_key(cart.token))
+
+    def delete(self, token):
+        if self.redis is None:
+            cache.delete(self.cache_key(token))
+        else:
+            self.redis.delete(self.hash_key(token))
+
+    def get_cart(self, request, create=True):
+        # Already persisted, for example by an abandoned checkout
+        if request.session.get(SESSION_CART_KEY):
+            cart = super().get_cart(request, create=False)
+            if cart is not None:
+                return cart
+
+        token = request.session.get(SESSION_TOKEN_KEY)
+        if token:
+            data = self.load(token)
+            if data is not None or create:
+                return CachedCart(self, token, data)
+        if not create:
+            return None
+
+        token = uuid.uuid4().hex
+        request.session[SESSION_TOKEN_KEY] = token
+        return CachedCart(self, token)
+
+    def persist(self, request):
+        """Write the cached cart to the database and return the row"""
+        cart = self.get_cart(request)
+        if isinstance(cart, Cart):
+            return cart
+
+        if not request.session.session_key:
+            request.session.create()
+        with transaction.atomic():
+            persisted = Cart.objects.create(session_key=request.session.session_key, is_active=True)
+            persisted.merge_lines(cart.as_lines())
+
+        self.delete(cart.token)
+        request.session.pop(SESSION_TOKEN_KEY, None)
+        request.session[SESSION_CART_KEY] = persisted.pk
+        return persisted
+
+    def discard(self, request):
+        token = request.session.pop(SESSION_TOKEN_KEY, None)
+        if token:
+            self.delete(token)
+        super().discard(request)
+
+    def count(self, request):
+        if request.session.get(SESSION_CART_KEY):
+            return super().count(request)
+        token = request.session.get(SESSION_TOKEN_KEY)
+        if not token:
+            return 0
+        return CachedCart(self, token, self.load(token)).item_count
+
+
+@lru_cache(maxsize=None)
+def get_cart_store():
+    """Return the configured store for anonymous carts"""
+    return import_string(getattr(settings, 'CART_ANONYMOUS_STORE', 'cart.storage.CacheCartStore'))()
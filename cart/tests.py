@@ -1,3 +1,100 @@
+import json
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
 from django.test import TestCase
+from django.urls import reverse
+
+from products.models import Product
+from .badge import SESSION_KEY
+from .models import Cart
+from .storage import CacheCartStore, CachedCart
+
+
+class MergeAnonymousCartTests(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(
+            name='Tee', slug='tee', description='', price=Decimal('10.00'), status='active', stock_quantity=5
+        )
+        self.user = get_user_model().objects.create_user(username='shopper', email='s@example.com', password='x')
+
+    def test_login_merges_cart_and_remembers_count(self):
+        response = self.client.post(
+            reverse('cart:add'), json.dumps({'product_id': self.product.pk, 'quantity': 2}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+
+        # force_login sends user_logged_in with a request that has no .user
+        self.client.force_login(self.user)
+
+        cart = Cart.objects.get(customer=self.user)
+        self.assertEqual(cart.item_count, 2)
+        self.assertEqual(self.client.session[SESSION_KEY]['user'], self.user.pk)
+        self.assertEqual(self.client.session[SESSION_KEY]['count'], 2)
+
+
+class CachedCartTests(TestCase):
+    def setUp(self):
+        self.store = CacheCartStore()
+        self.tee = Product.objects.create(name='Tee', slug='tee', description='', price=Decimal('10.00'))
+        self.cap = Product.objects.create(name='Cap', slug='cap', description='', price=Decimal('4.00'))
+
+    def reload(self):
+        return CachedCart(self.store, 'token', self.store.load('token'))
+
+    def test_line_changes_are_stored(self):
+        cart = CachedCart(self.store, 'token')
+        cart.add_item(self.tee, quantity=1)
+        cart.add_item(self.cap, quantity=2)
+        cart.add_item(self.tee, quantity=2)
+
+        cart = self.reload()
+        self.assertEqual(sorted(cart.as_lines()), sorted([(self.tee.pk, None, 3), (self.cap.pk, None, 2)]))
+        self.assertEqual(cart.subtotal, Decimal('38.00'))
+
+        items = {item.product_id: item for item in cart.get_items()}
+        cart.update_item_quantity(items[self.tee.pk], 1)
+        cart.apply_batch(removals=[items[self.cap.pk].id])
+        self.assertEqual(self.reload().as_lines(), [(self.tee.pk, None, 1)])
+
+        cart.clear()
+        self.assertTrue(self.reload().is_empty)
+
+
+class CartTotalsTests(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(
+            name='Mug', slug='mug', description='', price=Decimal('6.00'), status='active', stock_quantity=50
+        )
+        self.cart = Cart.objects.create()
+        self.item = self.cart.add_item(self.product, quantity=1)
+
+    def assertTotals(self, count, subtotal):
+        cart = Cart.objects.get(pk=self.cart.pk)
+        self.assertEqual((cart.item_count, cart.subtotal), (count, Decimal(subtotal)))
+        self.assertEqual(sum(quantity for product, variant, quantity in cart.as_lines()), count)
+
+    def test_changes_from_stale_items_keep_totals_right(self):
+        # Two tabs loaded the same line before either changed it
+        first, second = self.cart.get_item(self.item.pk), self.cart.get_item(self.item.pk)
+        self.cart.update_item_quantity(first, 3)
+        self.cart.update_item_quantity(second, 2)
+        self.assertTotals(2, '12.00')
+
+        self.cart.delete_item(first)
+        self.cart.delete_item(second)
+        self.assertTotals(0, '0.00')
+
+    def test_only_price_changes_reprice_carts(self):
+        Cart.objects.filter(pk=self.cart.pk).update(subtotal=Decimal('1.00'))
+        self.product.stock_quantity = 40
+        self.product.save()
+        self.assertEqual(Cart.objects.get(pk=self.cart.pk).subtotal, Decimal('1.00'))
+
+        self.product.price = Decimal('7.00')
+        self.product.save(update_fields=['stock_quantity'])
+        self.assertEqual(Cart.objects.get(pk=self.cart.pk).subtotal, Decimal('1.00'))
 
-# Create your tests here.
+        self.product.save()
+        self.assertEqual(Cart.objects.get(pk=self.cart.pk).subtotal, Decimal('7.00'))
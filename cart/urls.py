@@ -9,6 +9,7 @@ urlpatterns = [
     path('remove/', views.remove_from_cart, name='remove'),
     path('update/', views.update_cart_item, name='update'),
     path('clear/', views.clear_cart, name='clear'),
+    path('batch/', views.batch_update_cart, name='batch'),
     path('checkout/', views.CheckoutView.as_view(), name='checkout'),
     path('checkout/success/', views.checkout_success, name='checkout_success'),
     
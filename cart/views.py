@@ -7,51 +7,70 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
+from django.db import DatabaseError, transaction
+from django.urls import reverse
 import json
-from decimal import Decimal
+import logging
 
+from customers.models import Address
+from orders.checkout import CheckoutError, hold_stock, place_order
+from orders.pricing import default_destination, quote
+from payments.gateways import GatewayError
+from .badge import remember_cart_count
 from .models import Cart, CartItem, WishList, WishListItem
+from .storage import get_cart_store
 from products.models import Product, ProductVariant
 
 
-def get_or_create_cart(request):
-    """Get or create cart for user or session"""
+logger = logging.getLogger('xcommerce')
+
+
+def get_or_create_cart(request, persist=False):
+    """
+    Get or create cart for user or session
+    
+    Anonymous carts come from the configured store and may live in the cache.
+    Pass ``persist=True`` when a database row is required, as in checkout.
+    """
     if request.user.is_authenticated:
         cart, created = Cart.objects.get_or_create(
             customer=request.user,
             defaults={'is_active': True}
         )
+    elif persist:
+        cart = get_cart_store().persist(request)
     else:
-        session_key = request.session.session_key
-        if not session_key:
-            request.session.create()
-            session_key = request.session.session_key
-        
-        cart, created = Cart.objects.get_or_create(
-            session_key=session_key,
-            customer=None,
-            defaults={'is_active': True}
-        )
+        cart = get_cart_store().get_cart(request)
     
     return cart
 
 
+def quote_context(items, destination=None):
+    """Template context for the shipping, tax and total of a cart"""
+    pricing = quote(items, destination)
+    return {
+        'subtotal': pricing.subtotal,
+        'shipping_cost': pricing.shipping_cost,
+        'tax_rate': pricing.tax_rate * 100,
+        'tax_amount': pricing.tax_amount,
+        'total': pricing.total,
+    }
+
+
 class CartDetailView(TemplateView):
     template_name = 'cart/detail.html'
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         cart = get_or_create_cart(self.request)
+        remember_cart_count(self.request, cart)
         
         context['cart'] = cart
-        context['cart_items'] = cart.items.select_related('product', 'variant').prefetch_related('product__images')
-        
-        # Calculate totals
-        context['subtotal'] = cart.subtotal
-        context['shipping_cost'] = Decimal('10.00')  # Static for now
-        context['tax_rate'] = Decimal('0.08')  # 8% tax
-        context['tax_amount'] = context['subtotal'] * context['tax_rate']
-        context['total'] = context['subtotal'] + context['shipping_cost'] + context['tax_amount']
+        context['cart_items'] = list(cart.get_items())
+        context.update(quote_context(
+            [item for item in context['cart_items'] if item.product.status == 'active'],
+            default_destination(self.request.user),
+        ))
         
         return context
 
@@ -73,6 +92,7 @@ def add_to_cart(request):
         
         cart = get_or_create_cart(request)
         cart.add_item(product, variant, quantity)
+        remember_cart_count(request, cart)
         
         return JsonResponse({
             'success': True,
@@ -96,8 +116,9 @@ def remove_from_cart(request):
         item_id = data.get('item_id')
         
         cart = get_or_create_cart(request)
-        item = get_object_or_404(CartItem, id=item_id, cart=cart)
-        item.delete()
+        item = cart.get_item(item_id)
+        cart.delete_item(item)
+        remember_cart_count(request, cart)
         
         return JsonResponse({
             'success': True,
@@ -125,9 +146,9 @@ def update_cart_item(request):
             raise ValueError("Quantity must be at least 1")
         
         cart = get_or_create_cart(request)
-        item = get_object_or_404(CartItem, id=item_id, cart=cart)
-        item.quantity = quantity
-        item.save()
+        item = cart.get_item(item_id)
+        cart.update_item_quantity(item, quantity)
+        remember_cart_count(request, cart)
         
         return JsonResponse({
             'success': True,
@@ -150,6 +171,7 @@ def clear_cart(request):
     try:
         cart = get_or_create_cart(request)
         cart.clear()
+        remember_cart_count(request, cart)
         
         return JsonResponse({
             'success': True,
@@ -165,6 +187,98 @@ def clear_cart(request):
         }, status=400)
 
 
+MAX_BATCH_OPERATIONS = 200
+
+
+def parse_batch_operations(operations):
+    """
+    Validate a list of cart operations
+    
+    Returns ``(adds, quantities, removals)`` ready for ``apply_batch``. Every
+    product and variant is loaded with one ``in_bulk`` query per model.
+    """
+    if not isinstance(operations, list) or not operations:
+        raise ValueError('operations must be a non-empty list')
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        raise ValueError(f'At most {MAX_BATCH_OPERATIONS} operations per batch')
+    
+    product_ids, variant_ids = set(), set()
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise ValueError('Each operation must be an object')
+        if operation.get('op') == 'add':
+            product_ids.add(int(operation['product_id']))
+            if operation.get('variant_id'):
+                variant_ids.add(int(operation['variant_id']))
+    
+    products = Product.objects.filter(status='active').in_bulk(product_ids) if product_ids else {}
+    variants = ProductVariant.objects.in_bulk(variant_ids) if variant_ids else {}
+    
+    adds, quantities, removals = [], {}, set()
+    for operation in operations:
+        op = operation.get('op')
+        if op == 'add':
+            quantity = int(operation.get('quantity', 1))
+            if quantity < 1:
+                raise ValueError('Quantity must be at least 1')
+            product = products.get(int(operation['product_id']))
+            if product is None:
+                raise ValueError(f"Product {operation['product_id']} is not available")
+            variant = None
+            if operation.get('variant_id'):
+                variant = variants.get(int(operation['variant_id']))
+                if variant is None or variant.product_id != product.pk:
+                    raise ValueError(f"Variant {operation['variant_id']} does not belong to product {product.pk}")
+            adds.append((product, variant, quantity))
+        elif op == 'update':
+            quantity = int(operation.get('quantity', 1))
+            if quantity < 1:
+                raise ValueError('Quantity must be at least 1')
+            quantities[int(operation['item_id'])] = quantity
+        elif op == 'remove':
+            removals.add(int(operation['item_id']))
+        else:
+            raise ValueError(f'Unknown operation: {op!r}')
+    
+    return adds, quantities, removals
+
+
+@require_POST
+def batch_update_cart(request):
+    """Apply many add/update/remove operations in one request"""
+    try:
+        data = json.loads(request.body)
+        adds, quantities, removals = parse_batch_operations(data.get('operations'))
+        
+        cart = get_or_create_cart(request)
+        cart.apply_batch(adds, quantities, removals)
+        remember_cart_count(request, cart)
+        
+        return JsonResponse({
+            'success': True,
+            'message': 'Cart updated',
+            'cart_count': cart.total_items,
+            'cart_subtotal': str(cart.subtotal),
+            'items': [
+                {
+                    'id': item.id,
+                    'product_id': item.product_id,
+                    'variant_id': item.variant_id,
+                    'quantity': item.quantity,
+                    'unit_price': str(item.unit_price),
+                    'total_price': str(item.total_price),
+                }
+                for item in cart.get_items()
+            ],
+        })
+        
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'message': str(e)
+        }, status=400)
+
+
 class CheckoutView(TemplateView):
     template_name = 'cart/checkout.html'
     
@@ -175,21 +289,108 @@ class CheckoutView(TemplateView):
             return redirect('cart:detail')
         return super().dispatch(request, *args, **kwargs)
     
+    def get(self, request, *args, **kwargs):
+        cart = get_or_create_cart(request, persist=True)
+        try:
+            hold_stock(cart)
+        except CheckoutError as e:
+            messages.error(request, str(e))
+            return redirect('cart:detail')
+        return super().get(request, *args, **kwargs)
+    
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        cart = get_or_create_cart(self.request)
+        cart = get_or_create_cart(self.request, persist=True)
         
         context['cart'] = cart
-        context['cart_items'] = cart.items.select_related('product', 'variant').prefetch_related('product__images')
-        
-        # Calculate totals
-        context['subtotal'] = cart.subtotal
-        context['shipping_cost'] = Decimal('10.00')
-        context['tax_rate'] = Decimal('0.08')
-        context['tax_amount'] = context['subtotal'] * context['tax_rate']
-        context['total'] = context['subtotal'] + context['shipping_cost'] + context['tax_amount']
+        context['cart_items'] = list(cart.get_items())
+        context.update(quote_context(
+            [item for item in context['cart_items'] if item.product.status == 'active'],
+            default_destination(self.request.user),
+        ))
         
         return context
+    
+    def get_addresses(self, data):
+        """Save the checkout addresses for signed-in customers"""
+        if not self.request.user.is_authenticated:
+            return None, None
+        
+        def build(prefix, address_type):
+            return Address(
+                customer=self.request.user,
+                type=address_type,
+                first_name=data.get('first_name', ''),
+                last_name=data.get('last_name', ''),
+                address_line_1=data.get(f'{prefix}_address', ''),
+                address_line_2=data.get(f'{prefix}_address_2', ''),
+                city=data.get(f'{prefix}_city', ''),
+                state=data.get(f'{prefix}_state', ''),
+                postal_code=data.get(f'{prefix}_zip', ''),
+                country=data.get(f'{prefix}_country', 'US'),
+                phone=data.get('phone', ''),
+            )
+        
+        shipping = build('shipping', 'shipping')
+        billing = build('shipping' if not data.get('billing_address') else 'billing', 'billing')
+        Address.objects.bulk_create([shipping, billing])
+        return shipping, billing
+    
+    def post(self, request, *args, **kwargs):
+        """Place the order"""
+        try:
+            if request.content_type == 'application/json':
+                data = json.loads(request.body)
+            else:
+                data = request.POST.dict()
+            if not isinstance(data, dict):
+                raise CheckoutError('Invalid checkout request.')
+            email = data.get('email') or (request.user.email if request.user.is_authenticated else '')
+            if not email:
+                raise CheckoutError('An email address is required.')
+            coupon = str(data.get('coupon') or '').strip()
+            
+            cart = get_or_create_cart(request, persist=True)
+            with transaction.atomic():
+                shipping_address, billing_address = self.get_addresses(data)
+                order = place_order(
+                    cart,
+                    email=email,
+                    customer=request.user if request.user.is_authenticated else None,
+                    phone=data.get('phone', ''),
+                    shipping_address=shipping_address,
+                    billing_address=billing_address,
+                    coupon_codes=[coupon] if coupon else [],
+                    destination=Address(
+                        country=data.get('shipping_country', 'US'), state=data.get('shipping_state', '')
+                    ),
+                )
+            remember_cart_count(request, cart)
+            
+            return JsonResponse({
+                'success': True,
+                'message': 'Order placed',
+                'order_number': order.order_number,
+                'redirect_url': reverse('cart:checkout_success'),
+            })
+        
+        except CheckoutError as e:
+            return JsonResponse({
+                'success': False,
+                'message': str(e)
+            }, status=400)
+        except ValueError:
+            return JsonResponse({
+                'success': False,
+                'message': 'Invalid checkout request.'
+            }, status=400)
+        except (GatewayError, DatabaseError):
+            # Nothing was written; the customer can safely try again
+            logger.exception('Checkout failed')
+            return JsonResponse({
+                'success': False,
+                'message': 'We could not place your order just now. Please try again.'
+            }, status=503)
 
 
 def checkout_success(request):
@@ -207,7 +408,7 @@ class WishListView(LoginRequiredMixin, TemplateView):
         
         wishlist, created = WishList.objects.get_or_create(customer=self.request.user)
         context['wishlist'] = wishlist
-        context['wishlist_items'] = wishlist.items.select_related('product').prefetch_related('product__images')
+        context['wishlist_items'] = wishlist.items.select_related('product__primary_image')
         
         return context
 
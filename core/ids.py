@@ -0,0 +1,215 @@
+"""
+Time-ordered identifiers for orders, refunds and other public references.
+
+IDs are generated in the process, with no database round trip, and sort in
+creation order. New rows therefore append to the end of the unique index
+instead of landing on random pages.
+
+``SnowflakeGenerator``, the default, packs a 63-bit integer:
+
+    41 bits  milliseconds since 2024-01-01 (good until 2093)
+    10 bits  worker slot, unique among running processes
+    12 bits  sequence within the millisecond
+
+and writes it as 13 Crockford base32 characters. That alphabet has no I, L,
+O or U, so IDs are easy to read out over the phone. Worker slots are leased
+from the cache when it is Redis and renewed while the process is in use. Set
+``ID_WORKER_ID`` to pin a slot instead. Without either, each process picks a
+random slot and logs a warning: two processes then share a slot with odds of
+1 in 1024 per pair, and may issue the same ID if they also hit the same
+millisecond and sequence. The unique indexes reject such a repeat, but that
+setup is only meant for development.
+
+``UlidGenerator`` needs no slots. It writes 48 bits of time and 80 random bits
+as 26 characters, and increments within a millisecond to stay monotonic.
+
+Both keep issuing increasing IDs if the clock steps back, by reusing the
+last timestamp, and both reset in a forked child process.
+"""
+import logging
+import os
+import secrets
+import threading
+import time
+import uuid
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+DECODE = {char: value for value, char in enumerate(ALPHABET)}
+DECODE.update({char.lower(): value for char, value in list(DECODE.items())})
+DECODE.update({'I': 1, 'i': 1, 'L': 1, 'l': 1, 'O': 0, 'o': 0})
+
+EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+
+logger = logging.getLogger('xcommerce')
+
+
+def encode(value, width):
+    """Write ``value`` as ``width`` Crockford base32 characters"""
+    chars = []
+    for _ in range(width):
+        value, digit = divmod(value, 32)
+        chars.append(ALPHABET[digit])
+    if value:
+        raise ValueError('Value too large for the requested width')
+    return ''.join(reversed(chars))
+
+
+def decode(text):
+    """Read Crockford base32, tolerating lower case, hyphens and look-alike letters"""
+    value = 0
+    for char in text.replace('-', ''):
+        try:
+            value = value * 32 + DECODE[char]
+        except KeyError:
+            raise ValueError(f'Invalid character {char!r} in ID')
+    return value
+
+
+def now_ms():
+    return time.time_ns() // 1_000_000
+
+
+class BaseIdGenerator:
+    """
+    Interface shared by the ID generators
+    """
+    width = None
+
+    def __init__(self):
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """Forget per-process state, so a forked child never repeats its parent"""
+        self._lock = threading.Lock()
+        self._last_ms = 0
+
+    def next_int(self):
+        raise NotImplementedError
+
+    def next_id(self, prefix=''):
+        return prefix + encode(self.next_int(), self.width)
+
+
+class SnowflakeGenerator(BaseIdGenerator):
+    """
+    63-bit IDs of time, worker slot and sequence
+    """
+    width = 13
+    worker_bits = 10
+    sequence_bits = 12
+    lease_seconds = 60 * 60
+    lease_prefix = 'ids:worker'
+
+    def _reset(self):
+        super()._reset()
+        self._sequence = 0
+        self._worker = None
+        self._token = uuid.uuid4().hex
+        self._leased_at = 0.0
+
+    @property
+    def uses_lease(self):
+        return (
+            getattr(settings, 'ID_WORKER_ID', None) in (None, '')
+            and settings.CACHES['default']['BACKEND'].startswith('django_redis.')
+        )
+
+    def _lease_key(self, worker):
+        return f'{self.lease_prefix}:{worker}'
+
+    def _acquire_worker(self):
+        configured = getattr(settings, 'ID_WORKER_ID', None)
+        slots = 1 << self.worker_bits
+        if configured not in (None, ''):
+            return int(configured) % slots
+        if not self.uses_lease:
+            worker = secrets.randbelow(slots)
+            logger.warning(
+                'No Redis cache or ID_WORKER_ID; using random ID worker slot %d, which another process may share',
+                worker,
+            )
+            return worker
+
+        cache.add(f'{self.lease_prefix}:next', 0, None)
+        start = cache.incr(f'{self.lease_prefix}:next')
+        for offset in range(slots):
+            worker = (start + offset) % slots
+            if cache.add(self._lease_key(worker), self._token, self.lease_seconds):
+                self._leased_at = time.monotonic()
+                return worker
+        raise RuntimeError('Every ID worker slot is leased')
+
+    def _check_worker(self):
+        if self._worker is None:
+            self._worker = self._acquire_worker()
+        elif self.uses_lease and time.monotonic() - self._leased_at > self.lease_seconds / 4:
+            # An idle process may have lost its slot; take a new one if so
+            if cache.get(self._lease_key(self._worker)) == self._token:
+                cache.touch(self._lease_key(self._worker), self.lease_seconds)
+                self._leased_at = time.monotonic()
+            else:
+                self._worker = self._acquire_worker()
+
+    def next_int(self):
+        with self._lock:
+            self._check_worker()
+            # Never go back in time, even if the clock does
+            current = max(now_ms() - EPOCH_MS, self._last_ms)
+            if current == self._last_ms:
+                self._sequence = (self._sequence + 1) & ((1 << self.sequence_bits) - 1)
+                if not self._sequence:
+                    # Sequence exhausted; borrow the next millisecond
+                    current += 1
+            else:
+                self._sequence = 0
+            self._last_ms = current
+            return (
+                (current << (self.worker_bits + self.sequence_bits))
+                | (self._worker << self.sequence_bits)
+                | self._sequence
+            )
+
+
+class UlidGenerator(BaseIdGenerator):
+    """
+    128-bit ULIDs of time and randomness
+    """
+    width = 26
+    random_bits = 80
+
+    def _reset(self):
+        super()._reset()
+        self._random = 0
+
+    def next_int(self):
+        with self._lock:
+            current = max(now_ms(), self._last_ms)
+            if current == self._last_ms:
+                self._random += 1
+                if self._random >> self.random_bits:
+                    current += 1
+                    self._random = secrets.randbits(self.random_bits - 1)
+            else:
+                # Leave headroom so increments within the millisecond cannot overflow
+                self._random = secrets.randbits(self.random_bits - 1)
+            self._last_ms = current
+            return (current << self.random_bits) | self._random
+
+
+@lru_cache(maxsize=None)
+def get_id_generator():
+    """Return the configured ID generator"""
+    return import_string(getattr(settings, 'ID_GENERATOR', 'core.ids.SnowflakeGenerator'))()
+
+
+def new_id(prefix=''):
+    """Return a new time-ordered ID string"""
+    return get_id_generator().next_id(prefix)
@@ -0,0 +1,150 @@
+"""
+In-process indexes kept coherent across worker processes.
+
+Each worker builds its own copy of the index lazily on first use. Once the
+transaction that changes a record commits, the process applies the change to
+its own copy and appends it to a short change log in the shared cache. Every other worker reads
+the log at most once per ``sync_interval`` seconds and replays the changes it
+missed. If the log has expired or fallen too far behind, the worker rebuilds
+its copy from the database instead.
+
+A change takes its place in the log by incrementing the generation, and is
+stored under that generation just after. A worker that finds the newest
+entries missing replays up to the gap and looks again later. It rebuilds only
+if the gap is still there after ``gap_timeout`` seconds, as when the writer
+died in between.
+"""
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+
+logger = logging.getLogger('xcommerce')
+
+
+class ProcessLocalIndex:
+    """
+    Base class for per-process indexes
+
+    Subclasses set ``name`` and implement ``build()`` and ``apply_changes()``.
+    """
+    name = None
+    sync_interval = 5
+    change_log_ttl = 600
+    max_replay = 1000
+    gap_timeout = 10
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._built = False
+        self._generation = 0
+        self._checked_at = 0.0
+        self._gap_since = None
+
+    @property
+    def generation_key(self):
+        return f'local_index:{self.name}:generation'
+
+    def change_key(self, generation):
+        return f'local_index:{self.name}:change:{generation}'
+
+    def build(self):
+        """Load the whole index from the database"""
+        raise NotImplementedError
+
+    def apply_changes(self, keys):
+        """Refresh the entries for the given record keys"""
+        raise NotImplementedError
+
+    def warm(self):
+        """Build the index now instead of on the first request"""
+        self.ensure_ready(force_check=True)
+
+    def ensure_ready(self, force_check=False):
+        """Build the index if needed and replay changes made by other workers"""
+        now = time.monotonic()
+        if self._built and not force_check and now - self._checked_at < self.sync_interval:
+            return
+
+        with self._lock:
+            generation = cache.get(self.generation_key) or 0
+            if not self._built:
+                self._rebuild(generation)
+            elif generation != self._generation:
+                self._catch_up(generation)
+            self._checked_at = now
+
+    def record_change(self, key):
+        """
+        Apply a change to this process's copy and publish it to other workers
+
+        Both happen once the surrounding transaction commits, so a rolled back
+        change is never applied, and no worker re-reads the record before it
+        is saved.
+        """
+        transaction.on_commit(lambda: self._publish(key))
+
+    def _publish(self, key):
+        with self._lock:
+            if self._built:
+                self.apply_changes([key])
+
+            try:
+                generation = cache.incr(self.generation_key)
+            except ValueError:
+                cache.add(self.generation_key, 0, None)
+                generation = cache.incr(self.generation_key)
+            cache.set(self.change_key(generation), key, self.change_log_ttl)
+
+            if generation == self._generation + 1:
+                self._generation = generation
+            else:
+                # Another worker published changes we have not replayed yet
+                self._checked_at = 0.0
+
+    def invalidate(self):
+        """Force every worker, including this one, to rebuild once the transaction commits"""
+        transaction.on_commit(self._invalidate)
+
+    def _invalidate(self):
+        with self._lock:
+            self._built = False
+            try:
+                cache.incr(self.generation_key, self.max_replay + 1)
+            except ValueError:
+                cache.add(self.generation_key, 0, None)
+
+    def _rebuild(self, generation):
+        started = time.monotonic()
+        self.build()
+        self._built = True
+        self._generation = generation
+        self._gap_since = None
+        logger.info('Built %s index in %.2fs', self.name, time.monotonic() - started)
+
+    def _catch_up(self, generation):
+        missed = generation - self._generation
+        if missed < 0 or missed > self.max_replay:
+            self._rebuild(generation)
+            return
+
+        keys = [self.change_key(g) for g in range(self._generation + 1, generation + 1)]
+        changes = cache.get_many(keys)
+        replayable = next((count for count, key in enumerate(keys) if key not in changes), missed)
+        if replayable < missed:
+            # The writer may not have stored the entry yet; wait a while for it
+            now = time.monotonic()
+            if self._gap_since is None:
+                self._gap_since = now
+            elif now - self._gap_since > self.gap_timeout:
+                self._rebuild(generation)
+                return
+        else:
+            self._gap_since = None
+
+        if replayable:
+            self.apply_changes(list(dict.fromkeys(changes[key] for key in keys[:replayable])))
+            self._generation += replayable
@@ -0,0 +1,81 @@
+import hashlib
+import os
+import time
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from core.storage import (
+    CHUNK_SIZE, ContentAddressedStorage, acquire, collect_garbage, count_references, get_reference_providers,
+    is_blob,
+)
+
+
+class Command(BaseCommand):
+    help = 'Move stored media into content-addressed blobs, then remove blobs nothing refers to'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Files moved before references are updated')
+        parser.add_argument('--grace', type=int, default=None,
+                            help='Seconds a blob must be unreferenced before it is removed (MEDIA_BLOB_GC_GRACE)')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be moved and removed')
+
+    def digest(self, name):
+        digest, size = hashlib.sha256(), 0
+        with default_storage.open(name, 'rb') as handle:
+            for chunk in handle.chunks(CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+        return digest.hexdigest(), size
+
+    def move(self, chunk, counts):
+        """Store a chunk of files as blobs, repoint their references, then remove the originals"""
+        renamed, sizes = {}, {}
+        for name in chunk:
+            with default_storage.open(name, 'rb') as handle:
+                renamed[name], digest, sizes[name] = default_storage.store(handle, os.path.splitext(name)[1])
+            acquire(renamed[name], digest, sizes[name], count=counts[name])
+        for provider in get_reference_providers():
+            provider.rename(renamed)
+        for name in chunk:
+            default_storage.delete(name)
+        return renamed, sizes
+
+    def handle(self, *args, **options):
+        if not isinstance(default_storage, ContentAddressedStorage):
+            raise CommandError('The default storage is not core.storage.ContentAddressedStorage')
+        dry_run = options['dry_run']
+        started = time.monotonic()
+
+        counts = count_references()
+        pending = sorted(name for name in counts if not is_blob(name))
+        missing = {name for name in pending if not default_storage.exists(name)}
+        for name in sorted(missing):
+            self.stderr.write(f'Missing file: {name}')
+        pending = [name for name in pending if name not in missing]
+
+        digests, moved_bytes = set(), 0
+        chunk_size = options['chunk_size']
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start:start + chunk_size]
+            if dry_run:
+                for name in chunk:
+                    digest, size = self.digest(name)
+                    digests.add(digest)
+                    moved_bytes += size
+            else:
+                renamed, sizes = self.move(chunk, counts)
+                digests.update(renamed.values())
+                moved_bytes += sum(sizes.values())
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{start + len(chunk)} of {len(pending)} files')
+
+        removed, freed = collect_garbage(options['grace'], dry_run)
+        elapsed = time.monotonic() - started
+
+        verb = 'would be' if dry_run else 'were'
+        self.stdout.write(f'Files moved:       {len(pending)} ({moved_bytes / 1048576:.1f} MiB) {verb} stored as '
+                          f'{len(digests)} blobs')
+        self.stdout.write(f'Missing files:     {len(missing)}')
+        self.stdout.write(f'Blobs removed:     {removed} ({freed / 1048576:.1f} MiB) {verb} unreferenced')
+        self.stdout.write(self.style.SUCCESS(f'Done in {elapsed:.1f}s'))
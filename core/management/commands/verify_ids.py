@@ -0,0 +1,86 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.ids import get_id_generator
+
+
+BUCKETS = 61
+FLUSH_EVERY = 100000
+
+
+def generate(args):
+    """Write IDs from one process into bucket files; report count, rate and ordering"""
+    worker, count, directory, size = args
+    generator = get_id_generator()
+    buckets = [[] for _ in range(BUCKETS)]
+    files = [open(os.path.join(directory, f'{worker}-{bucket}'), 'wb') for bucket in range(BUCKETS)]
+    previous, out_of_order = -1, 0
+    started = time.perf_counter()
+    try:
+        for number in range(count):
+            value = generator.next_int()
+            if value <= previous:
+                out_of_order += 1
+            previous = value
+            buckets[value % BUCKETS].append(value)
+            if number % FLUSH_EVERY == FLUSH_EVERY - 1:
+                for values, handle in zip(buckets, files):
+                    handle.write(b''.join(value.to_bytes(size, 'big') for value in values))
+                    values.clear()
+        for values, handle in zip(buckets, files):
+            handle.write(b''.join(value.to_bytes(size, 'big') for value in values))
+    finally:
+        for handle in files:
+            handle.close()
+    return count / (time.perf_counter() - started), out_of_order
+
+
+class Command(BaseCommand):
+    help = 'Generate IDs from several processes and check that none repeat'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=8)
+        parser.add_argument('--per-process', type=int, default=2500000, help='IDs generated by each process')
+
+    def handle(self, *args, **options):
+        processes, per_process = options['processes'], options['per_process']
+        generator = get_id_generator()
+        size = 8 if generator.width <= 13 else 16
+        # Use the generator before forking, so the children must not inherit its state
+        generator.next_int()
+
+        directory = tempfile.mkdtemp(prefix='verify_ids_')
+        try:
+            started = time.perf_counter()
+            with multiprocessing.get_context('fork').Pool(processes) as pool:
+                results = pool.map(generate, [(worker, per_process, directory, size) for worker in range(processes)])
+            elapsed = time.perf_counter() - started
+
+            # Equal IDs land in the same bucket, so each bucket is checked on its own
+            total = duplicates = 0
+            for bucket in range(BUCKETS):
+                seen, count = set(), 0
+                for worker in range(processes):
+                    with open(os.path.join(directory, f'{worker}-{bucket}'), 'rb') as handle:
+                        data = handle.read()
+                    seen.update(data[start:start + size] for start in range(0, len(data), size))
+                    count += len(data) // size
+                total += count
+                duplicates += count - len(seen)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        self.stdout.write(f'Generator:        {generator.__class__.__name__}')
+        self.stdout.write(f'IDs generated:    {total:,} by {processes} processes in {elapsed:.1f}s')
+        self.stdout.write(f'Per process:      {min(rate for rate, _ in results):,.0f} IDs/s or more')
+        self.stdout.write(f'Out of order:     {sum(disorder for _, disorder in results)}')
+        if duplicates:
+            raise CommandError(f'{duplicates} duplicate IDs')
+        if any(disorder for _, disorder in results):
+            raise CommandError('IDs were not increasing within a process')
+        self.stdout.write(self.style.SUCCESS('Duplicates:       0'))
@@ -75,3 +75,20 @@ class Category(TimeStampedModel):
         db_table = 'core_category'
         verbose_name_plural = 'categories'
         ordering = ['sort_order', 'name']
+
+
+class MediaBlob(TimeStampedModel):
+    """
+    A file stored once under its content digest by core.storage
+    """
+    name = models.CharField(max_length=255, unique=True)
+    digest = models.CharField(max_length=64, db_index=True)
+    size = models.BigIntegerField(default=0)
+    # Rows and records pointing at the blob; zero makes it garbage
+    refcount = models.IntegerField(default=0)
+    
+    def __str__(self):
+        return self.name
+    
+    class Meta:
+        db_table = 'core_media_blob'
@@ -0,0 +1,282 @@
+"""
+Pagination helpers for large listings.
+
+``CursorPaginator`` pages by keyset instead of OFFSET. Each page starts right
+after the last row of the previous one, so page 500 is as cheap as page 1.
+It reads the sort key from the queryset ordering, which must be a single
+non-null field followed by ``id`` as a tiebreaker in the same direction,
+such as ``('-price', '-id')``. A composite index on those columns covers the
+query.
+
+Cursors are signed, so clients cannot forge positions or inject filter values.
+
+``ApproximateCountPaginator`` stops counting at ``count_threshold`` rows. On
+PostgreSQL it then falls back to the planner's row estimate, so very large
+result sets never pay for an exact COUNT(*).
+"""
+import json
+from datetime import datetime
+from decimal import Decimal
+
+from django.core import signing
+from django.core.paginator import EmptyPage, Page, Paginator
+from django.db import connections
+from django.db.models import Q
+from django.http import Http404
+from django.utils.functional import cached_property
+
+
+DEFAULT_COUNT_THRESHOLD = 10000
+
+
+def approximate_count(queryset, threshold=DEFAULT_COUNT_THRESHOLD):
+    """
+    Return ``(count, is_exact)`` for a queryset
+
+    Counts exactly up to ``threshold`` rows with a bounded subquery. Larger
+    result sets use the PostgreSQL planner estimate when available, or else
+    report ``threshold`` as a lower bound.
+    """
+    bounded = queryset.order_by()[:threshold].count()
+    if bounded < threshold:
+        return bounded, True
+
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.order_by().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return max(int(plan[0]['Plan']['Plan Rows']), threshold), False
+
+    return threshold, False
+
+
+class ApproximateCountPaginator(Paginator):
+    """
+    Page-number paginator that does not run an unbounded COUNT(*)
+    """
+    count_threshold = DEFAULT_COUNT_THRESHOLD
+
+    def __init__(self, *args, count_threshold=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if count_threshold is not None:
+            self.count_threshold = count_threshold
+
+    @cached_property
+    def _approximate_count(self):
+        if hasattr(self.object_list, 'query'):
+            return approximate_count(self.object_list, self.count_threshold)
+        return len(self.object_list), True
+
+    @cached_property
+    def count(self):
+        return self._approximate_count[0]
+
+    @property
+    def count_is_exact(self):
+        return self._approximate_count[1]
+
+    def validate_number(self, number):
+        try:
+            return super().validate_number(number)
+        except EmptyPage:
+            # Past the estimate there may still be rows; page() checks
+            if self.count_is_exact:
+                raise
+            return int(number)
+
+    def page(self, number):
+        if self.count_is_exact:
+            return super().page(number)
+
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not rows and number > 1:
+            raise EmptyPage('That page contains no results')
+        return ApproximatePage(rows[:self.per_page], number, self, len(rows) > self.per_page)
+
+
+class ApproximatePage(Page):
+    """
+    Page whose neighbours are known from the rows fetched, not from the count
+    """
+
+    def __init__(self, object_list, number, paginator, has_next):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+    def end_index(self):
+        return self.start_index() + len(self.object_list) - 1
+
+
+def _encode_value(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+class CursorPage:
+    """
+    One page of a keyset-paginated listing
+    """
+
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return f'<CursorPage of {len(self.object_list)} items>'
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    """
+    Keyset paginator with opaque, signed cursors
+    """
+
+    def __init__(self, queryset, per_page, salt='core.pagination', count_threshold=DEFAULT_COUNT_THRESHOLD):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.salt = salt
+        self.count_threshold = count_threshold
+
+        ordering = list(queryset.query.order_by)
+        if len(ordering) != 2 or ordering[1].lstrip('-') not in ('id', 'pk'):
+            raise ValueError(f'Cursor pagination needs ordering like (field, id), got {ordering!r}')
+        self.descending = ordering[0].startswith('-')
+        if ordering[1].startswith('-') != self.descending:
+            raise ValueError('The id tiebreaker must be sorted in the same direction as the sort key')
+        self.field = ordering[0].lstrip('-')
+
+    @cached_property
+    def _approximate_count(self):
+        return approximate_count(self.queryset, self.count_threshold)
+
+    @cached_property
+    def count(self):
+        return self._approximate_count[0]
+
+    @property
+    def count_is_exact(self):
+        return self._approximate_count[1]
+
+    def encode_cursor(self, obj, direction):
+        position = [_encode_value(getattr(obj, self.field)), obj.pk]
+        return signing.dumps({'f': self.field, 'p': position, 'd': direction}, salt=self.salt, compress=True)
+
+    def decode_cursor(self, cursor):
+        try:
+            data = signing.loads(cursor, salt=self.salt)
+        except signing.BadSignature:
+            raise Http404('Invalid cursor')
+        if data.get('f') != self.field or data.get('d') not in ('next', 'prev'):
+            raise Http404('Invalid cursor')
+
+        value, pk = data['p']
+        field = self.queryset.model._meta.get_field(self.field)
+        return field.to_python(value), pk, data['d']
+
+    def _after(self, value, pk, forward):
+        """Rows strictly after ``(value, pk)`` in the direction of travel"""
+        greater = forward != self.descending
+        lookup = 'gt' if greater else 'lt'
+        return Q(**{f'{self.field}__{lookup}': value}) | Q(**{self.field: value, f'pk__{lookup}': pk})
+
+    def page(self, cursor=None):
+        """Return the page that starts at ``cursor``, or the first page"""
+        queryset = self.queryset
+        direction = 'next'
+        if cursor:
+            value, pk, direction = self.decode_cursor(cursor)
+            queryset = queryset.filter(self._after(value, pk, forward=direction == 'next'))
+
+        if direction == 'prev':
+            queryset = queryset.reverse()
+
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+
+        if direction == 'prev':
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, bool(cursor)
+
+        next_cursor = previous_cursor = None
+        if rows and has_next:
+            next_cursor = self.encode_cursor(rows[-1], 'next')
+        if rows and has_previous:
+            previous_cursor = self.encode_cursor(rows[0], 'prev')
+        return CursorPage(rows, self, next_cursor, previous_cursor)
+
+
+class CursorPaginationMixin:
+    """
+    ListView mixin adding a cursor pagination mode
+
+    Requests that carry the ``cursor`` query parameter, even an empty one, get
+    keyset pages. Other requests keep page numbers, counted with
+    ``ApproximateCountPaginator``.
+    """
+    paginator_class = ApproximateCountPaginator
+    cursor_query_param = 'cursor'
+    count_threshold = DEFAULT_COUNT_THRESHOLD
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        return self.paginator_class(
+            queryset, per_page, orphans=orphans, allow_empty_first_page=allow_empty_first_page,
+            count_threshold=self.count_threshold, **kwargs
+        )
+
+    def paginate_queryset(self, queryset, page_size):
+        if self.cursor_query_param not in self.request.GET:
+            return super().paginate_queryset(queryset, page_size)
+
+        paginator = CursorPaginator(
+            queryset, page_size, salt=f'{self.__class__.__module__}.{self.__class__.__name__}',
+            count_threshold=self.count_threshold,
+        )
+        page = paginator.page(self.request.GET.get(self.cursor_query_param))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        query.pop(self.cursor_query_param, None)
+        context['pagination_query'] = query.urlencode()
+        context['cursor_pagination'] = self.cursor_query_param in self.request.GET
+
+        page = context.get('page_obj')
+        if page is not None and not context['cursor_pagination']:
+            context['page_range'] = page.paginator.get_elided_page_range(page.number)
+        return context
@@ -0,0 +1,209 @@
+"""
+Content-addressed media storage.
+
+``ContentAddressedStorage`` stores every upload under the SHA-256 digest of
+its content, as ``blobs/ab/cd/<digest><ext>``, whatever the uploaded file was
+called. The same image uploaded a hundred times is stored once, under one
+URL. The content behind a URL never changes, so it may be cached for good:
+``MEDIA_BLOB_CACHE_CONTROL`` is sent with blobs (see ``core.views.serve_media``),
+and web servers or CDNs in front of MEDIA_ROOT should send it too.
+
+Uploads are hashed while they are written to a temporary file, one chunk at a
+time, so large files never sit in memory. The temporary file is then renamed
+into place, unless the blob exists already.
+
+``MediaBlob`` rows count references. Saving adds one and ``delete()`` takes
+one away; a blob is never removed on the spot, because another upload may
+be about to reuse it. ``collect_garbage`` recounts references from what the
+database actually holds, as listed by the MEDIA_BLOB_REFERENCES providers.
+It then removes blobs nobody has referenced for a grace period.
+``manage.py dedupe_media`` runs it, after moving files saved under their
+upload names into blobs.
+"""
+import hashlib
+import os
+import tempfile
+import time
+from collections import Counter
+from datetime import timedelta
+from functools import lru_cache
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F, FileField
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import MediaBlob
+
+
+BLOB_PREFIX = 'blobs/'
+CHUNK_SIZE = 1024 * 1024
+
+
+def blob_name(digest, extension):
+    return f'{BLOB_PREFIX}{digest[:2]}/{digest[2:4]}/{digest}{extension.lower()}'
+
+
+def is_blob(name):
+    return bool(name) and name.startswith(BLOB_PREFIX)
+
+
+def acquire(name, digest, size, count=1):
+    """Add ``count`` references to a blob"""
+    if MediaBlob.objects.filter(name=name).update(refcount=F('refcount') + count, updated_at=timezone.now()):
+        return
+    try:
+        with transaction.atomic():
+            MediaBlob.objects.create(name=name, digest=digest, size=size, refcount=count)
+    except IntegrityError:
+        MediaBlob.objects.filter(name=name).update(refcount=F('refcount') + count, updated_at=timezone.now())
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    FileSystemStorage that stores each distinct content once, under its digest
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # The name is replaced by the digest, so it never needs to be unique
+        return name
+
+    def _spool(self, content):
+        """Copy ``content`` to a temporary file beside the blobs; returns ``(path, digest, size)``"""
+        directory = self.path(BLOB_PREFIX)
+        os.makedirs(directory, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        handle, path = tempfile.mkstemp(dir=directory, prefix='.incoming-')
+        try:
+            with os.fdopen(handle, 'wb') as temp:
+                for chunk in content.chunks(CHUNK_SIZE):
+                    digest.update(chunk)
+                    temp.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.unlink(path)
+            raise
+        return path, digest.hexdigest(), size
+
+    def store(self, content, extension):
+        """Store ``content`` as a blob without counting a reference; returns ``(name, digest, size)``"""
+        temp_path, digest, size = self._spool(content)
+        name = blob_name(digest, extension)
+        path = self.path(name)
+        if os.path.exists(path):
+            os.unlink(temp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if self.file_permissions_mode is not None:
+                os.chmod(temp_path, self.file_permissions_mode)
+            # Atomic: readers see the whole blob or none of it
+            os.replace(temp_path, path)
+        return name, digest, size
+
+    def _save(self, name, content):
+        extension = os.path.splitext(name)[1]
+        name, digest, size = self.store(content, extension)
+        acquire(name, digest, size)
+        if not os.path.exists(self.path(name)):
+            # Garbage collection removed the blob between store() and acquire()
+            self.store(content, extension)
+        return name
+
+    def delete(self, name):
+        if not is_blob(name):
+            return super().delete(name)
+        MediaBlob.objects.filter(name=name, refcount__gt=0).update(
+            refcount=F('refcount') - 1, updated_at=timezone.now()
+        )
+
+
+class FileFieldReferences:
+    """
+    Media referenced by the file and image fields of all models
+    """
+
+    def fields(self):
+        for model in apps.get_models():
+            for field in model._meta.concrete_fields:
+                if isinstance(field, FileField) and isinstance(field.storage, ContentAddressedStorage):
+                    yield model, field
+
+    def names(self):
+        for model, field in self.fields():
+            queryset = model._default_manager.exclude(**{f'{field.name}__isnull': True}).exclude(**{field.name: ''})
+            yield from queryset.values_list(field.name, flat=True).iterator(chunk_size=5000)
+
+    def rename(self, renamed):
+        """Point references at new names; ``renamed`` maps old names to new ones"""
+        for model, field in self.fields():
+            for old, new in renamed.items():
+                model._default_manager.filter(**{field.name: old}).update(**{field.name: new})
+
+
+@lru_cache(maxsize=None)
+def get_reference_providers():
+    return [import_string(path)() for path in settings.MEDIA_BLOB_REFERENCES]
+
+
+def count_references():
+    """How many times the database references each stored name"""
+    counts = Counter()
+    for provider in get_reference_providers():
+        counts.update(provider.names())
+    return counts
+
+
+def collect_garbage(grace=None, dry_run=False):
+    """
+    Recount blob references and remove blobs unreferenced for ``grace`` seconds
+
+    Returns ``(removed, freed_bytes)``.
+    """
+    grace = settings.MEDIA_BLOB_GC_GRACE if grace is None else grace
+    counts = count_references()
+
+    changed = []
+    for blob in MediaBlob.objects.only('pk', 'name', 'refcount').iterator(chunk_size=5000):
+        if blob.refcount != counts[blob.name]:
+            blob.refcount = counts[blob.name]
+            blob.updated_at = timezone.now()
+            changed.append(blob)
+    if changed and not dry_run:
+        MediaBlob.objects.bulk_update(changed, ['refcount', 'updated_at'], batch_size=1000)
+    recounted = {blob.pk: blob.refcount for blob in changed}
+
+    removed, freed = 0, 0
+    cutoff = timezone.now() - timedelta(seconds=grace)
+    for blob in MediaBlob.objects.filter(updated_at__lt=cutoff).only('pk', 'name', 'size', 'refcount').iterator():
+        if recounted.get(blob.pk, blob.refcount):
+            continue
+        if not dry_run:
+            with transaction.atomic():
+                # The lock makes an upload reusing the blob wait, then write it again
+                if not MediaBlob.objects.select_for_update().filter(pk=blob.pk, refcount=0).exists():
+                    continue
+                path = default_storage.path(blob.name)
+                if os.path.exists(path):
+                    os.unlink(path)
+                MediaBlob.objects.filter(pk=blob.pk).delete()
+        removed += 1
+        freed += blob.size
+
+    # Blobs written by a process that died before counting them, and abandoned temporary files
+    known = set(MediaBlob.objects.values_list('name', flat=True))
+    root = default_storage.path(BLOB_PREFIX)
+    for directory, subdirectories, files in os.walk(root):
+        for filename in files:
+            path = os.path.join(directory, filename)
+            name = BLOB_PREFIX + os.path.relpath(path, root).replace(os.sep, '/')
+            if name in known or counts[name] or time.time() - os.path.getmtime(path) < grace:
+                continue
+            removed += 1
+            freed += os.path.getsize(path)
+            if not dry_run:
+                os.unlink(path)
+    return removed, freed
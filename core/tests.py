@@ -1,3 +1,149 @@
-from django.test import TestCase
+import multiprocessing
+import os
+import shutil
+import tempfile
+import uuid
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from .ids import SnowflakeGenerator, get_id_generator
+from .local_index import ProcessLocalIndex
+from .models import Category, MediaBlob
+from .storage import blob_name, collect_garbage
+
+
+def generate(args):
+    """IDs from one forked process, using the slot the deployment would pin for it"""
+    worker, count = args
+    with override_settings(ID_WORKER_ID=str(worker)):
+        generator = get_id_generator()
+        return [generator.next_int() for _ in range(count)]
+
+
+@override_settings(ID_GENERATOR='core.ids.SnowflakeGenerator', ID_WORKER_ID='')
+class SnowflakeTests(SimpleTestCase):
+    def setUp(self):
+        get_id_generator.cache_clear()
+        self.addCleanup(get_id_generator.cache_clear)
+
+    def test_processes_issue_distinct_increasing_ids(self):
+        # Used before forking, so each child must drop the parent's slot and sequence
+        with self.assertLogs('xcommerce', 'WARNING'):
+            get_id_generator().next_int()
+
+        with multiprocessing.get_context('fork').Pool(4) as pool:
+            results = pool.map(generate, [(worker, 20000) for worker in range(4)])
+
+        for values in results:
+            self.assertEqual(values, sorted(set(values)))
+        self.assertEqual(len(set().union(*results)), 80000)
+
+    def test_without_lease_or_pinned_slot_warns(self):
+        generator = SnowflakeGenerator()
+        with self.assertLogs('xcommerce', 'WARNING') as logs:
+            value = generator.next_int()
+        self.assertIn('random ID worker slot', logs.output[0])
+        self.assertEqual(value >> 12 & 1023, generator._worker)
+
+
+class RecordingIndex(ProcessLocalIndex):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self.builds = 0
+        self.applied = []
+
+    def build(self):
+        self.builds += 1
+
+    def apply_changes(self, keys):
+        self.applied.extend(keys)
+
+
+class ProcessLocalIndexTests(TestCase):
+    def setUp(self):
+        name = uuid.uuid4().hex
+        self.writer, self.reader = RecordingIndex(name), RecordingIndex(name)
+        self.writer.warm()
+        self.reader.warm()
+
+    def test_changes_wait_for_commit(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    self.writer.record_change(1)
+                    raise ValueError
+            with transaction.atomic():
+                self.writer.record_change(2)
+                self.assertEqual(self.writer.applied, [])
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(self.writer.applied, [2])
+
+        self.reader.ensure_ready(force_check=True)
+        self.assertEqual(self.reader.applied, [2])
+        self.assertEqual(self.reader.builds, 1)
+
+    def test_entry_not_stored_yet_is_awaited(self):
+        # The writer has taken generation 1 but not stored its change yet
+        cache.add(self.writer.generation_key, 0, None)
+        cache.incr(self.writer.generation_key)
+        self.reader.ensure_ready(force_check=True)
+        self.assertEqual((self.reader.builds, self.reader.applied), (1, []))
+
+        cache.set(self.writer.change_key(1), 7)
+        self.reader.ensure_ready(force_check=True)
+        self.assertEqual((self.reader.builds, self.reader.applied), (1, [7]))
+
+    def test_lost_entry_forces_rebuild_after_timeout(self):
+        cache.add(self.writer.generation_key, 0, None)
+        cache.incr(self.writer.generation_key)
+        self.reader.gap_timeout = -1
+        self.reader.ensure_ready(force_check=True)
+        self.reader.ensure_ready(force_check=True)
+        self.assertEqual(self.reader.builds, 2)
+
+
+class MediaBlobTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_same_content_is_stored_once(self):
+        first = default_storage.save('a.png', ContentFile(b'pixels'))
+        second = default_storage.save('photos/b.PNG', ContentFile(b'pixels'))
+        self.assertEqual(first, second)
+        self.assertTrue(first.endswith('.png'))
+        self.assertEqual(MediaBlob.objects.get(name=first).refcount, 2)
+
+        for _ in range(3):
+            default_storage.delete(first)
+        self.assertEqual(MediaBlob.objects.get(name=first).refcount, 0)
+        # Only garbage collection removes the file
+        self.assertTrue(default_storage.exists(first))
+
+    def test_garbage_collection_recounts_references(self):
+        kept = Category.objects.create(name='Kitchen', slug='kitchen', image=ContentFile(b'kept', name='k.png'))
+        dropped = default_storage.save('d.png', ContentFile(b'dropped'))
+        self.assertEqual(MediaBlob.objects.get(name=dropped).refcount, 1)
+        # A blob written by a process that died before counting it
+        orphan = blob_name('f' * 64, '.png')
+        os.makedirs(os.path.dirname(default_storage.path(orphan)))
+        with open(default_storage.path(orphan), 'wb') as f:
+            f.write(b'orphan')
+
+        self.assertEqual(collect_garbage(grace=3600), (0, 0))
+        self.assertEqual(MediaBlob.objects.get(name=dropped).refcount, 0)
+        self.assertEqual(collect_garbage(grace=0, dry_run=True), (2, 13))
+        self.assertTrue(default_storage.exists(dropped))
+
+        self.assertEqual(collect_garbage(grace=0), (2, 13))
+        self.assertFalse(default_storage.exists(dropped) or default_storage.exists(orphan))
+        self.assertEqual(list(MediaBlob.objects.values_list('name', 'refcount')), [(kept.image.name, 1)])
+        self.assertTrue(default_storage.exists(kept.image.name))
@@ -1,8 +1,12 @@
+from django.conf import settings
 from django.shortcuts import render
+from django.views.static import serve
 from django.views.generic import TemplateView
 from django.db.models import Q
+from products.cards import render_cards
 from products.models import Product
 from core.models import Category, Store
+from core.storage import is_blob
 
 
 class HomeView(TemplateView):
@@ -22,8 +26,9 @@ class HomeView(TemplateView):
         featured_products = Product.objects.filter(
             status='active',
             is_featured=True
-        ).select_related('category').prefetch_related('images')[:8]
+        ).select_related('category')[:8]
         context['featured_products'] = featured_products
+        context['featured_product_cards'] = render_cards(featured_products, 'components/featured_product_card.html')
         
         # Get categories
         categories = Category.objects.filter(
@@ -46,3 +51,11 @@ def custom_404(request, exception):
 def custom_500(request):
     """Custom 500 error handler"""
     return render(request, 'errors/500.html', status=500)
+
+
+def serve_media(request, path, document_root=None):
+    """Development media server that lets browsers cache blobs for good"""
+    response = serve(request, path, document_root=document_root)
+    if is_blob(path):
+        response['Cache-Control'] = settings.MEDIA_BLOB_CACHE_CONTROL
+    return response
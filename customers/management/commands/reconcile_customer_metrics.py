@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from customers.metrics import reconcile
+
+
+class Command(BaseCommand):
+    help = "Recompute customers' total_orders and total_spent from their orders, payments and refunds"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Customers recomputed per transaction')
+        parser.add_argument('--start-after', type=int, default=0, metavar='CUSTOMER_ID',
+                            help='Resume after this customer id')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the customers that are off')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        last_id, corrected = options['start_after'], 0
+        while True:
+            next_id, stale = reconcile(last_id, options['chunk_size'], options['dry_run'])
+            if next_id is None:
+                break
+            corrected += stale
+            last_id = next_id
+            if options['verbosity'] > 1:
+                self.stdout.write(f'Up to customer {last_id}: {corrected} corrected')
+        elapsed = time.monotonic() - started
+
+        verb = 'would be corrected' if options['dry_run'] else 'corrected'
+        self.stdout.write(self.style.SUCCESS(f'Checked customers up to id {last_id}; {corrected} {verb} in {elapsed:.1f}s'))
@@ -0,0 +1,110 @@
+"""
+Maintained customer analytics: ``Customer.total_orders`` and ``total_spent``.
+
+``total_orders`` counts every order a customer has placed. ``total_spent`` is
+what they have paid: their captured payments less their completed refunds.
+
+Both are kept up to date with deltas rather than recounted. The code that
+moves an order, payment or refund into a state that counts calls
+``add_orders`` or ``add_spend`` in the same transaction. The delta is an
+``F()`` update of the customer row, so concurrent deltas never overwrite each
+other. Callers only apply a delta when their own conditional update changed a
+row. A redelivered webhook or a retried task therefore counts nothing twice.
+
+Anything that bypasses these paths, such as admin edits or raw SQL, lets the
+counters drift. ``reconcile`` recomputes them from the orders, payments and
+refunds tables; ``manage.py reconcile_customer_metrics`` runs it over all
+customers in chunks.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+
+from orders.models import Order
+from payments.models import Payment, Refund
+from .models import Customer
+
+
+ZERO = Decimal('0.00')
+
+# Payment statuses of money that was taken, including what was later refunded
+CAPTURED = ['completed', 'partially_refunded', 'refunded']
+
+
+def _order_customer(order_id):
+    return Customer.objects.filter(orders=order_id)
+
+
+def add_orders(customer_id, count=1):
+    if customer_id:
+        Customer.objects.filter(pk=customer_id).update(total_orders=F('total_orders') + count)
+
+
+def add_spend(order_id, amount):
+    """Add ``amount`` (negative for a refund) to the spend of the order's customer"""
+    _order_customer(order_id).update(total_spent=F('total_spent') + amount)
+
+
+def add_spends(amounts):
+    """``add_spend`` for many orders: ``amounts`` is a list of ``(order_id, amount)``"""
+    by_order = defaultdict(Decimal)
+    for order_id, amount in amounts:
+        by_order[order_id] += amount
+    by_customer = defaultdict(Decimal)
+    for order_id, customer_id in Order.objects.filter(pk__in=by_order, customer__isnull=False).values_list(
+        'pk', 'customer_id'
+    ):
+        by_customer[customer_id] += by_order[order_id]
+    # In id order, so concurrent callers lock customer rows in the same order
+    for customer_id in sorted(by_customer):
+        Customer.objects.filter(pk=customer_id).update(total_spent=F('total_spent') + by_customer[customer_id])
+
+
+def compute(customer_ids):
+    """``{customer_id: (total_orders, total_spent)}`` counted from scratch"""
+    orders = dict(
+        Order.objects.filter(customer__in=customer_ids).order_by()
+        .values_list('customer_id').annotate(n=Count('id'))
+    )
+    paid = dict(
+        Payment.objects.filter(order__customer__in=customer_ids, status__in=CAPTURED, transaction_type='payment')
+        .order_by().values_list('order__customer_id').annotate(total=Sum('amount'))
+    )
+    refunded = dict(
+        Refund.objects.filter(order__customer__in=customer_ids, status='completed')
+        .order_by().values_list('order__customer_id').annotate(total=Sum('amount'))
+    )
+    return {
+        customer_id: (orders.get(customer_id, 0), (paid.get(customer_id) or ZERO) - (refunded.get(customer_id) or ZERO))
+        for customer_id in customer_ids
+    }
+
+
+def reconcile(after=0, chunk_size=1000, dry_run=False):
+    """
+    Recompute one chunk of customers with ids above ``after``
+
+    Returns ``(last_id, corrected)``. ``last_id`` is None once there are no
+    customers left. The chunk's customer rows are locked before they are
+    counted. A delta committed first is therefore included in the count, and
+    one committed later is added on top of it.
+    """
+    with transaction.atomic():
+        customers = list(
+            Customer.objects.filter(pk__gt=after).order_by('pk').select_for_update()
+            .only('pk', 'total_orders', 'total_spent')[:chunk_size]
+        )
+        if not customers:
+            return None, 0
+        actual = compute([customer.pk for customer in customers])
+        stale = []
+        for customer in customers:
+            total_orders, total_spent = actual[customer.pk]
+            if (customer.total_orders, customer.total_spent) != (total_orders, total_spent):
+                customer.total_orders, customer.total_spent = total_orders, total_spent
+                stale.append(customer)
+        if stale and not dry_run:
+            Customer.objects.bulk_update(stale, ['total_orders', 'total_spent'])
+    return customers[-1].pk, len(stale)
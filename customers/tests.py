@@ -1,3 +1,98 @@
+import re
+from decimal import Decimal
+from html import unescape
+
+from django.contrib.auth import get_user_model
 from django.test import TestCase
+from django.urls import reverse
+
+from cart.models import Cart
+from orders.checkout import place_order
+from orders.models import Order
+from payments.models import Payment, Refund
+from products.models import Product
+from . import metrics
+
+
+class OrderHistoryViewTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='buyer', email='b@example.com', password='x')
+        for _ in range(12):
+            Order.objects.create(customer=self.user, customer_email='b@example.com', total_amount=Decimal('10.00'))
+        self.client.force_login(self.user)
+
+    def link(self, response, label):
+        match = re.search(rf'href="(\?[^"]*)" class="btn btn-outline">{label}<', response.content.decode())
+        return match and unescape(match.group(1))
+
+    def test_cursor_links_walk_the_history(self):
+        url = reverse('customers:orders')
+        first = self.client.get(url, {'cursor': ''})
+        self.assertEqual(len(first.context['orders']), 10)
+        self.assertIsNone(self.link(first, 'Previous'))
+
+        second = self.client.get(url + self.link(first, 'Next'))
+        self.assertEqual(len(second.context['orders']), 2)
+        self.assertIsNone(self.link(second, 'Next'))
+        seen = {order.pk for order in first.context['orders']} | {order.pk for order in second.context['orders']}
+        self.assertEqual(len(seen), 12)
+
+        back = self.client.get(url + self.link(second, 'Previous'))
+        self.assertEqual(list(back.context['orders']), list(first.context['orders']))
+
+    def test_page_numbers_without_a_cursor(self):
+        response = self.client.get(reverse('customers:orders'), {'status': 'pending'})
+        self.assertEqual(len(response.context['orders']), 10)
+        self.assertEqual(self.link(response, 'Next'), '?status=pending&page=2')
+
+
+class CustomerMetricsTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.first = User.objects.create_user(username='first', email='f@example.com', password='x')
+        self.second = User.objects.create_user(username='second', email='s@example.com', password='x')
+        self.orders = [
+            Order.objects.create(customer=customer, customer_email='c@example.com', total_amount=Decimal('20.00'))
+            for customer in (self.first, self.first, self.second, None)
+        ]
+
+    def totals(self, customer):
+        customer.refresh_from_db()
+        return customer.total_orders, customer.total_spent
+
+    def test_checkout_counts_the_order(self):
+        product = Product.objects.create(
+            name='Mug', slug='mug', description='', price=Decimal('8.00'), status='active', stock_quantity=1
+        )
+        cart = Cart.objects.create(customer=self.first)
+        cart.add_item(product)
+        place_order(cart, email='f@example.com', customer=self.first)
+        self.assertEqual(self.totals(self.first), (1, Decimal('0.00')))
+
+    def test_spends_add_up_per_customer(self):
+        first, second, third, guest = self.orders
+        metrics.add_spends([
+            (first.pk, Decimal('20.00')), (second.pk, Decimal('15.00')), (third.pk, Decimal('5.00')),
+            (guest.pk, Decimal('9.00')), (first.pk, Decimal('-2.50')),
+        ])
+        self.assertEqual(self.totals(self.first), (0, Decimal('32.50')))
+        self.assertEqual(self.totals(self.second), (0, Decimal('5.00')))
+
+    def test_reconcile_corrects_drift_in_chunks(self):
+        payment = Payment.objects.create(
+            transaction_id='txn-1', order=self.orders[0], amount=Decimal('20.00'), status='completed'
+        )
+        Refund.objects.create(
+            original_payment=payment, order=self.orders[0], amount=Decimal('5.00'), reason='', status='completed'
+        )
+        get_user_model().objects.filter(pk=self.second.pk).update(total_orders=1)
+
+        self.assertEqual(metrics.reconcile(chunk_size=1, dry_run=True), (self.first.pk, 1))
+        self.assertEqual(self.totals(self.first), (0, Decimal('0.00')))
 
-# Create your tests here.
+        last, corrected = metrics.reconcile(chunk_size=1)
+        self.assertEqual((last, corrected), (self.first.pk, 1))
+        self.assertEqual(metrics.reconcile(after=last, chunk_size=1), (self.second.pk, 0))
+        self.assertEqual(metrics.reconcile(after=self.second.pk), (None, 0))
+        self.assertEqual(self.totals(self.first), (2, Decimal('15.00')))
+        self.assertEqual(self.totals(self.second), (1, Decimal('0.00')))
@@ -11,6 +11,7 @@ from django.core.paginator import Paginator
 from django.db.models import Q
 import json
 
+from core.pagination import CursorPaginationMixin
 from .models import Customer, Address
 from .forms import CustomerRegistrationForm, CustomerLoginForm, CustomerEditForm, AddressForm
 from orders.models import Order
@@ -78,9 +79,9 @@ class AccountView(LoginRequiredMixin, TemplateView):
         
         # Recent orders
         try:
-            recent_orders = Order.objects.filter(customer=self.request.user).order_by('-created_at')[:5]
+            recent_orders = Order.objects.filter(customer=self.request.user).order_by('-created_at', '-id')[:5]
             context['recent_orders'] = recent_orders
-            context['total_orders'] = Order.objects.filter(customer=self.request.user).count()
+            context['total_orders'] = self.request.user.total_orders
         except:
             context['recent_orders'] = []
             context['total_orders'] = 0
@@ -110,14 +111,14 @@ class EditAccountView(LoginRequiredMixin, View):
         return render(request, self.template_name, {'form': form})
 
 
-class OrderHistoryView(LoginRequiredMixin, ListView):
+class OrderHistoryView(LoginRequiredMixin, CursorPaginationMixin, ListView):
     template_name = 'customers/orders.html'
     context_object_name = 'orders'
     paginate_by = 10
     
     def get_queryset(self):
         try:
-            queryset = Order.objects.filter(customer=self.request.user).order_by('-created_at')
+            queryset = Order.objects.filter(customer=self.request.user).order_by('-created_at', '-id')
             
             # Search functionality
             search = self.request.GET.get('search')
@@ -134,7 +135,12 @@ class OrderHistoryView(LoginRequiredMixin, ListView):
             
             return queryset
         except:
-            return Order.objects.none()
+            return Order.objects.none().order_by('-created_at', '-id')
+    
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['status_choices'] = Order.STATUS_CHOICES
+        return context
 
 
 class OrderDetailView(LoginRequiredMixin, DetailView):
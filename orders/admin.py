@@ -1,3 +1,16 @@
 from django.contrib import admin
+from .models import ShippingRate, TaxRate
 
-# Register your models here.
+
+@admin.register(ShippingRate)
+class ShippingRateAdmin(admin.ModelAdmin):
+    list_display = ['country', 'region', 'base_cost', 'cost_per_kg', 'free_over', 'is_active']
+    list_filter = ['is_active', 'country']
+    search_fields = ['country', 'region']
+
+
+@admin.register(TaxRate)
+class TaxRateAdmin(admin.ModelAdmin):
+    list_display = ['country', 'region', 'rate', 'is_active']
+    list_filter = ['is_active', 'country']
+    search_fields = ['country', 'region']
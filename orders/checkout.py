@@ -0,0 +1,124 @@
+"""
+Checkout: turn a cart into an order.
+
+``place_order`` runs as one transaction that starts by locking the cart row,
+so concurrent checkouts of one cart run one after the other and only the
+first places an order. Its query count does not depend on how many lines the
+cart has. Items, coupon links and stock changes are all
+written in bulk.
+
+Shipping and tax are priced by ``orders.pricing`` for the shipping address.
+"""
+from decimal import Decimal
+
+from django.db import transaction
+
+from customers.metrics import add_orders
+from products.counters import record_sale
+from products.inventory import InsufficientStock, claim_reserved_stock, reserve_stock
+from .coupons import CouponError, evaluate, redeem
+from .models import Order, OrderCoupon, OrderItem, OrderStatusHistory
+from .pricing import quote
+
+
+class CheckoutError(Exception):
+    """
+    Raised when a cart cannot be turned into an order
+    """
+
+
+def stock_lines(items):
+    """Cart items as the ``(product, variant, quantity)`` lines used by products.inventory"""
+    return [(item.product, item.variant, item.quantity) for item in items]
+
+
+def hold_stock(cart):
+    """
+    Hold the cart's stock while the customer fills in the checkout form
+
+    Calling it again refreshes the hold. Raises ``CheckoutError`` if something
+    in the cart has sold out.
+    """
+    items = [item for item in cart.get_items() if item.product.status == 'active']
+    try:
+        reserve_stock(f'cart:{cart.pk}', stock_lines(items))
+    except InsufficientStock as e:
+        raise CheckoutError(str(e))
+
+
+def place_order(cart, email, customer=None, phone='', shipping_address=None, billing_address=None,
+                coupon_codes=(), destination=None, notes=''):
+    """
+    Create an order from ``cart`` and empty the cart
+
+    Shipping and tax are quoted to ``shipping_address``, or to ``destination``
+    when no address is saved, as for guests. Stock held by ``hold_stock`` is
+    used up. Raises ``CheckoutError`` if the cart is empty, a coupon is
+    unusable or stock ran out. Nothing is written in that case.
+    """
+    with transaction.atomic():
+        # A double submit or a second tab waits here, then finds the cart emptied
+        cart.lock()
+        items = [item for item in cart.get_items() if item.product.status == 'active']
+        if not items:
+            raise CheckoutError('Your cart is empty.')
+
+        subtotal = sum((item.total_price for item in items), Decimal('0.00'))
+        try:
+            coupons = evaluate(coupon_codes, subtotal)
+        except CouponError as e:
+            raise CheckoutError(str(e))
+        discount_amount = sum((discount for coupon, discount in coupons), Decimal('0.00'))
+        pricing = quote(items, shipping_address or destination, discount_amount)
+
+        try:
+            claim_reserved_stock(f'cart:{cart.pk}', stock_lines(items))
+            redeem([coupon for coupon, discount in coupons], customer)
+        except (InsufficientStock, CouponError) as e:
+            raise CheckoutError(str(e))
+
+        order = Order.objects.create(
+            customer=customer,
+            customer_email=email,
+            customer_phone=phone,
+            billing_address=billing_address,
+            shipping_address=shipping_address,
+            subtotal=subtotal,
+            discount_amount=discount_amount,
+            shipping_cost=pricing.shipping_cost,
+            tax_amount=pricing.tax_amount,
+            total_amount=pricing.total,
+            notes=notes,
+        )
+        # bulk_create skips OrderItem.save(), so total_price is set here
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                product=item.product,
+                variant=item.variant,
+                product_name=item.product.name,
+                variant_name=item.variant.name if item.variant else '',
+                product_sku=(item.variant.sku if item.variant and item.variant.sku else item.product.sku) or '',
+                unit_price=item.unit_price,
+                quantity=item.quantity,
+                total_price=item.total_price,
+            )
+            for item in items
+        ])
+        if coupons:
+            OrderCoupon.objects.bulk_create([
+                OrderCoupon(order=order, coupon_id=coupon.pk, discount_amount=discount)
+                for coupon, discount in coupons
+            ])
+        OrderStatusHistory.objects.create(
+            order=order, new_status=order.status, notes='Order placed', changed_by=customer
+        )
+        add_orders(order.customer_id)
+        cart.clear()
+
+        def count_sales():
+            for item in items:
+                record_sale(item.product_id, item.quantity)
+        transaction.on_commit(count_sales)
+
+    return order
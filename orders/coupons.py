@@ -0,0 +1,168 @@
+"""
+Coupon engine.
+
+Active coupons are compiled into plain rules and held by ``coupon_index``, a
+per-process index keyed by code that follows coupon saves and deletes through
+``core.local_index``. Checking and pricing a stack of coupons therefore needs
+no queries.
+
+Usage limits are enforced when the order is written, with atomic counters:
+``Coupon.usage_count`` for the global limit, and one ``CouponRedemption`` row
+per coupon and customer for the per-customer limit. Each counter is bumped
+with a conditional UPDATE that only succeeds while it is below its limit.
+The ``usage_count`` held in the index is only a snapshot, used to turn away
+coupons that were used up when it was loaded.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from core.local_index import ProcessLocalIndex
+from .models import Coupon, CouponRedemption
+
+
+CENTS = Decimal('0.01')
+
+
+class CouponError(Exception):
+    """
+    Raised when a coupon cannot be applied
+    """
+
+
+class CompiledCoupon:
+    """
+    The parts of a ``Coupon`` needed to check and price it
+    """
+    __slots__ = (
+        'pk', 'code', 'percentage', 'value', 'minimum', 'maximum', 'valid_from', 'valid_until',
+        'usage_limit', 'usage_count', 'per_customer',
+    )
+
+    def __init__(self, coupon):
+        self.pk = coupon.pk
+        self.code = coupon.code
+        self.percentage = coupon.discount_type == 'percentage'
+        self.value = coupon.discount_value / 100 if self.percentage else coupon.discount_value
+        self.minimum = coupon.minimum_amount
+        self.maximum = coupon.maximum_discount
+        self.valid_from = coupon.valid_from
+        self.valid_until = coupon.valid_until
+        self.usage_limit = coupon.usage_limit
+        self.usage_count = coupon.usage_count
+        self.per_customer = coupon.usage_limit_per_customer
+
+    def is_live(self, now):
+        return (
+            self.valid_from <= now
+            and (self.valid_until is None or self.valid_until >= now)
+            and not (self.usage_limit and self.usage_count >= self.usage_limit)
+        )
+
+    def discount(self, amount):
+        """Discount on ``amount``, rounded to cents, the same as ``Coupon.calculate_discount``"""
+        if amount < self.minimum:
+            return Decimal('0.00')
+        discount = amount * self.value if self.percentage else self.value
+        if self.maximum:
+            discount = min(discount, self.maximum)
+        return min(discount, amount).quantize(CENTS, ROUND_HALF_UP)
+
+
+class CouponIndex(ProcessLocalIndex):
+    """
+    Compiled active coupons by code
+    """
+    name = 'coupons'
+
+    def __init__(self):
+        super().__init__()
+        self.by_code = {}
+        self.codes = {}
+
+    def _live(self):
+        return Coupon.objects.filter(is_active=True).filter(
+            Q(valid_until__isnull=True) | Q(valid_until__gte=timezone.now())
+        )
+
+    def build(self):
+        compiled = [CompiledCoupon(coupon) for coupon in self._live().iterator()]
+        self.by_code = {coupon.code: coupon for coupon in compiled}
+        self.codes = {coupon.pk: coupon.code for coupon in compiled}
+
+    def apply_changes(self, coupon_ids):
+        for coupon_id in coupon_ids:
+            self.by_code.pop(self.codes.pop(coupon_id, None), None)
+        for coupon in self._live().filter(pk__in=coupon_ids):
+            self.by_code[coupon.code] = CompiledCoupon(coupon)
+            self.codes[coupon.pk] = coupon.code
+
+    def get(self, code):
+        self.ensure_ready()
+        return self.by_code.get(code)
+
+
+coupon_index = CouponIndex()
+
+
+def evaluate(codes, subtotal, now=None):
+    """
+    Check a stack of coupon codes against a subtotal and price them
+
+    Coupons apply in the order given, each to what the previous ones left.
+    Returns ``[(compiled_coupon, discount), ...]``. Raises ``CouponError`` for
+    unknown, expired or used up codes; usage limits are checked by ``redeem``.
+    """
+    codes = list(dict.fromkeys(code.strip() for code in codes if code and code.strip()))
+    if not codes:
+        return []
+
+    now = now or timezone.now()
+    coupons = [coupon_index.get(code) for code in codes]
+    invalid = [code for code, coupon in zip(codes, coupons) if coupon is None or not coupon.is_live(now)]
+    if invalid:
+        raise CouponError(f"Invalid coupon: {', '.join(invalid)}")
+
+    applied = []
+    remaining = subtotal
+    for coupon in coupons:
+        discount = coupon.discount(remaining)
+        applied.append((coupon, discount))
+        remaining -= discount
+    return applied
+
+
+def redeem(coupons, customer=None):
+    """
+    Count one use of each coupon against its limits
+
+    Must run inside the order's transaction. Raises ``CouponError`` if a
+    global or per-customer limit has been reached.
+    """
+    if not coupons:
+        return
+    claimed = Coupon.objects.filter(
+        Q(usage_limit__isnull=True) | Q(usage_count__lt=F('usage_limit')),
+        pk__in=[coupon.pk for coupon in coupons],
+    ).update(usage_count=F('usage_count') + 1)
+    if claimed != len(coupons):
+        raise CouponError('A coupon reached its usage limit')
+
+    if customer is None:
+        return
+    for coupon in coupons:
+        if not coupon.per_customer:
+            continue
+        counted = CouponRedemption.objects.filter(
+            coupon_id=coupon.pk, customer=customer, count__lt=coupon.per_customer
+        ).update(count=F('count') + 1)
+        if counted:
+            continue
+        try:
+            # First use; the unique constraint turns away a concurrent first use
+            with transaction.atomic():
+                CouponRedemption.objects.create(coupon_id=coupon.pk, customer=customer, count=1)
+        except IntegrityError:
+            raise CouponError(f'Coupon already used: {coupon.code}')
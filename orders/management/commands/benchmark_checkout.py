@@ -0,0 +1,79 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
+
+from cart.models import Cart, CartItem
+from orders.checkout import place_order
+from orders.models import Order
+from orders.pricing import rate_table
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Measure checkout throughput and query count on synthetic carts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', type=int, default=50, help='Lines per cart')
+        parser.add_argument('--checkouts', type=int, default=200, help='Orders to place')
+        parser.add_argument('--workers', type=int, default=1, help='Concurrent checkout threads')
+        parser.add_argument('--keep', action='store_true', help='Keep the synthetic products, carts and orders')
+
+    def create_fixtures(self, run, lines, checkouts):
+        products = Product.objects.bulk_create([
+            Product(
+                name=f'Benchmark product {n}',
+                slug=f'benchmark-{run}-{n}',
+                description='Synthetic product for benchmark_checkout',
+                price=Decimal('10.00') + n,
+                stock_quantity=checkouts * 10,
+                status='active',
+            )
+            for n in range(lines)
+        ])
+        carts = Cart.objects.bulk_create([Cart(session_key=f'bench-{run}-{n}') for n in range(checkouts)])
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product, quantity=2) for cart in carts for product in products
+        ], batch_size=5000)
+        Cart.recalculate_totals(Cart.objects.filter(pk__in=[cart.pk for cart in carts]))
+        return products, list(Cart.objects.filter(pk__in=[cart.pk for cart in carts]).order_by('pk'))
+
+    def checkout(self, cart):
+        try:
+            return place_order(cart, email='benchmark@example.com')
+        finally:
+            connections.close_all()
+
+    def handle(self, *args, **options):
+        run = uuid.uuid4().hex[:8]
+        products, carts = self.create_fixtures(run, options['lines'], options['checkouts'])
+        orders = []
+        try:
+            # The first checkout runs alone so its queries can be counted
+            rate_table.warm()
+            with CaptureQueriesContext(connection) as queries:
+                orders.append(place_order(carts[0], email='benchmark@example.com'))
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+                orders.extend(pool.map(self.checkout, carts[1:]))
+            elapsed = time.perf_counter() - started
+
+            placed = len(orders) - 1
+            self.stdout.write(f"Lines per cart:    {options['lines']}")
+            self.stdout.write(f'Queries/checkout:  {len(queries)}')
+            self.stdout.write(f"Workers:           {options['workers']}")
+            self.stdout.write(f'Checkouts:         {placed} in {elapsed:.2f}s')
+            if placed:
+                self.stdout.write(
+                    f'Throughput:        {placed / elapsed:.1f} checkouts/s ({elapsed / placed * 1000:.1f} ms each)'
+                )
+        finally:
+            if not options['keep']:
+                Order.objects.filter(pk__in=[order.pk for order in orders]).delete()
+                Cart.objects.filter(pk__in=[cart.pk for cart in carts]).delete()
+                Product.objects.filter(pk__in=[product.pk for product in products]).delete()
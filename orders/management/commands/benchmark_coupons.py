@@ -0,0 +1,102 @@
+import random
+import time
+import uuid
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from customers.models import Customer
+from orders.coupons import CENTS, coupon_index, evaluate
+from orders.models import Coupon, OrderCoupon
+
+
+def per_request(codes, subtotal, customer):
+    """Coupon checks as checkout did them before the engine: loaded and counted on every request"""
+    coupons = {coupon.code: coupon for coupon in Coupon.objects.filter(code__in=codes)}
+    coupons = [coupons[code] for code in codes if code in coupons and coupons[code].is_valid]
+    limited = [coupon.pk for coupon in coupons if coupon.usage_limit_per_customer]
+    if limited:
+        dict(
+            OrderCoupon.objects.filter(coupon_id__in=limited, order__customer=customer)
+            .values_list('coupon_id').annotate(uses=Count('id'))
+        )
+    applied, remaining = [], subtotal
+    for coupon in coupons:
+        discount = coupon.calculate_discount(remaining).quantize(CENTS, ROUND_HALF_UP)
+        applied.append((coupon, discount))
+        remaining -= discount
+    return applied
+
+
+def with_engine(codes, subtotal, customer):
+    return evaluate(codes, subtotal)
+
+
+class Command(BaseCommand):
+    help = 'Measure coupon evaluation on large carts with many candidate coupons'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--coupons', type=int, default=5000, help='Active coupons to choose from')
+        parser.add_argument('--lines', type=int, default=200, help='Lines per cart')
+        parser.add_argument('--stack', type=int, default=5, help='Coupons applied to each cart')
+        parser.add_argument('--carts', type=int, default=2000, help='Carts to evaluate')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        run = uuid.uuid4().hex[:8]
+        now = timezone.now()
+        coupons = Coupon.objects.bulk_create([
+            Coupon(
+                code=f'BENCH-{run}-{n}',
+                discount_type='percentage' if n % 2 else 'fixed',
+                discount_value=Decimal(rng.randint(1, 30)),
+                minimum_amount=Decimal(rng.choice([0, 0, 25, 100])),
+                maximum_discount=Decimal(rng.choice([50, 100])) if n % 3 == 0 else None,
+                usage_limit_per_customer=rng.choice([None, None, 5]),
+                valid_from=now,
+            )
+            for n in range(options['coupons'])
+        ], batch_size=1000)
+        customer = Customer.objects.create(username=f'coupon-benchmark-{run}', email=f'{run}@example.com')
+        codes = [coupon.code for coupon in coupons]
+        carts = [
+            (
+                [(Decimal(rng.randint(100, 20000)) / 100, rng.randint(1, 4)) for _ in range(options['lines'])],
+                rng.sample(codes, options['stack']),
+            )
+            for _ in range(options['carts'])
+        ]
+
+        try:
+            coupon_index.invalidate()
+            started = time.perf_counter()
+            coupon_index.warm()
+            warm_seconds = time.perf_counter() - started
+
+            results = {}
+            for label, apply in (('Per request', per_request), ('Coupon engine', with_engine)):
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    totals = []
+                    for lines, stack in carts:
+                        subtotal = sum((price * quantity for price, quantity in lines), Decimal('0.00'))
+                        totals.append(sum((discount for coupon, discount in apply(stack, subtotal, customer)), 0))
+                    elapsed = time.perf_counter() - started
+                results[label] = totals
+                self.stdout.write(
+                    f'{label:<15}{elapsed / len(carts) * 1000:>8.3f} ms/cart  '
+                    f'{len(queries) / len(carts):>5.1f} queries/cart'
+                )
+
+            self.stdout.write(f"Index warm-up:   {warm_seconds * 1000:.0f} ms for {options['coupons']} coupons")
+            mismatched = sum(a != b for a, b in zip(results['Per request'], results['Coupon engine']))
+            self.stdout.write(f'Discount mismatches: {mismatched}')
+        finally:
+            customer.delete()
+            Coupon.objects.filter(pk__in=[coupon.pk for coupon in coupons]).delete()
+            coupon_index.invalidate()
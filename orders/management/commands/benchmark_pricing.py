@@ -0,0 +1,112 @@
+import random
+import time
+import uuid
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from cart.models import Cart, CartItem
+from customers.models import Address
+from orders.models import ShippingRate, TaxRate
+from orders.pricing import quote, quote_carts, rate_table
+from products.models import Product
+
+
+REGIONS = ['CA', 'NY', 'TX', 'WA', 'FL', 'IL', 'OR', 'NV', 'MA', 'CO']
+
+
+class Command(BaseCommand):
+    help = 'Compare quoting shipping and tax one cart at a time with quoting carts in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--carts', type=int, default=1000)
+        parser.add_argument('--lines', type=int, default=10, help='Lines per cart')
+        parser.add_argument('--batch-size', type=int, default=500, help='Carts per quote_carts call')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def create_fixtures(self, run, rng, carts, lines):
+        products = Product.objects.bulk_create([
+            Product(
+                name=f'Pricing benchmark {run} {n}',
+                slug=f'pricing-benchmark-{run}-{n}',
+                description='Synthetic product for benchmark_pricing',
+                price=Decimal(rng.randint(500, 20000)) / 100,
+                weight=Decimal(rng.randint(1, 500)) / 100,
+                length=Decimal(rng.randint(5, 60)),
+                width=Decimal(rng.randint(5, 40)),
+                height=Decimal(rng.randint(1, 30)),
+                is_digital=n % 10 == 0,
+                status='active',
+            )
+            for n in range(lines * 5)
+        ])
+        carts = Cart.objects.bulk_create([Cart(session_key=f'pricing-{run}-{n}') for n in range(carts)])
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product, quantity=rng.randint(1, 3))
+            for cart in carts for product in rng.sample(products, lines)
+        ], batch_size=5000)
+        return products, carts
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        run = uuid.uuid4().hex[:8]
+        country = f'B{run[:6]}'.upper()
+        ShippingRate.objects.bulk_create([
+            ShippingRate(country=country, region=region, base_cost=Decimal(rng.randint(3, 9)),
+                         cost_per_kg=Decimal(rng.randint(50, 250)) / 100, free_over=Decimal('500.00'))
+            for region in REGIONS
+        ])
+        TaxRate.objects.bulk_create([
+            TaxRate(country=country, region=region, rate=Decimal(rng.randint(0, 1000)) / 10000)
+            for region in REGIONS
+        ])
+        products, carts = self.create_fixtures(run, rng, options['carts'], options['lines'])
+        destinations = {cart.pk: Address(country=country, state=rng.choice(REGIONS)) for cart in carts}
+
+        try:
+            rate_table.invalidate()
+            started = time.perf_counter()
+            rate_table.warm()
+            self.stdout.write(f'Rate table load:  {(time.perf_counter() - started) * 1000:.1f} ms')
+
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                one_by_one = {
+                    cart.pk: quote(
+                        [item for item in cart.get_items() if item.product.status == 'active'],
+                        destinations[cart.pk],
+                    )
+                    for cart in carts
+                }
+                elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f'One at a time:    {len(carts) / elapsed:>8.0f} carts/s  {len(queries)} queries'
+            )
+
+            size = options['batch_size']
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                batched = {}
+                for start in range(0, len(carts), size):
+                    chunk = carts[start:start + size]
+                    batched.update(quote_carts(chunk, {cart.pk: destinations[cart.pk] for cart in chunk}))
+                elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f'Batches of {size:<6}{len(carts) / elapsed:>8.0f} carts/s  {len(queries)} queries'
+            )
+
+            mismatched = sum(
+                (a.shipping_cost, a.tax_amount) != (b.shipping_cost, b.tax_amount)
+                for a, b in ((one_by_one[pk], batched[pk]) for pk in one_by_one)
+            )
+            if mismatched:
+                raise CommandError(f'{mismatched} quotes differ between the two paths')
+            self.stdout.write('Quote mismatches: 0')
+        finally:
+            Cart.objects.filter(pk__in=[cart.pk for cart in carts]).delete()
+            Product.objects.filter(pk__in=[product.pk for product in products]).delete()
+            ShippingRate.objects.filter(country=country).delete()
+            TaxRate.objects.filter(country=country).delete()
+            rate_table.invalidate()
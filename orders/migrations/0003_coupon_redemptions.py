@@ -0,0 +1,47 @@
+# Generated by Django 5.0.14 on 2026-10-17 02:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_redemptions(apps, schema_editor):
+    OrderCoupon = apps.get_model('orders', 'OrderCoupon')
+    CouponRedemption = apps.get_model('orders', 'CouponRedemption')
+    uses = (
+        OrderCoupon.objects.filter(order__customer__isnull=False)
+        .values_list('coupon_id', 'order__customer_id')
+        .annotate(uses=Count('id'))
+        .order_by()
+    )
+    CouponRedemption.objects.bulk_create(
+        [CouponRedemption(coupon_id=coupon_id, customer_id=customer_id, count=count)
+         for coupon_id, customer_id, count in uses.iterator()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0002_pagination_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CouponRedemption',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='redemptions', to='orders.coupon')),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='coupon_redemptions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'orders_coupon_redemption',
+                'unique_together': {('coupon', 'customer')},
+            },
+        ),
+        migrations.RunPython(count_redemptions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.0.14 on 2026-10-17 02:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0003_coupon_redemptions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShippingRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('country', models.CharField(help_text='As written in addresses, e.g. US', max_length=100)),
+                ('region', models.CharField(blank=True, help_text='State or region; leave empty for the whole country', max_length=100)),
+                ('base_cost', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('cost_per_kg', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('free_over', models.DecimalField(blank=True, decimal_places=2, help_text='Ship free when the subtotal after discounts reaches this amount', max_digits=10, null=True)),
+                ('is_active', models.BooleanField(default=True)),
+            ],
+            options={
+                'db_table': 'orders_shipping_rate',
+                'unique_together': {('country', 'region')},
+            },
+        ),
+        migrations.CreateModel(
+            name='TaxRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('country', models.CharField(help_text='As written in addresses, e.g. US', max_length=100)),
+                ('region', models.CharField(blank=True, help_text='State or region; leave empty for the whole country', max_length=100)),
+                ('rate', models.DecimalField(decimal_places=4, help_text='0.0825 for 8.25%', max_digits=6)),
+                ('is_active', models.BooleanField(default=True)),
+            ],
+            options={
+                'db_table': 'orders_tax_rate',
+                'unique_together': {('country', 'region')},
+            },
+        ),
+    ]
@@ -2,6 +2,7 @@ from django.db import models
 from django.core.validators import MinValueValidator
 from decimal import Decimal
 import uuid
+from core.ids import new_id
 from core.models import TimeStampedModel
 from customers.models import Customer, Address
 from products.models import Product, ProductVariant
@@ -76,8 +77,7 @@ class Order(TimeStampedModel):
         super().save(*args, **kwargs)
     
     def generate_order_number(self):
-        import random, string
-        return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+        return new_id()
     
     @property
     def is_paid(self):
@@ -90,6 +90,10 @@ class Order(TimeStampedModel):
     class Meta:
         db_table = 'orders_order'
         ordering = ['-created_at']
+        indexes = [
+            # Keyset pagination of a customer's order history
+            models.Index(fields=['customer', 'created_at', 'id'], name='orders_customer_created_idx'),
+        ]
 
 
 class OrderItem(TimeStampedModel):
@@ -218,3 +222,60 @@ class OrderCoupon(models.Model):
     class Meta:
         db_table = 'orders_order_coupon'
         unique_together = ['order', 'coupon']
+
+
+class CouponRedemption(models.Model):
+    """
+    How many times a customer has used a coupon
+    """
+    coupon = models.ForeignKey(Coupon, related_name='redemptions', on_delete=models.CASCADE)
+    customer = models.ForeignKey(Customer, related_name='coupon_redemptions', on_delete=models.CASCADE)
+    count = models.PositiveIntegerField(default=0)
+    
+    def __str__(self):
+        return f"{self.coupon.code} used {self.count} time(s) by {self.customer}"
+    
+    class Meta:
+        db_table = 'orders_coupon_redemption'
+        unique_together = ['coupon', 'customer']
+
+
+class ShippingRate(TimeStampedModel):
+    """
+    Shipping charge for a destination country or region
+    """
+    country = models.CharField(max_length=100, help_text="As written in addresses, e.g. US")
+    region = models.CharField(max_length=100, blank=True, help_text="State or region; leave empty for the whole country")
+    
+    base_cost = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    cost_per_kg = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    free_over = models.DecimalField(
+        max_digits=10, decimal_places=2, null=True, blank=True,
+        help_text="Ship free when the subtotal after discounts reaches this amount"
+    )
+    is_active = models.BooleanField(default=True)
+    
+    def __str__(self):
+        return f"Shipping to {self.region or 'all of'} {self.country}"
+    
+    class Meta:
+        db_table = 'orders_shipping_rate'
+        unique_together = ['country', 'region']
+
+
+class TaxRate(TimeStampedModel):
+    """
+    Sales tax rate for a destination country or region
+    """
+    country = models.CharField(max_length=100, help_text="As written in addresses, e.g. US")
+    region = models.CharField(max_length=100, blank=True, help_text="State or region; leave empty for the whole country")
+    
+    rate = models.DecimalField(max_digits=6, decimal_places=4, help_text="0.0825 for 8.25%")
+    is_active = models.BooleanField(default=True)
+    
+    def __str__(self):
+        return f"Tax in {self.region or 'all of'} {self.country}: {self.rate}"
+    
+    class Meta:
+        db_table = 'orders_tax_rate'
+        unique_together = ['country', 'region']
@@ -0,0 +1,179 @@
+"""
+Shipping and tax quotes.
+
+``rate_table`` keeps the active ShippingRate and TaxRate rows in memory, in a
+per-process copy that follows edits through ``core.local_index``. Quoting a
+cart therefore needs no queries beyond loading its items. ``quote_carts``
+quotes any number of carts with two queries in total.
+
+Shipping is charged on billable weight: for each line that ships, the greater
+of its actual weight and its dimensional weight (length x width x height /
+SHIPPING_DIM_DIVISOR), times its quantity. Digital products and products that
+do not require shipping add nothing, and a cart with nothing to ship is not
+charged for shipping. Tax applies to the subtotal after discounts.
+
+Rates are looked up for the destination's country and region, then for the
+whole country, then fall back to DEFAULT_SHIPPING_COST and DEFAULT_TAX_RATE.
+"""
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.conf import settings
+
+from cart.models import CartItem
+from core.local_index import ProcessLocalIndex
+from customers.models import Address
+from .models import ShippingRate, TaxRate
+
+
+CENTS = Decimal('0.01')
+ZERO = Decimal('0.00')
+
+
+def destination_key(address=None):
+    """The ``(country, region)`` an address is charged for"""
+    if address is None:
+        return settings.DEFAULT_SHIPPING_COUNTRY.strip().upper(), ''
+    return (
+        (address.country or settings.DEFAULT_SHIPPING_COUNTRY).strip().upper(),
+        (address.state or '').strip().upper(),
+    )
+
+
+def rate_key(rate):
+    return rate.country.strip().upper(), rate.region.strip().upper()
+
+
+class RateTable(ProcessLocalIndex):
+    """
+    Active shipping and tax rates by ``(country, region)``
+    """
+    name = 'pricing_rates'
+
+    def __init__(self):
+        super().__init__()
+        self.shipping = {}
+        self.tax = {}
+
+    def build(self):
+        self.shipping = {
+            rate_key(rate): (rate.base_cost, rate.cost_per_kg, rate.free_over)
+            for rate in ShippingRate.objects.filter(is_active=True)
+        }
+        self.tax = {
+            rate_key(rate): rate.rate
+            for rate in TaxRate.objects.filter(is_active=True)
+        }
+
+    def apply_changes(self, keys):
+        # A few hundred rows at most, so any change reloads both tables
+        self.build()
+
+    def _find(self, name, country, region):
+        self.ensure_ready()
+        table = getattr(self, name)
+        found = table.get((country, region))
+        if found is None and region:
+            found = table.get((country, ''))
+        return found
+
+    def shipping_rate(self, country, region=''):
+        """``(base_cost, cost_per_kg, free_over)`` for a destination"""
+        return self._find('shipping', country, region) or (settings.DEFAULT_SHIPPING_COST, ZERO, None)
+
+    def tax_rate(self, country, region=''):
+        found = self._find('tax', country, region)
+        return settings.DEFAULT_TAX_RATE if found is None else found
+
+
+rate_table = RateTable()
+
+
+def billable_weight(product, variant=None):
+    """
+    Weight in kg charged for one unit, or ``None`` if it does not ship
+    """
+    if product.is_digital or not product.requires_shipping:
+        return None
+    weight = variant.weight if variant is not None and variant.weight is not None else product.weight
+    weight = weight or ZERO
+    if product.length and product.width and product.height:
+        weight = max(weight, product.length * product.width * product.height / settings.SHIPPING_DIM_DIVISOR)
+    return weight
+
+
+class Quote:
+    """
+    Shipping and tax for one cart
+    """
+    __slots__ = ('subtotal', 'discount', 'weight', 'shipping_cost', 'tax_rate', 'tax_amount')
+
+    def __init__(self, subtotal, discount, weight, shipping_cost, tax_rate, tax_amount):
+        self.subtotal = subtotal
+        self.discount = discount
+        self.weight = weight
+        self.shipping_cost = shipping_cost
+        self.tax_rate = tax_rate
+        self.tax_amount = tax_amount
+
+    @property
+    def total(self):
+        return self.subtotal - self.discount + self.shipping_cost + self.tax_amount
+
+
+def quote(items, destination=None, discount=ZERO):
+    """
+    Price shipping and tax for cart items shipped to ``destination``
+
+    ``items`` need ``product``, ``variant``, ``quantity`` and ``total_price``,
+    as cart and order items have. ``destination`` is an ``Address``, saved or
+    not; without one the default country is quoted.
+    """
+    country, region = destination_key(destination)
+    subtotal = sum((item.total_price for item in items), ZERO)
+    weight, ships = ZERO, False
+    for item in items:
+        unit = billable_weight(item.product, item.variant)
+        if unit is not None:
+            ships = True
+            weight += unit * item.quantity
+
+    goods = subtotal - discount
+    shipping_cost = ZERO
+    if ships:
+        base_cost, cost_per_kg, free_over = rate_table.shipping_rate(country, region)
+        if free_over is None or goods < free_over:
+            shipping_cost = (base_cost + cost_per_kg * weight).quantize(CENTS, ROUND_HALF_UP)
+    tax_rate = rate_table.tax_rate(country, region)
+    tax_amount = (goods * tax_rate).quantize(CENTS, ROUND_HALF_UP)
+    return Quote(subtotal, discount, weight, shipping_cost, tax_rate, tax_amount)
+
+
+def quote_carts(carts, destinations=None):
+    """
+    Quote many carts at once; returns ``{cart.pk: Quote}``
+
+    ``destinations`` maps cart pks to addresses. Other carts are quoted to
+    their customer's default shipping address, or to the default country.
+    Uses two queries however many carts there are.
+    """
+    carts = list(carts)
+    destinations = dict(destinations or {})
+
+    items = defaultdict(list)
+    for item in CartItem.objects.filter(cart__in=carts, product__status='active').select_related('product', 'variant'):
+        items[item.cart_id].append(item)
+
+    unaddressed = {cart.customer_id: cart.pk for cart in carts if cart.pk not in destinations and cart.customer_id}
+    if unaddressed:
+        for address in Address.objects.filter(customer_id__in=unaddressed, type='shipping', is_default=True):
+            destinations[unaddressed[address.customer_id]] = address
+
+    return {cart.pk: quote(items[cart.pk], destinations.get(cart.pk)) for cart in carts}
+
+
+def default_destination(customer):
+    """A signed-in customer's default shipping address, if they have one"""
+    if customer is None or not customer.is_authenticated:
+        return None
+    return Address.objects.filter(customer=customer, type='shipping', is_default=True).first()
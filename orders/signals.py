@@ -0,0 +1,26 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .coupons import coupon_index
+from .models import Coupon, ShippingRate, TaxRate
+from .pricing import rate_table
+
+
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Coupon)
+def refresh_coupon(sender, instance, raw=False, **kwargs):
+    """Recompile the coupon in every worker's coupon index"""
+    if raw:
+        return
+    coupon_index.record_change(instance.pk)
+
+
+@receiver(post_save, sender=ShippingRate)
+@receiver(post_save, sender=TaxRate)
+@receiver(post_delete, sender=ShippingRate)
+@receiver(post_delete, sender=TaxRate)
+def refresh_rates(sender, instance, raw=False, **kwargs):
+    """Reload the rate table in every worker"""
+    if raw:
+        return
+    rate_table.record_change(f'{sender._meta.model_name}:{instance.pk}')
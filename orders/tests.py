@@ -1,3 +1,136 @@
+import json
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError, transaction
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from cart.models import Cart
+from products.models import Product
+from .checkout import CheckoutError, place_order
+from .coupons import CompiledCoupon, CouponError, evaluate, redeem
+from .models import Coupon, CouponRedemption, Order
+
+
+class PlaceOrderTests(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(
+            name='Kettle', slug='kettle', description='', price=Decimal('30.00'), status='active',
+            stock_quantity=5, track_inventory=True,
+        )
+        self.cart = Cart.objects.create()
+        self.cart.add_item(self.product, quantity=2)
+
+    def test_places_order_and_empties_cart(self):
+        order = place_order(self.cart, email='k@example.com')
+
+        self.assertEqual(order.subtotal, Decimal('60.00'))
+        self.assertEqual(list(order.items.values_list('product_id', 'quantity')), [(self.product.pk, 2)])
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock_quantity, 3)
+        self.assertTrue(Cart.objects.get(pk=self.cart.pk).is_empty)
+
+    def test_second_checkout_of_the_same_cart_fails(self):
+        # The other tab still holds the cart with its items
+        stale = Cart.objects.get(pk=self.cart.pk)
+        place_order(self.cart, email='k@example.com')
+        with self.assertRaisesMessage(CheckoutError, 'Your cart is empty.'):
+            place_order(stale, email='k@example.com')
+
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock_quantity, 3)
+
+    def test_short_stock_writes_nothing(self):
+        Product.objects.filter(pk=self.product.pk).update(stock_quantity=1)
+        with self.assertRaises(CheckoutError):
+            place_order(self.cart, email='k@example.com')
+
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock_quantity, 1)
+        self.assertEqual(Cart.objects.get(pk=self.cart.pk).item_count, 2)
+
+
+class CheckoutViewTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='buyer', email='b@example.com', password='x')
+        product = Product.objects.create(
+            name='Kettle', slug='kettle', description='', price=Decimal('30.00'), status='active', stock_quantity=5
+        )
+        Cart.objects.create(customer=self.user).add_item(product)
+        self.client.force_login(self.user)
+
+    def post(self, body):
+        return self.client.post(reverse('cart:checkout'), body, content_type='application/json')
+
+    def test_malformed_bodies_get_json_errors(self):
+        for body in ['{not json', '[1, 2]', '"text"']:
+            response = self.post(body)
+            self.assertEqual(response.status_code, 400, body)
+            self.assertFalse(response.json()['success'])
+
+    def test_database_errors_get_json_errors(self):
+        with mock.patch('cart.views.place_order', side_effect=DatabaseError('lock timeout')):
+            with self.assertLogs('xcommerce', 'ERROR'):
+                response = self.post(json.dumps({}))
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.json()['success'])
+
+    def test_coupon_codes(self):
+        with mock.patch('cart.views.place_order', return_value=Order(order_number='T-1')) as place:
+            self.post(json.dumps({'coupon': ' SAVE10 '}))
+        self.assertEqual(place.call_args.kwargs['coupon_codes'], ['SAVE10'])
+
+        response = self.post(json.dumps({}))
+        self.assertEqual(response.status_code, 200)
+        order = Order.objects.get(order_number=response.json()['order_number'])
+        self.assertEqual(order.customer, self.user)
+        self.assertEqual(order.discount_amount, 0)
+
+
+class CouponTests(TestCase):
+    def coupon(self, code, **fields):
+        fields.setdefault('valid_from', timezone.now() - timedelta(days=1))
+        with self.captureOnCommitCallbacks(execute=True):
+            coupon = Coupon.objects.create(code=code, discount_type='fixed', discount_value=Decimal('5.00'), **fields)
+        return CompiledCoupon(coupon)
+
+    def test_global_limit_holds_against_a_stale_snapshot(self):
+        coupon = self.coupon('ONCE', usage_limit=1)
+        redeem([coupon])
+        # The compiled coupon still says it was never used
+        with self.assertRaisesMessage(CouponError, 'usage limit'):
+            redeem([coupon])
+        self.assertEqual(Coupon.objects.get(pk=coupon.pk).usage_count, 1)
+
+    def test_failed_stack_counts_nothing_once_rolled_back(self):
+        open_coupon, used = self.coupon('OPEN'), self.coupon('USED', usage_limit=1)
+        redeem([used])
+        with self.assertRaises(CouponError):
+            with transaction.atomic():
+                redeem([open_coupon, used])
+        self.assertEqual(Coupon.objects.get(pk=open_coupon.pk).usage_count, 0)
+
+    def test_per_customer_limit(self):
+        User = get_user_model()
+        first = User.objects.create_user(username='first', email='f@example.com', password='x')
+        second = User.objects.create_user(username='second', email='s@example.com', password='x')
+        coupon = self.coupon('TWICE', usage_limit_per_customer=2)
+
+        redeem([coupon], customer=first)
+        redeem([coupon], customer=first)
+        with self.assertRaisesMessage(CouponError, 'Coupon already used: TWICE'):
+            redeem([coupon], customer=first)
+        redeem([coupon], customer=second)
+        self.assertEqual(CouponRedemption.objects.get(coupon_id=coupon.pk, customer=first).count, 2)
+        self.assertEqual(Coupon.objects.get(pk=coupon.pk).usage_count, 4)
 
-# Create your tests here.
+    def test_evaluate_stacks_in_order_and_rejects_used_up_codes(self):
+        self.coupon('FIVE')
+        self.coupon('GONE', usage_limit=1, usage_count=1)
+        applied = evaluate(['FIVE', 'FIVE'], Decimal('7.00'))
+        self.assertEqual([(coupon.code, discount) for coupon, discount in applied], [('FIVE', Decimal('5.00'))])
+        with self.assertRaisesMessage(CouponError, 'Invalid coupon: GONE'):
+            evaluate(['FIVE', 'GONE'], Decimal('7.00'))
@@ -0,0 +1,344 @@
+"""
+Payment gateway adapters.
+
+A ``PaymentMethod`` names its gateway in ``provider``; PAYMENT_GATEWAYS maps
+providers to adapter classes, which read ``base_url``, ``api_key`` and an
+optional ``timeout`` from the method's ``config``. Adapters only build
+requests and read responses. Sending is shared:
+
+- Requests go through one keep-alive pool per process (``payments.http``),
+  or through a pool per event loop on the async path.
+- Every request has a timeout, and carries an idempotency key derived from
+  the payment or refund, so a retried capture is never charged twice.
+- Each provider has a circuit breaker. After PAYMENT_GATEWAY_FAILURE_THRESHOLD
+  transport errors or 5xx responses in a row, calls fail at once with
+  ``GatewayUnavailable`` for PAYMENT_GATEWAY_RESET_TIMEOUT seconds, then one
+  trial call decides whether to close it again. A gateway that is down thus
+  costs a worker nothing instead of a full timeout per request.
+
+``capture_payment`` and ``refund_payment`` record the outcome, including the
+customer's spend (``customers.metrics``). Their async
+twins ``acapture_payment`` and ``arefund_payment`` hold no thread while the
+gateway answers, for use from ASGI views.
+"""
+import json
+import threading
+import time
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from customers.metrics import CAPTURED, add_spend
+from orders.models import Order
+from .http import AsyncHTTPPool, HTTPPool, TransportError
+from .models import Payment, Refund
+
+
+class GatewayError(Exception):
+    """
+    Raised when a gateway call gets no answer; the payment is left unchanged
+    """
+
+
+class GatewayUnavailable(GatewayError):
+    """
+    Raised without calling the gateway while its circuit breaker is open
+    """
+
+
+class CircuitBreaker:
+    """
+    Consecutive failure counter that stops calls to a failing gateway
+    """
+
+    def __init__(self, name, threshold, reset_timeout):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self._trial else 'open'
+
+    def before_call(self):
+        """Raise ``GatewayUnavailable`` unless a call may go ahead"""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Let one call through to see whether the gateway is back. If
+                # it never reports, another is let through after a further wait.
+                self._trial = True
+                self.opened_at = time.monotonic()
+                return
+        raise GatewayUnavailable(f'{self.name} is unavailable; not calling it for now')
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self._trial = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(provider):
+    with _breakers_lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(
+                provider, settings.PAYMENT_GATEWAY_FAILURE_THRESHOLD, settings.PAYMENT_GATEWAY_RESET_TIMEOUT
+            )
+        return _breakers[provider]
+
+
+@lru_cache(maxsize=None)
+def get_http_pool():
+    return HTTPPool(size=settings.PAYMENT_GATEWAY_POOL_SIZE, timeout=settings.PAYMENT_GATEWAY_TIMEOUT)
+
+
+@lru_cache(maxsize=None)
+def get_async_http_pool():
+    return AsyncHTTPPool(size=settings.PAYMENT_GATEWAY_POOL_SIZE, timeout=settings.PAYMENT_GATEWAY_TIMEOUT)
+
+
+class GatewayResult:
+    """
+    Outcome of a capture or refund the gateway answered
+    """
+    __slots__ = ('success', 'reference', 'response', 'error')
+
+    def __init__(self, success, reference='', response=None, error=''):
+        self.success = success
+        self.reference = reference
+        self.response = response or {}
+        self.error = error
+
+
+class BaseGateway:
+    """
+    Adapter for one provider's API
+
+    Subclasses implement ``capture_request``, ``refund_request`` and
+    ``read_response``; the sync and async paths share them.
+    """
+
+    def __init__(self, payment_method):
+        config = payment_method.config or {}
+        self.provider = payment_method.provider
+        self.base_url = config['base_url'].rstrip('/')
+        self.api_key = config.get('api_key', '')
+        self.timeout = config.get('timeout', settings.PAYMENT_GATEWAY_TIMEOUT)
+        self.breaker = get_breaker(self.provider)
+
+    def capture_request(self, payment):
+        """``(method, path, payload)`` capturing ``payment``"""
+        raise NotImplementedError
+
+    def refund_request(self, refund):
+        """``(method, path, payload)`` refunding ``refund``"""
+        raise NotImplementedError
+
+    def read_response(self, response):
+        """A ``GatewayResult`` from a response below 500"""
+        raise NotImplementedError
+
+    def headers(self, idempotency_key):
+        return {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {self.api_key}',
+            'Idempotency-Key': idempotency_key,
+        }
+
+    def _prepare(self, request, idempotency_key):
+        self.breaker.before_call()
+        method, path, payload = request
+        return method, self.base_url + path, json.dumps(payload).encode(), self.headers(idempotency_key)
+
+    def _finish(self, response):
+        if response.status >= 500:
+            self.breaker.record_failure()
+            raise GatewayError(f'{self.provider} answered {response.status}')
+        self.breaker.record_success()
+        return self.read_response(response)
+
+    def send(self, request, idempotency_key):
+        method, url, body, headers = self._prepare(request, idempotency_key)
+        try:
+            response = get_http_pool().request(method, url, body, headers, timeout=self.timeout)
+        except TransportError as e:
+            self.breaker.record_failure()
+            raise GatewayError(str(e)) from e
+        return self._finish(response)
+
+    async def asend(self, request, idempotency_key):
+        method, url, body, headers = self._prepare(request, idempotency_key)
+        try:
+            response = await get_async_http_pool().request(method, url, body, headers, timeout=self.timeout)
+        except TransportError as e:
+            self.breaker.record_failure()
+            raise GatewayError(str(e)) from e
+        return self._finish(response)
+
+    def capture(self, payment):
+        return self.send(self.capture_request(payment), f'capture-{payment.uuid}')
+
+    def refund(self, refund):
+        return self.send(self.refund_request(refund), f'refund-{refund.uuid}')
+
+    async def acapture(self, payment):
+        return await self.asend(self.capture_request(payment), f'capture-{payment.uuid}')
+
+    async def arefund(self, refund):
+        return await self.asend(self.refund_request(refund), f'refund-{refund.uuid}')
+
+
+class MockGateway(BaseGateway):
+    """
+    Adapter for the local gateway started by ``manage.py mock_gateway``
+    """
+
+    def capture_request(self, payment):
+        return 'POST', '/v1/captures', {
+            'amount': str(payment.amount),
+            'currency': payment.currency,
+            'reference': payment.transaction_id,
+        }
+
+    def refund_request(self, refund):
+        return 'POST', '/v1/refunds', {
+            'capture': refund.original_payment.gateway_transaction_id,
+            'amount': str(refund.amount),
+        }
+
+    def read_response(self, response):
+        try:
+            data = response.json() or {}
+        except ValueError:
+            data = {}
+        if response.status < 300 and data.get('status') == 'succeeded':
+            return GatewayResult(True, data.get('id', ''), data)
+        return GatewayResult(False, data.get('id', ''), data, data.get('error') or f'HTTP {response.status}')
+
+
+def get_gateway(payment_method):
+    """The adapter for a ``PaymentMethod``"""
+    if payment_method is None:
+        raise GatewayError('No payment method to charge through')
+    try:
+        path = settings.PAYMENT_GATEWAYS[payment_method.provider]
+    except KeyError:
+        raise GatewayError(f'No gateway adapter for provider {payment_method.provider!r}')
+    return import_string(path)(payment_method)
+
+
+def _record_capture(payment, result):
+    payment.gateway_response = result.response
+    payment.processed_at = timezone.now()
+    if result.success:
+        payment.status = 'completed'
+        payment.gateway_transaction_id = result.reference
+        payment.failure_reason = ''
+    else:
+        payment.status = 'failed'
+        payment.failure_reason = result.error
+    return ['status', 'gateway_transaction_id', 'gateway_response', 'processed_at', 'failure_reason', 'updated_at']
+
+
+def _record_refund(refund, result):
+    refund.gateway_response = result.response
+    refund.processed_at = timezone.now()
+    refund.status = 'completed' if result.success else 'failed'
+    if result.success:
+        refund.gateway_refund_id = result.reference
+    return ['status', 'gateway_refund_id', 'gateway_response', 'processed_at', 'updated_at']
+
+
+def _first_capture(payment):
+    return Payment.objects.filter(pk=payment.pk).exclude(status__in=CAPTURED)
+
+
+def _first_refund(refund):
+    return Refund.objects.filter(pk=refund.pk).exclude(status='completed')
+
+
+def _save_capture(payment, result, fields):
+    with transaction.atomic():
+        # A webhook may have recorded the capture already; count it only once
+        first = result.success and _first_capture(payment).update(status='completed')
+        payment.save(update_fields=fields)
+        if result.success:
+            Order.objects.filter(pk=payment.order_id, payment_status__in=['pending', 'failed']).update(payment_status='paid')
+        if first:
+            add_spend(payment.order_id, payment.amount)
+
+
+def _save_refund(refund, result, fields):
+    with transaction.atomic():
+        first = result.success and _first_refund(refund).update(status='completed')
+        refund.save(update_fields=fields)
+        if first:
+            add_spend(refund.order_id, -refund.amount)
+
+
+def capture_payment(payment):
+    """
+    Capture a pending payment and record the outcome
+
+    ``payment.payment_method`` must be set. Raises ``GatewayError`` if the
+    gateway did not answer, leaving the payment pending.
+    """
+    result = get_gateway(payment.payment_method).capture(payment)
+    _save_capture(payment, result, _record_capture(payment, result))
+    return result
+
+
+def refund_payment(refund):
+    """
+    Send a pending refund to the gateway of its payment and record the outcome
+    """
+    result = get_gateway(refund.original_payment.payment_method).refund(refund)
+    _save_refund(refund, result, _record_refund(refund, result))
+    return result
+
+
+async def acapture_payment(payment):
+    """
+    ``capture_payment`` for coroutines
+
+    Load the payment with ``select_related('payment_method')``; related rows
+    cannot be fetched lazily here. The outcome is recorded in one transaction,
+    on a worker thread.
+    """
+    result = await get_gateway(payment.payment_method).acapture(payment)
+    await sync_to_async(_save_capture)(payment, result, _record_capture(payment, result))
+    return result
+
+
+async def arefund_payment(refund):
+    """
+    ``refund_payment`` for coroutines
+
+    Load the refund with ``select_related('original_payment__payment_method')``.
+    """
+    result = await get_gateway(refund.original_payment.payment_method).arefund(refund)
+    await sync_to_async(_save_refund)(refund, result, _record_refund(refund, result))
+    return result
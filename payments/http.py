@@ -0,0 +1,236 @@
+"""
+Keep-alive HTTP clients for payment gateways.
+
+``HTTPPool`` keeps idle connections per host for synchronous callers.
+``AsyncHTTPPool`` does the same over asyncio streams, for ASGI views and other
+coroutines, so a request in flight holds no thread. Either way a gateway call
+reuses a warm connection, so it costs one round trip instead of a new TCP and
+TLS handshake each time.
+
+Both apply the timeout to connecting and to each read. Both retry once when a
+pooled connection turns out to have been closed by the server, which happens
+before the gateway has seen the request. Only what gateway APIs need is
+supported: HTTP/1.1 requests with a bytes body, and responses framed by
+Content-Length or chunked encoding.
+"""
+import asyncio
+import http.client
+import json
+import os
+import ssl
+import threading
+import weakref
+from urllib.parse import urlsplit
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class TransportError(Exception):
+    """
+    Raised when a request gets no usable response: refused, reset or timed out
+    """
+
+
+class Response:
+    """
+    Status, lower-cased headers and body of a response
+    """
+    __slots__ = ('status', 'headers', 'body')
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body or b'null')
+
+
+def split_url(url):
+    """``(scheme, host, port, path)`` of an http or https URL"""
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError(f'Unsupported URL: {url}')
+    path = parts.path or '/'
+    if parts.query:
+        path = f'{path}?{parts.query}'
+    return parts.scheme, parts.hostname, parts.port or DEFAULT_PORTS[parts.scheme], path
+
+
+def host_header(scheme, host, port):
+    """Value of the Host header, with the port unless it is the scheme's default"""
+    if ':' in host:
+        host = f'[{host}]'
+    return host if port == DEFAULT_PORTS[scheme] else f'{host}:{port}'
+
+
+class HTTPPool:
+    """
+    Idle ``http.client`` connections by host, shared by the threads of a process
+    """
+
+    def __init__(self, size=10, timeout=10):
+        self.size = size
+        self.timeout = timeout
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # A forked child must not share its parent's sockets
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def _checkout(self, key, timeout):
+        with self._lock:
+            idle = self._idle.get(key)
+            connection = idle.pop() if idle else None
+        if connection is not None:
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            return connection, True
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=timeout, context=ssl.create_default_context()), False
+        return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+    def _checkin(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        scheme, host, port, path = split_url(url)
+        key = (scheme, host, port)
+        timeout = timeout or self.timeout
+        for attempt in range(2):
+            connection, reused = self._checkout(key, timeout)
+            try:
+                connection.request(method, path, body, headers or {})
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                connection.close()
+                if reused and not attempt:
+                    continue
+                raise TransportError(f'{method} {url}: {e.__class__.__name__}: {e}') from e
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                raise TransportError(f'{method} {url}: {e.__class__.__name__}: {e}') from e
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._checkin(key, connection)
+            return Response(response.status, {name.lower(): value for name, value in response.getheaders()}, data)
+
+
+class AsyncHTTPPool:
+    """
+    Idle asyncio stream connections by host, kept separately for each event loop
+    """
+
+    def __init__(self, size=10, timeout=10):
+        self.size = size
+        self.timeout = timeout
+        self._loops = weakref.WeakKeyDictionary()
+
+    def _idle(self, key):
+        return self._loops.setdefault(asyncio.get_running_loop(), {}).setdefault(key, [])
+
+    async def _checkout(self, key, timeout):
+        idle = self._idle(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl.create_default_context() if scheme == 'https' else None),
+            timeout,
+        )
+        return reader, writer, False
+
+    def _checkin(self, key, reader, writer):
+        idle = self._idle(key)
+        if len(idle) < self.size:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _exchange(self, reader, writer, method, authority, path, body, headers, timeout):
+        head = [f'{method} {path} HTTP/1.1', f'Host: {authority}', f'Content-Length: {len(body)}']
+        head += [f'{name}: {value}' for name, value in headers.items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+        await asyncio.wait_for(writer.drain(), timeout)
+
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        if not status_line:
+            raise ConnectionResetError('Connection closed by server')
+        version, status = status_line.split(None, 2)[:2]
+        response_headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await asyncio.wait_for(reader.readline(), timeout)).split(b';')[0], 16)
+                chunk = await asyncio.wait_for(reader.readexactly(size + 2), timeout)
+                if not size:
+                    break
+                chunks.append(chunk[:-2])
+            data = b''.join(chunks)
+        elif 'content-length' in response_headers:
+            data = await asyncio.wait_for(reader.readexactly(int(response_headers['content-length'])), timeout)
+        else:
+            data = await asyncio.wait_for(reader.read(), timeout)
+            response_headers['connection'] = 'close'
+
+        keep_alive = response_headers.get('connection', '').lower() != 'close' and version == b'HTTP/1.1'
+        return Response(int(status), response_headers, data), keep_alive
+
+    async def request(self, method, url, body=b'', headers=None, timeout=None):
+        scheme, host, port, path = split_url(url)
+        key = (scheme, host, port)
+        authority = host_header(scheme, host, port)
+        timeout = timeout or self.timeout
+        for attempt in range(2):
+            reader = writer = None
+            reused = False
+            try:
+                reader, writer, reused = await self._checkout(key, timeout)
+                response, keep_alive = await self._exchange(
+                    reader, writer, method, authority, path, body or b'', headers or {}, timeout
+                )
+            except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError) as e:
+                if writer is not None:
+                    writer.close()
+                if reused and not attempt:
+                    continue
+                raise TransportError(f'{method} {url}: {e.__class__.__name__}: {e}') from e
+            except (OSError, asyncio.TimeoutError, ValueError) as e:
+                if writer is not None:
+                    writer.close()
+                raise TransportError(f'{method} {url}: {e.__class__.__name__}: {e}') from e
+            except asyncio.CancelledError:
+                # The response may still arrive on this connection, so it cannot be reused
+                if writer is not None:
+                    writer.close()
+                raise
+
+            if keep_alive:
+                self._checkin(key, reader, writer)
+            else:
+                writer.close()
+            return response
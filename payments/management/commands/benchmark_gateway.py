@@ -0,0 +1,121 @@
+import asyncio
+import http.client
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from payments.gateways import GatewayError, get_breaker, get_gateway
+from payments.mock_gateway import MockGatewayServer
+from payments.models import Payment, PaymentMethod
+
+
+class Command(BaseCommand):
+    help = 'Measure gateway calls against the mock gateway: per-call connections, pooled, threaded and async'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=200, help='Captures per scenario')
+        parser.add_argument('--latency', type=float, default=0.02, help='Mock gateway answer delay in seconds')
+        parser.add_argument('--threads', type=int, default=8, help='Threads in the threaded scenario')
+        parser.add_argument('--concurrency', type=int, default=100, help='Captures in flight on the async path')
+
+    def start_server(self, **kwargs):
+        loop = asyncio.new_event_loop()
+        server = MockGatewayServer(port=0, **kwargs)
+        loop.run_until_complete(server.start())
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        return server, loop
+
+    def payments(self, count):
+        return [
+            Payment(transaction_id=f'bench-{n}', amount=Decimal('25.00'), currency='USD')
+            for n in range(count)
+        ]
+
+    def report(self, label, calls, elapsed, latencies=None, connections=None):
+        line = f'{label:<32}{calls / elapsed:>8.0f} captures/s'
+        if latencies:
+            line += f'  {statistics.median(latencies) * 1000:>6.1f} ms median'
+        if connections is not None:
+            line += f'  {connections} connections'
+        self.stdout.write(line)
+
+    def handle(self, *args, **options):
+        calls, latency = options['calls'], options['latency']
+        server, loop = self.start_server(latency=latency)
+        method = PaymentMethod(name='Mock', provider='mock', config={'base_url': f'http://127.0.0.1:{server.port}'})
+        gateway = get_gateway(method)
+        self.stdout.write(f'Mock gateway latency {latency * 1000:.0f} ms, {calls} captures per scenario\n')
+
+        # A new connection for every call, as a bare requests.post() makes
+        payments, latencies = self.payments(calls), []
+        before = server.connections
+        started = time.perf_counter()
+        for payment in payments:
+            call_started = time.perf_counter()
+            connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=10)
+            method_name, path, payload = gateway.capture_request(payment)
+            connection.request(method_name, path, json.dumps(payload).encode(), gateway.headers(f'capture-{payment.uuid}'))
+            connection.getresponse().read()
+            connection.close()
+            latencies.append(time.perf_counter() - call_started)
+        self.report('Sync, connection per call', calls, time.perf_counter() - started, latencies,
+                    server.connections - before)
+
+        payments, latencies = self.payments(calls), []
+        before = server.connections
+        started = time.perf_counter()
+        for payment in payments:
+            call_started = time.perf_counter()
+            gateway.capture(payment)
+            latencies.append(time.perf_counter() - call_started)
+        self.report('Sync, pooled', calls, time.perf_counter() - started, latencies, server.connections - before)
+
+        payments = self.payments(calls)
+        before = server.connections
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+            list(pool.map(gateway.capture, payments))
+        self.report(f"Sync, pooled, {options['threads']} threads", calls, time.perf_counter() - started,
+                    connections=server.connections - before)
+
+        async def capture_all(payments, concurrency):
+            limit = asyncio.Semaphore(concurrency)
+
+            async def capture(payment):
+                async with limit:
+                    return await gateway.acapture(payment)
+            return await asyncio.gather(*(capture(payment) for payment in payments))
+
+        payments = self.payments(calls)
+        before = server.connections
+        started = time.perf_counter()
+        results = asyncio.run(capture_all(payments, options['concurrency']))
+        self.report(f"Async, {options['concurrency']} in flight, 1 thread", calls, time.perf_counter() - started,
+                    connections=server.connections - before)
+        declined = sum(not result.success for result in results)
+
+        # Idempotency: capturing the same payment twice returns the same charge
+        first, second = gateway.capture(payments[0]), gateway.capture(payments[0])
+        self.stdout.write(f'Repeated capture, same charge:  {first.reference == second.reference}')
+        self.stdout.write(f'Declined:                       {declined}')
+
+        # Circuit breaker against a gateway answering 503
+        server.failure_rate = 1.0
+        breaker = get_breaker(method.provider)
+        started, failed_fast = time.perf_counter(), 0
+        for payment in self.payments(calls):
+            try:
+                gateway.capture(payment)
+            except GatewayError as e:
+                failed_fast += e.__class__.__name__ == 'GatewayUnavailable'
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'Failing gateway: {calls} calls in {elapsed * 1000:.0f} ms, {failed_fast} refused by the '
+            f'breaker ({breaker.state}), {calls - failed_fast} reached the gateway'
+        )
+        loop.call_soon_threadsafe(server.close)
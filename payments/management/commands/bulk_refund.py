@@ -0,0 +1,65 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.models import RefundBatch
+from payments.refunds import create_batch, eligible_payments, run_batch
+
+
+class Command(BaseCommand):
+    help = 'Refund many orders at once, e.g. for a recall or a fraud sweep; resumable after a crash'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resume', type=int, metavar='BATCH_ID', help='Carry on with an earlier batch')
+        parser.add_argument('--order-numbers', metavar='FILE', help='File with one order number per line')
+        parser.add_argument('--product', type=int, help='Refund orders containing this product id')
+        parser.add_argument('--placed-after', help='ISO datetime')
+        parser.add_argument('--placed-before', help='ISO datetime')
+        parser.add_argument('--reason', default='', help='Recorded on every refund')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=20, help='Refunds in flight at once')
+        parser.add_argument('--claim-timeout', type=int, metavar='SECONDS',
+                            help='Resend refunds claimed this long ago by a run that died (REFUND_CLAIM_TIMEOUT); '
+                                 '0 if no other run is going')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the payments that would be refunded')
+
+    def criteria(self, options):
+        criteria = {}
+        if options['order_numbers']:
+            with open(options['order_numbers']) as handle:
+                criteria['order_numbers'] = [line.strip() for line in handle if line.strip()]
+        if options['product']:
+            criteria['product'] = options['product']
+        if options['placed_after']:
+            criteria['placed_after'] = options['placed_after']
+        if options['placed_before']:
+            criteria['placed_before'] = options['placed_before']
+        if not criteria:
+            raise CommandError('Choose orders with --order-numbers, --product or --placed-after/--placed-before')
+        return criteria
+
+    def handle(self, *args, **options):
+        if options['resume']:
+            try:
+                batch = RefundBatch.objects.get(pk=options['resume'])
+            except RefundBatch.DoesNotExist:
+                raise CommandError(f"No refund batch {options['resume']}")
+        else:
+            criteria = self.criteria(options)
+            if options['dry_run']:
+                self.stdout.write(f'{eligible_payments(criteria).count()} payments would be refunded')
+                return
+            if not options['reason']:
+                raise CommandError('Give a --reason')
+            batch = create_batch(criteria, options['reason'])
+            self.stdout.write(f'Created refund batch {batch.pk}')
+
+        started = time.perf_counter()
+        run_batch(batch, options['chunk_size'], options['concurrency'], options['claim_timeout'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'Batch {batch.pk}: {batch.status}; {batch.planned} planned, {batch.succeeded} refunded, '
+            f'{batch.declined} declined in {elapsed:.1f}s'
+        )
+        if batch.last_error:
+            self.stdout.write(self.style.WARNING(batch.last_error))
@@ -0,0 +1,97 @@
+import http.client
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from orders.models import Order
+from payments.webhooks import sign
+
+
+class Command(BaseCommand):
+    help = 'Fire signed payment webhooks at a running server, as a gateway in a retry storm would'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000/payments/webhooks/fake/')
+        parser.add_argument('--events', type=int, default=10000, help='Distinct events to send')
+        parser.add_argument('--threads', type=int, default=32, help='Concurrent connections')
+        parser.add_argument('--duplicates', type=float, default=0.5,
+                            help='Share of events sent again, as a provider retrying does')
+        parser.add_argument('--orders', type=int, default=200, help='Recent orders the events are about')
+        parser.add_argument('--secret', default=None, help='Signing secret; defaults to PAYMENT_WEBHOOK_SECRET')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def build_events(self, options):
+        rng = random.Random(options['seed'])
+        order_numbers = list(Order.objects.order_by('-pk').values_list('order_number', flat=True)[:options['orders']])
+        if not order_numbers:
+            raise CommandError('Place some orders first; events refer to existing orders')
+        run = uuid.uuid4().hex[:8]
+        events = []
+        for n in range(options['events']):
+            order_number = rng.choice(order_numbers)
+            events.append({
+                'id': f'evt_{run}_{n}',
+                'type': rng.choices(['payment.succeeded', 'payment.failed', 'customer.updated'], [8, 1, 1])[0],
+                'data': {
+                    'order_number': order_number,
+                    'transaction_id': f'txn_{run}_{order_number}',
+                    'reason': 'card_declined',
+                },
+            })
+        events += rng.sample(events, int(len(events) * options['duplicates']))
+        rng.shuffle(events)
+        return [json.dumps(event).encode() for event in events]
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        bodies = self.build_events(options)
+        signatures = [sign(body, options['secret']) for body in bodies]
+        statuses, latencies = {}, []
+        lock = threading.Lock()
+        position = iter(range(len(bodies)))
+
+        def sender():
+            connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+            mine, times = {}, []
+            for index in position:
+                started = time.perf_counter()
+                try:
+                    connection.request('POST', url.path, bodies[index], {
+                        'Content-Type': 'application/json', 'X-Webhook-Signature': signatures[index],
+                    })
+                    response = connection.getresponse()
+                    response.read()
+                    status = response.status
+                    if response.will_close:
+                        connection.close()
+                except (OSError, http.client.HTTPException):
+                    status = 'error'
+                    connection.close()
+                times.append(time.perf_counter() - started)
+                mine[status] = mine.get(status, 0) + 1
+            connection.close()
+            with lock:
+                for status, count in mine.items():
+                    statuses[status] = statuses.get(status, 0) + count
+                latencies.extend(times)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+            for _ in range(options['threads']):
+                pool.submit(sender)
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        self.stdout.write(f"Sent:        {len(bodies)} requests ({options['events']} distinct events) in {elapsed:.2f}s")
+        self.stdout.write(f'Throughput:  {len(bodies) / elapsed:.0f} requests/s')
+        self.stdout.write(
+            f'Latency:     p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, '
+            f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms'
+        )
+        self.stdout.write(f'Responses:   {dict(sorted(statuses.items(), key=str))}')
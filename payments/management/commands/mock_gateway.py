@@ -0,0 +1,30 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from payments.mock_gateway import MockGatewayServer
+
+
+class Command(BaseCommand):
+    help = 'Run a local mock payment gateway for development and benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8900)
+        parser.add_argument('--latency', type=float, default=0.1, help='Seconds before each answer')
+        parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of requests answered 503')
+        parser.add_argument('--decline-rate', type=float, default=0.0, help='Share of payments declined')
+
+    def handle(self, *args, **options):
+        server = MockGatewayServer(
+            options['host'], options['port'], options['latency'], options['failure_rate'], options['decline_rate']
+        )
+        self.stdout.write(
+            f"Mock gateway on http://{options['host']}:{options['port']}/ "
+            f"(latency {options['latency'] * 1000:.0f} ms); set base_url in a PaymentMethod's config "
+            "with provider 'mock'"
+        )
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.14 on 2026-10-17 02:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentwebhook',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='paymentwebhook',
+            name='order_number',
+            field=models.CharField(blank=True, help_text='Events for one order are processed in arrival order', max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name='paymentwebhook',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='payments_webhook_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='paymentwebhook',
+            index=models.Index(fields=['order_number', 'id'], name='payments_webhook_order_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.0.14 on 2026-10-17 02:19
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0002_webhook_queue'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RefundBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('reason', models.TextField()),
+                ('criteria', models.JSONField(default=dict, help_text='Which orders to refund')),
+                ('status', models.CharField(choices=[('planning', 'Planning'), ('refunding', 'Refunding'), ('paused', 'Paused'), ('completed', 'Completed')], default='planning', max_length=20)),
+                ('last_payment_id', models.BigIntegerField(default=0)),
+                ('planned', models.PositiveIntegerField(default=0)),
+                ('succeeded', models.PositiveIntegerField(default=0)),
+                ('declined', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'payments_refund_batch',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='batch',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='refunds', to='payments.refundbatch'),
+        ),
+    ]
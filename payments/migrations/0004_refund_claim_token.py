@@ -0,0 +1,18 @@
+# Generated by Django 5.0.14 on 2026-10-17 02:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0003_refund_batches'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='refund',
+            name='claim_token',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+    ]
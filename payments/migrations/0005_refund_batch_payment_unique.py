@@ -0,0 +1,17 @@
+# Generated by Django 5.0.14 on 2026-10-17 03:11
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0004_refund_claim_token'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='refund',
+            unique_together={('batch', 'original_payment')},
+        ),
+    ]
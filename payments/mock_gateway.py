@@ -0,0 +1,102 @@
+"""
+A local stand-in for a payment gateway, for development and benchmarks.
+
+It speaks the API ``payments.gateways.MockGateway`` expects: ``POST
+/v1/captures`` and ``POST /v1/refunds`` with JSON bodies. It keeps
+connections alive, honours ``Idempotency-Key``, waits ``latency`` seconds
+before each answer and can fail a share of requests with 503. Nothing is
+stored beyond the idempotency keys of the running process.
+"""
+import asyncio
+import json
+import random
+import uuid
+
+
+class MockGatewayServer:
+    """
+    asyncio HTTP/1.1 server answering like a gateway
+    """
+
+    def __init__(self, host='127.0.0.1', port=8900, latency=0.1, failure_rate=0.0, decline_rate=0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.decline_rate = decline_rate
+        self.requests = 0
+        self.connections = 0
+        self._answers = {}
+        self._server = None
+
+    def answer(self, path, payload, idempotency_key):
+        """``(status, body)`` for one request"""
+        if random.random() < self.failure_rate:
+            return 503, {'error': 'unavailable'}
+        if idempotency_key and idempotency_key in self._answers:
+            return self._answers[idempotency_key]
+        if path not in ('/v1/captures', '/v1/refunds'):
+            return 404, {'error': 'not found'}
+        kind = 'ch' if path == '/v1/captures' else 're'
+        if random.random() < self.decline_rate:
+            result = 402, {'id': f'{kind}_{uuid.uuid4().hex[:16]}', 'status': 'declined', 'error': 'card_declined'}
+        else:
+            result = 200, {'id': f'{kind}_{uuid.uuid4().hex[:16]}', 'status': 'succeeded',
+                           'amount': payload.get('amount')}
+        if idempotency_key:
+            self._answers[idempotency_key] = result
+        return result
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path = request_line.decode('latin-1').split()[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.requests += 1
+
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                try:
+                    payload = json.loads(body or b'{}')
+                except ValueError:
+                    status, answer = 400, {'error': 'invalid json'}
+                else:
+                    status, answer = (
+                        self.answer(path, payload, headers.get('idempotency-key'))
+                        if method == 'POST' else (405, {'error': 'method not allowed'})
+                    )
+                data = json.dumps(answer).encode()
+                writer.write(
+                    f'HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n'
+                    f'Content-Length: {len(data)}\r\n\r\n'.encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self.handle, self.host, self.port, backlog=1024)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
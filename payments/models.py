@@ -1,6 +1,7 @@
 from django.db import models
 from django.core.validators import MinValueValidator
 import uuid
+from core.ids import new_id
 from core.models import TimeStampedModel
 from customers.models import Customer
 from orders.models import Order
@@ -92,6 +93,39 @@ class Payment(TimeStampedModel):
         ordering = ['-created_at']
 
 
+class RefundBatch(TimeStampedModel):
+    """
+    A bulk refund run, with the checkpoints it resumes from
+    """
+    STATUS_CHOICES = [
+        ('planning', 'Planning'),
+        ('refunding', 'Refunding'),
+        ('paused', 'Paused'),
+        ('completed', 'Completed'),
+    ]
+    
+    reason = models.TextField()
+    criteria = models.JSONField(default=dict, help_text="Which orders to refund")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='planning')
+    created_by = models.ForeignKey(Customer, on_delete=models.SET_NULL, null=True, blank=True)
+    
+    # Checkpoint: payments up to this id have their refund rows
+    last_payment_id = models.BigIntegerField(default=0)
+    
+    # Progress
+    planned = models.PositiveIntegerField(default=0)
+    succeeded = models.PositiveIntegerField(default=0)
+    declined = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    
+    def __str__(self):
+        return f"Refund batch {self.pk} - {self.status}"
+    
+    class Meta:
+        db_table = 'payments_refund_batch'
+        ordering = ['-created_at']
+
+
 class Refund(TimeStampedModel):
     """
     Refund transactions
@@ -111,6 +145,7 @@ class Refund(TimeStampedModel):
     # Related objects
     original_payment = models.ForeignKey(Payment, related_name='refunds', on_delete=models.CASCADE)
     order = models.ForeignKey(Order, related_name='refunds', on_delete=models.CASCADE)
+    batch = models.ForeignKey(RefundBatch, related_name='refunds', on_delete=models.SET_NULL, null=True, blank=True)
     
     # Refund details
     amount = models.DecimalField(max_digits=10, decimal_places=2, validators=[MinValueValidator(0)])
@@ -125,6 +160,9 @@ class Refund(TimeStampedModel):
     processed_at = models.DateTimeField(null=True, blank=True)
     processed_by = models.ForeignKey(Customer, on_delete=models.SET_NULL, null=True, blank=True)
     
+    # The bulk refund run that claimed this refund while it is processing
+    claim_token = models.CharField(max_length=32, blank=True, editable=False)
+    
     def __str__(self):
         return f"Refund {self.refund_id} - ${self.amount}"
     
@@ -134,12 +172,13 @@ class Refund(TimeStampedModel):
         super().save(*args, **kwargs)
     
     def generate_refund_id(self):
-        import random, string
-        return 'REF-' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+        return new_id('REF-')
     
     class Meta:
         db_table = 'payments_refund'
         ordering = ['-created_at']
+        # A batch plans at most one refund per payment
+        unique_together = ['batch', 'original_payment']
 
 
 class CustomerPaymentMethod(TimeStampedModel):
@@ -209,11 +248,13 @@ class PaymentWebhook(TimeStampedModel):
     # Webhook data
     data = models.JSONField()
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    order_number = models.CharField(max_length=50, blank=True, help_text="Events for one order are processed in arrival order")
     
     # Processing details
     processed_at = models.DateTimeField(null=True, blank=True)
     error_message = models.TextField(blank=True)
     attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
     
     def __str__(self):
         return f"{self.provider} webhook: {self.event_type} - {self.status}"
@@ -221,3 +262,8 @@ class PaymentWebhook(TimeStampedModel):
     class Meta:
         db_table = 'payments_webhook'
         ordering = ['-created_at']
+        indexes = [
+            # The drain's scan for due events, and its check for earlier events of the same order
+            models.Index(fields=['status', 'next_attempt_at'], name='payments_webhook_due_idx'),
+            models.Index(fields=['order_number', 'id'], name='payments_webhook_order_idx'),
+        ]
@@ -0,0 +1,259 @@
+"""
+Bulk refunds, for recalls, fraud sweeps and other mass cancellations.
+
+A ``RefundBatch`` runs in two phases, and either can be resumed after a crash.
+
+Planning walks the eligible payments in id order, one chunk at a time. For
+each chunk it locks the batch row, bulk-creates pending ``Refund`` rows for
+the unrefunded balance and moves ``last_payment_id`` forward in the same
+transaction. A crash therefore never plans a payment twice and never skips
+one, and overlapping runs take turns instead of planning the same chunk.
+
+Refunding claims the batch's pending refunds a chunk at a time and marks them
+processing under the run's claim token. It sends them over the async gateway
+path, at most ``concurrency`` at once, then writes the results back with bulk
+updates to refunds, payments, ``Order.payment_status`` and customers' spend.
+Only refunds still processing under the run's own token are written, so
+overlapping runs never record, count or debit a refund twice.
+
+Refunds a gateway did not answer are handed back when the run ends. Those
+left processing by a run that crashed are handed back once their claim is
+REFUND_CLAIM_TIMEOUT seconds old. Either way a later run sends them again.
+Their idempotency keys come from the refund, so the gateway repeats its first
+answer and nobody is refunded twice.
+
+A batch is paused when a gateway's circuit breaker opens; run it again to
+carry on.
+"""
+import asyncio
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, DecimalField, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from customers.metrics import add_spends
+from orders.models import Order
+from .gateways import GatewayError, GatewayUnavailable, get_gateway
+from .models import Payment, Refund, RefundBatch
+
+
+REFUNDABLE = ['completed', 'partially_refunded']
+
+
+def eligible_orders(criteria):
+    """
+    Orders matched by a batch's ``criteria``
+
+    Supported keys: ``order_numbers``, ``product`` (an id), and ISO
+    ``placed_after`` / ``placed_before`` datetimes.
+    """
+    orders = Order.objects.all()
+    if 'order_numbers' in criteria:
+        orders = orders.filter(order_number__in=criteria['order_numbers'])
+    if 'product' in criteria:
+        orders = orders.filter(items__product_id=criteria['product'])
+    if 'placed_after' in criteria:
+        orders = orders.filter(created_at__gte=parse_datetime(criteria['placed_after']))
+    if 'placed_before' in criteria:
+        orders = orders.filter(created_at__lt=parse_datetime(criteria['placed_before']))
+    return orders
+
+
+def eligible_payments(criteria):
+    """Captured payments of the matched orders with an unrefunded balance, annotated ``refundable``"""
+    refunded = (
+        Refund.objects.filter(original_payment=OuterRef('pk')).exclude(status__in=['failed', 'cancelled'])
+        .values('original_payment').annotate(total=Sum('amount')).values('total')
+    )
+    money = DecimalField(max_digits=10, decimal_places=2)
+    return (
+        Payment.objects
+        .filter(status__in=REFUNDABLE, transaction_type='payment', order__in=eligible_orders(criteria).values('pk'))
+        .annotate(refundable=F('amount') - Coalesce(Subquery(refunded, output_field=money), Value(0), output_field=money))
+        .filter(refundable__gt=0)
+        .order_by('pk')
+    )
+
+
+def create_batch(criteria, reason, created_by=None):
+    return RefundBatch.objects.create(criteria=criteria, reason=reason, created_by=created_by)
+
+
+def plan(batch, chunk_size=500):
+    """Create the batch's refund rows, resuming after its ``last_payment_id``"""
+    payments = eligible_payments(batch.criteria)
+    while batch.status == 'planning':
+        with transaction.atomic():
+            # Another run may have planned since this one last looked
+            locked = RefundBatch.objects.select_for_update().get(pk=batch.pk)
+            batch.status, batch.last_payment_id, batch.planned = locked.status, locked.last_payment_id, locked.planned
+            if batch.status != 'planning':
+                break
+            chunk = list(payments.filter(pk__gt=batch.last_payment_id)[:chunk_size])
+            if chunk:
+                refunds = [
+                    Refund(
+                        original_payment=payment,
+                        order_id=payment.order_id,
+                        batch=batch,
+                        amount=payment.refundable,
+                        reason=batch.reason,
+                        processed_by_id=batch.created_by_id,
+                    )
+                    for payment in chunk
+                ]
+                # bulk_create skips Refund.save(), which assigns the refund_id
+                for refund in refunds:
+                    refund.refund_id = refund.generate_refund_id()
+                Refund.objects.bulk_create(refunds)
+                batch.last_payment_id = chunk[-1].pk
+                batch.planned += len(chunk)
+            else:
+                batch.status = 'refunding'
+            batch.save(update_fields=['last_payment_id', 'planned', 'status', 'updated_at'])
+
+
+async def send_refunds(refunds, concurrency):
+    """Send refunds to their gateways; returns a ``GatewayResult`` or ``GatewayError`` for each"""
+    limit = asyncio.Semaphore(concurrency)
+    gateways = {}
+
+    async def send(refund):
+        try:
+            method = refund.original_payment.payment_method
+            key = method.pk if method else None
+            if key not in gateways:
+                gateways[key] = get_gateway(method)
+            async with limit:
+                return await gateways[key].arefund(refund)
+        except GatewayError as e:
+            return e
+
+    return await asyncio.gather(*(send(refund) for refund in refunds))
+
+
+def release_stale_claims(batch, timeout=None):
+    """Hand back refunds claimed by a run that has not answered for ``timeout`` seconds"""
+    timeout = settings.REFUND_CLAIM_TIMEOUT if timeout is None else timeout
+    return Refund.objects.filter(
+        batch=batch, status='processing', updated_at__lt=timezone.now() - timedelta(seconds=timeout)
+    ).update(status='pending', claim_token='', updated_at=timezone.now())
+
+
+def claim(batch, chunk_size, token):
+    """Mark the next chunk of pending refunds processing under ``token``; returns their ids"""
+    with transaction.atomic():
+        pending = Refund.objects.filter(batch=batch, status='pending').order_by('pk')
+        if connection.features.has_select_for_update_skip_locked:
+            pending = pending.select_for_update(skip_locked=True)
+        ids = list(pending.values_list('pk', flat=True)[:chunk_size])
+        Refund.objects.filter(pk__in=ids, status='pending').update(
+            status='processing', claim_token=token, updated_at=timezone.now()
+        )
+    return list(Refund.objects.filter(pk__in=ids, claim_token=token).values_list('pk', flat=True))
+
+
+def record(batch, refunds, results, token):
+    """
+    Write a chunk's answers back with bulk updates; returns the errors of unanswered refunds
+
+    Answers for refunds no longer processing under ``token`` are dropped:
+    another run took them over and records them itself.
+    """
+    now = timezone.now()
+    errors = []
+    for refund, result in zip(refunds, results):
+        if isinstance(result, GatewayError):
+            errors.append(result)
+
+    with transaction.atomic():
+        owned = Refund.objects.filter(
+            pk__in=[refund.pk for refund in refunds], status='processing', claim_token=token
+        )
+        if connection.features.has_select_for_update:
+            owned = owned.select_for_update()
+        owned = set(owned.values_list('pk', flat=True))
+
+        answered, refunded, declined = [], [], 0
+        for refund, result in zip(refunds, results):
+            if isinstance(result, GatewayError) or refund.pk not in owned:
+                continue
+            refund.gateway_response = result.response
+            refund.processed_at = refund.updated_at = now
+            refund.claim_token = ''
+            if result.success:
+                refund.status = 'completed'
+                refund.gateway_refund_id = result.reference
+                refunded.append(refund)
+            else:
+                refund.status = 'failed'
+                declined += 1
+            answered.append(refund)
+
+        if answered:
+            Refund.objects.bulk_update(
+                answered,
+                ['status', 'gateway_refund_id', 'gateway_response', 'processed_at', 'claim_token', 'updated_at'],
+            )
+        if refunded:
+            # Planned refunds cover each payment's whole balance
+            Payment.objects.filter(pk__in=[refund.original_payment_id for refund in refunded]).update(
+                status='refunded', updated_at=now
+            )
+            orders = Order.objects.filter(pk__in={refund.order_id for refund in refunded}).annotate(
+                captured=Count('payments', filter=Q(payments__status__in=REFUNDABLE, payments__transaction_type='payment'))
+            )
+            orders.filter(captured=0).update(payment_status='refunded', updated_at=now)
+            orders.filter(captured__gt=0).update(payment_status='partially_refunded', updated_at=now)
+            add_spends([(refund.order_id, -refund.amount) for refund in refunded])
+        RefundBatch.objects.filter(pk=batch.pk).update(
+            succeeded=F('succeeded') + len(refunded), declined=F('declined') + declined, updated_at=now
+        )
+    return errors
+
+
+def send_batch(batch, chunk_size=500, concurrency=20, claim_timeout=None):
+    """Send the batch's pending refunds, including any abandoned by an earlier run"""
+    release_stale_claims(batch, claim_timeout)
+    batch.status, batch.last_error = 'refunding', ''
+    batch.save(update_fields=['status', 'last_error', 'updated_at'])
+
+    token = uuid.uuid4().hex
+    unanswered = []
+    while True:
+        ids = claim(batch, chunk_size, token)
+        if not ids:
+            break
+        refunds = list(
+            Refund.objects.filter(pk__in=ids).select_related('original_payment__payment_method').order_by('pk')
+        )
+        errors = record(batch, refunds, asyncio.run(send_refunds(refunds, concurrency)), token)
+        unanswered += errors
+        if any(isinstance(error, GatewayUnavailable) for error in errors):
+            break
+
+    # This run is done with its unanswered refunds; the next run sends them again
+    Refund.objects.filter(batch=batch, status='processing', claim_token=token).update(
+        status='pending', claim_token='', updated_at=timezone.now()
+    )
+    batch.refresh_from_db()
+    if unanswered:
+        batch.status = 'paused'
+        batch.last_error = f'{len(unanswered)} refund(s) got no answer, e.g. {unanswered[-1]}; run the batch again'
+    elif not Refund.objects.filter(batch=batch, status__in=['pending', 'processing']).exists():
+        batch.status = 'completed'
+    batch.save(update_fields=['status', 'last_error', 'updated_at'])
+
+
+def run_batch(batch, chunk_size=500, concurrency=20, claim_timeout=None):
+    """Plan and send a batch, or carry on where an earlier run stopped"""
+    if batch.status == 'planning':
+        plan(batch, chunk_size)
+    if batch.status in ('refunding', 'paused'):
+        send_batch(batch, chunk_size, concurrency, claim_timeout)
+    return batch
@@ -0,0 +1,19 @@
+from django.conf import settings
+
+from xcommerce.celery import app
+
+from . import refunds, webhooks
+from .models import RefundBatch
+
+
+@app.task(ignore_result=True)
+def process_payment_webhooks():
+    """Process stored payment webhooks that are due"""
+    # Stop before the next scheduled run, so runs do not pile up
+    return webhooks.drain(time_limit=max(settings.PAYMENT_WEBHOOK_DRAIN_INTERVAL - 1, 1))
+
+
+@app.task(ignore_result=True)
+def run_refund_batch(batch_id, chunk_size=500, concurrency=20):
+    """Plan and send a bulk refund batch, or resume it"""
+    refunds.run_batch(RefundBatch.objects.get(pk=batch_id), chunk_size, concurrency)
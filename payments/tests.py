@@ -1,3 +1,277 @@
-from django.test import TestCase
+import asyncio
+import json
+import socket
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from orders.models import Order
+from . import refunds, webhooks
+from .gateways import (
+    GatewayError, GatewayResult, GatewayUnavailable, _breakers, acapture_payment, capture_payment, get_breaker,
+    get_http_pool,
+)
+from .http import host_header, split_url
+from .mock_gateway import MockGatewayServer
+from .models import Payment, PaymentMethod, PaymentWebhook, Refund, RefundBatch
+
+
+class HostHeaderTests(TestCase):
+    def test_port_is_kept_unless_default(self):
+        self.assertEqual(host_header(*split_url('http://gateway.test/v1')[:3]), 'gateway.test')
+        self.assertEqual(host_header(*split_url('https://gateway.test:443/v1')[:3]), 'gateway.test')
+        self.assertEqual(host_header(*split_url('http://127.0.0.1:8900/v1')[:3]), '127.0.0.1:8900')
+        self.assertEqual(host_header(*split_url('https://gateway.test:80/v1')[:3]), 'gateway.test:80')
+        self.assertEqual(host_header(*split_url('http://[::1]:8900/v1')[:3]), '[::1]:8900')
+
+
+@override_settings(PAYMENT_GATEWAY_FAILURE_THRESHOLD=2, PAYMENT_GATEWAY_RESET_TIMEOUT=30)
+class GatewayTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.loop = asyncio.new_event_loop()
+        cls.server = MockGatewayServer(port=0, latency=0)
+        threading.Thread(target=cls.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(cls.server.start(), cls.loop).result()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.call_soon_threadsafe(cls.server.close)
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        super().tearDownClass()
+
+    def setUp(self):
+        _breakers.clear()
+        get_http_pool.cache_clear()
+        self.server.failure_rate = 0.0
+        self.method = PaymentMethod.objects.create(
+            name='Mock', provider='mock', config={'base_url': f'http://127.0.0.1:{self.server.port}'}
+        )
+
+    def payment(self, number='1'):
+        order = Order.objects.create(order_number=f'T{number}', customer_email='t@example.com',
+                                     total_amount=Decimal('20.00'))
+        return Payment.objects.create(
+            transaction_id=f'txn-{number}', order=order, payment_method=self.method, amount=Decimal('20.00')
+        )
+
+    def test_breaker_opens_and_half_opens(self):
+        payment = self.payment()
+        self.server.failure_rate = 1.0
+        for _ in range(2):
+            with self.assertRaises(GatewayError):
+                capture_payment(payment)
+        breaker = get_breaker('mock')
+        self.assertEqual(breaker.state, 'open')
+
+        requests = self.server.requests
+        with self.assertRaises(GatewayUnavailable):
+            capture_payment(payment)
+        self.assertEqual(self.server.requests, requests)
+
+        # Once the reset timeout has passed, one trial call goes through
+        breaker.opened_at -= 30
+        with self.assertRaises(GatewayError):
+            capture_payment(payment)
+        self.assertEqual(self.server.requests, requests + 1)
+        self.assertEqual(breaker.state, 'open')
+
+        breaker.opened_at -= 30
+        self.server.failure_rate = 0.0
+        self.assertTrue(capture_payment(payment).success)
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_retry_reuses_idempotency_key(self):
+        payment = self.payment()
+        self.server.failure_rate = 1.0
+        with self.assertRaises(GatewayError):
+            capture_payment(payment)
+        self.server.failure_rate = 0.0
+        first = capture_payment(payment)
+        again = capture_payment(payment)
+
+        self.assertTrue(first.success)
+        self.assertEqual(again.reference, first.reference)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'completed')
+        self.assertEqual(payment.gateway_transaction_id, first.reference)
+
+    def test_pooled_connection_is_reused(self):
+        connections = self.server.connections
+        for number in range(3):
+            self.assertTrue(capture_payment(self.payment(str(number))).success)
+        self.assertEqual(self.server.connections, connections + 1)
+
+        # A pooled connection that turns out to be closed is replaced, once
+        key = split_url(self.method.config['base_url'])[:3]
+        for connection in get_http_pool()._idle[key]:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        self.assertTrue(capture_payment(self.payment('closed')).success)
+        self.assertEqual(self.server.connections, connections + 2)
+
+    async def test_async_capture(self):
+        payment = await Payment.objects.select_related('payment_method').aget(pk=(await self.apayment()).pk)
+        result = await acapture_payment(payment)
+
+        self.assertTrue(result.success)
+        payment = await Payment.objects.select_related('order').aget(pk=payment.pk)
+        self.assertEqual(payment.status, 'completed')
+        self.assertEqual(payment.gateway_transaction_id, result.reference)
+        self.assertEqual(payment.order.payment_status, 'paid')
+
+    async def apayment(self):
+        order = await Order.objects.acreate(order_number='TA', customer_email='t@example.com',
+                                            total_amount=Decimal('20.00'))
+        return await Payment.objects.acreate(
+            transaction_id='txn-async', order=order, payment_method=self.method, amount=Decimal('20.00')
+        )
+
+
+class RefundBatchTests(TestCase):
+    def setUp(self):
+        self.customer = get_user_model().objects.create_user(
+            username='buyer', email='b@example.com', password='x', total_spent=Decimal('60.00')
+        )
+        method = PaymentMethod.objects.create(name='Mock', provider='mock', config={'base_url': 'http://127.0.0.1:9'})
+        self.payments = []
+        for number in range(3):
+            order = Order.objects.create(order_number=f'R{number}', customer=self.customer,
+                                         customer_email='b@example.com', total_amount=Decimal('20.00'),
+                                         payment_status='paid')
+            self.payments.append(Payment.objects.create(
+                transaction_id=f'txn-r{number}', order=order, payment_method=method, amount=Decimal('20.00'),
+                status='completed',
+            ))
+        self.batch = refunds.create_batch({'order_numbers': ['R0', 'R1', 'R2']}, 'recall')
+
+    def test_plan_resumes_from_the_locked_row(self):
+        stale = RefundBatch.objects.get(pk=self.batch.pk)
+        refunds.plan(self.batch, chunk_size=2)
+        self.assertEqual(self.batch.status, 'refunding')
+
+        # A run that read the batch before the first one planned must not plan again
+        refunds.plan(stale, chunk_size=2)
+        self.assertEqual(stale.status, 'refunding')
+        self.assertEqual(Refund.objects.filter(batch=self.batch).count(), 3)
+        self.assertEqual(RefundBatch.objects.get(pk=self.batch.pk).planned, 3)
+
+    def test_one_refund_per_payment_and_batch(self):
+        refunds.plan(self.batch)
+        with self.assertRaises(IntegrityError):
+            Refund.objects.create(original_payment=self.payments[0], order_id=self.payments[0].order_id,
+                                  batch=self.batch, amount=Decimal('1.00'), reason='again')
+
+    def test_record_counts_only_own_claims(self):
+        refunds.plan(self.batch)
+        ids = refunds.claim(self.batch, 10, 'mine')
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(refunds.claim(self.batch, 10, 'other'), [])
+
+        claimed = list(Refund.objects.filter(pk__in=ids).order_by('pk'))
+        # Another run took over the last refund after this run's claim went stale
+        Refund.objects.filter(pk=claimed[2].pk).update(claim_token='other')
+        results = [GatewayResult(True, 're_1'), GatewayResult(False, 're_2', error='declined'),
+                   GatewayResult(True, 're_3')]
+        errors = refunds.record(self.batch, claimed, results, 'mine')
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Refund.objects.get(pk=claimed[0].pk).status, 'completed')
+        self.assertEqual(Refund.objects.get(pk=claimed[1].pk).status, 'failed')
+        self.assertEqual(Refund.objects.get(pk=claimed[2].pk).status, 'processing')
+        self.assertEqual(Payment.objects.get(pk=claimed[0].original_payment_id).status, 'refunded')
+        self.assertEqual(Order.objects.get(pk=claimed[0].order_id).payment_status, 'refunded')
+        batch = RefundBatch.objects.get(pk=self.batch.pk)
+        self.assertEqual((batch.succeeded, batch.declined), (1, 1))
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.total_spent, Decimal('40.00'))
+
+        # Recording the same answers again changes nothing
+        refunds.record(self.batch, claimed, results, 'mine')
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.total_spent, Decimal('40.00'))
+        self.assertEqual(RefundBatch.objects.get(pk=self.batch.pk).succeeded, 1)
+
+    def test_stale_claims_are_released(self):
+        refunds.plan(self.batch)
+        refunds.claim(self.batch, 10, 'crashed')
+        self.assertEqual(refunds.release_stale_claims(self.batch, timeout=3600), 0)
+        self.assertEqual(refunds.release_stale_claims(self.batch, timeout=-1), 3)
+        self.assertEqual(Refund.objects.filter(batch=self.batch, status='pending', claim_token='').count(), 3)
+
+
+@override_settings(PAYMENT_WEBHOOK_SECRET='secret', PAYMENT_WEBHOOK_RETRY_DELAY=30, PAYMENT_WEBHOOK_MAX_ATTEMPTS=2)
+class WebhookTests(TestCase):
+    def setUp(self):
+        self.customer = get_user_model().objects.create_user(username='buyer', email='b@example.com', password='x')
+        self.order = Order.objects.create(order_number='W1', customer=self.customer, customer_email='b@example.com',
+                                          total_amount=Decimal('20.00'))
+
+    def post(self, webhook_id, event_type, **data):
+        body = json.dumps({'id': webhook_id, 'type': event_type, 'data': {'order_number': 'W1', **data}}).encode()
+        return self.client.post(
+            reverse('payments:webhook', args=['mock']), body, content_type='application/json',
+            HTTP_X_WEBHOOK_SIGNATURE=webhooks.sign(body),
+        )
+
+    def test_redeliveries_are_stored_and_counted_once(self):
+        for _ in range(2):
+            self.assertEqual(self.post('evt-1', 'payment.succeeded', transaction_id='txn-1').status_code, 200)
+        # A second event for the same capture changes nothing either
+        self.post('evt-2', 'payment.succeeded', transaction_id='txn-1')
+        self.assertEqual(PaymentWebhook.objects.count(), 2)
+
+        self.assertEqual(webhooks.process_batch(), 2)
+        self.assertEqual(Payment.objects.get(transaction_id='txn-1').status, 'completed')
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.total_spent, Decimal('20.00'))
+
+    def test_bad_signature_is_rejected(self):
+        response = self.client.post(
+            reverse('payments:webhook', args=['mock']), b'{"id": "evt-1", "type": "payment.succeeded"}',
+            content_type='application/json', HTTP_X_WEBHOOK_SIGNATURE='forged',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(PaymentWebhook.objects.exists())
+
+    def test_refund_waits_for_the_payment_retry(self):
+        self.post('evt-1', 'payment.succeeded', transaction_id='txn-1')
+        self.post('evt-2', 'refund.created', transaction_id='txn-1', refund_id='re-1', amount='20.00')
+        succeeded = webhooks.HANDLERS['payment.succeeded']
+        now = timezone.now()
+
+        with mock.patch.dict(webhooks.HANDLERS, {'payment.succeeded': mock.Mock(side_effect=ValueError)}), \
+                self.assertLogs('xcommerce', 'WARNING'):
+            self.assertEqual(webhooks.process_batch(now=now), 1)
+        self.assertEqual(
+            list(PaymentWebhook.objects.order_by('pk').values_list('status', 'attempts')),
+            [('pending', 1), ('pending', 0)],
+        )
+        # Nothing is due until the payment's retry
+        self.assertEqual(webhooks.process_batch(now=now + timedelta(seconds=10)), 0)
+
+        self.assertEqual(webhooks.HANDLERS['payment.succeeded'], succeeded)
+        self.assertEqual(webhooks.process_batch(now=now + timedelta(seconds=31)), 2)
+        self.order.refresh_from_db()
+        self.customer.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'refunded')
+        self.assertEqual(self.customer.total_spent, Decimal('0.00'))
+
+    def test_event_failing_for_good_unblocks_its_order(self):
+        self.post('evt-1', 'refund.created', transaction_id='txn-missing', refund_id='re-1', amount='5.00')
+        self.post('evt-2', 'payment.succeeded', transaction_id='txn-1')
+        now = timezone.now()
+
+        with self.assertLogs('xcommerce', 'WARNING'):
+            self.assertEqual(webhooks.process_batch(now=now), 1)
+            self.assertEqual(webhooks.process_batch(now=now + timedelta(seconds=31)), 2)
+        self.assertEqual(
+            list(PaymentWebhook.objects.order_by('pk').values_list('status', flat=True)), ['failed', 'processed']
+        )
@@ -0,0 +1,9 @@
+from django.urls import path
+from . import views
+
+app_name = 'payments'
+
+urlpatterns = [
+    path('webhooks/<slug:provider>/', views.payment_webhook, name='webhook'),
+    path('<uuid:uuid>/capture/', views.capture_payment, name='capture'),
+]
@@ -1,3 +1,41 @@
-from django.shortcuts import render
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
-# Create your views here.
+from .gateways import GatewayError, acapture_payment
+from .models import Payment
+from .webhooks import WebhookError, ingest
+
+
+@csrf_exempt
+@require_POST
+def payment_webhook(request, provider):
+    """Store a gateway event for the webhook drain and acknowledge it at once"""
+    try:
+        ingest(provider, request.body, request.headers.get('X-Webhook-Signature'))
+    except WebhookError as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+    return HttpResponse(status=200)
+
+
+@require_POST
+async def capture_payment(request, uuid):
+    """Capture a pending payment; runs without a thread while the gateway answers under ASGI"""
+    user = await request.auser()
+    if not user.is_staff:
+        return JsonResponse({'success': False, 'message': 'Staff only'}, status=403)
+    try:
+        payment = await Payment.objects.select_related('payment_method').aget(uuid=uuid, status='pending')
+    except Payment.DoesNotExist:
+        return JsonResponse({'success': False, 'message': 'No pending payment'}, status=404)
+    
+    try:
+        result = await acapture_payment(payment)
+    except GatewayError as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=503)
+    return JsonResponse({
+        'success': result.success,
+        'status': payment.status,
+        'gateway_transaction_id': payment.gateway_transaction_id,
+        'message': result.error,
+    })
@@ -0,0 +1,264 @@
+"""
+Payment webhook ingestion and processing.
+
+The endpoint does as little as possible: it checks the signature, parses the
+event and stores it with one INSERT that skips webhook ids already stored, so
+provider retries and replays cost one statement and never run twice. Nothing
+else happens in the request.
+
+``process_batch`` does the work later, from the payments.tasks drain. It
+locks a batch of due events with SKIP LOCKED, so several workers can drain
+at once, and runs each handler in its own savepoint. A failed event is
+retried after PAYMENT_WEBHOOK_RETRY_DELAY seconds, doubling with each
+attempt, and is marked failed after PAYMENT_WEBHOOK_MAX_ATTEMPTS.
+
+Events for the same order are applied in arrival order. An event is only
+handled once every earlier event for its order has been processed, has
+failed for good or was ignored, so a refund never overtakes the payment it
+refunds, even while that payment is waiting for a retry.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef, Q, Sum
+from django.utils import timezone
+
+from customers.metrics import CAPTURED, add_spend
+from orders.models import Order
+from .models import Payment, PaymentWebhook, Refund
+
+
+logger = logging.getLogger('xcommerce')
+
+
+class WebhookError(Exception):
+    """
+    Raised for a webhook request that must be rejected
+    """
+
+
+def sign(body, secret=None):
+    """HMAC-SHA256 signature of a webhook body, as sent in ``X-Webhook-Signature``"""
+    secret = settings.PAYMENT_WEBHOOK_SECRET if secret is None else secret
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def verify_signature(body, signature):
+    if not settings.PAYMENT_WEBHOOK_SECRET:
+        if settings.DEBUG:
+            return
+        raise WebhookError('Webhook secret is not configured')
+    if not hmac.compare_digest(sign(body), signature or ''):
+        raise WebhookError('Invalid signature')
+
+
+def parse_event(provider, body):
+    """
+    Build an unsaved ``PaymentWebhook`` from a request body
+
+    Events are JSON objects with ``id``, ``type`` and a ``data`` object, which
+    names the order in ``data.order_number`` where there is one.
+    """
+    try:
+        event = json.loads(body)
+        webhook_id, event_type = str(event['id']), str(event['type'])
+        data = event.get('data') or {}
+        order_number = str(data.get('order_number') or '') if isinstance(data, dict) else ''
+    except (ValueError, TypeError, KeyError):
+        raise WebhookError('Malformed event')
+    if not webhook_id or len(webhook_id) > 255 or len(event_type) > 50 or len(order_number) > 50:
+        raise WebhookError('Malformed event')
+    return PaymentWebhook(
+        webhook_id=webhook_id,
+        provider=provider,
+        event_type=event_type,
+        data=event,
+        order_number=order_number,
+    )
+
+
+def ingest(provider, body, signature):
+    """
+    Verify and store one webhook
+
+    Repeats of a stored ``webhook_id`` are dropped by the database
+    (ON CONFLICT DO NOTHING), in the same single INSERT.
+    """
+    verify_signature(body, signature)
+    PaymentWebhook.objects.bulk_create([parse_event(provider, body)], ignore_conflicts=True)
+
+
+def get_payment(data, order):
+    """The payment an event is about, recording it if it is new"""
+    if order is None:
+        raise Order.DoesNotExist(f'No order {data.get("order_number")!r}')
+    payment, created = Payment.objects.get_or_create(
+        transaction_id=data['transaction_id'],
+        defaults={
+            'order': order,
+            'customer_id': order.customer_id,
+            'amount': Decimal(str(data.get('amount', order.total_amount))),
+            'currency': data.get('currency', 'USD'),
+            'gateway_transaction_id': data['transaction_id'],
+            'gateway_response': data,
+        },
+    )
+    return payment
+
+
+def payment_succeeded(webhook, data, order):
+    payment = get_payment(data, order)
+    # A payment counts towards the customer's spend once, when it first succeeds
+    if Payment.objects.filter(pk=payment.pk).exclude(status__in=CAPTURED).update(
+        status='completed', processed_at=timezone.now(), failure_reason=''
+    ):
+        add_spend(order.pk, payment.amount)
+    Order.objects.filter(pk=order.pk, payment_status__in=['pending', 'failed']).update(payment_status='paid')
+
+
+def payment_failed(webhook, data, order):
+    payment = get_payment(data, order)
+    # A late failure for an attempt that was since paid changes nothing
+    Payment.objects.filter(pk=payment.pk, status__in=['pending', 'processing']).update(
+        status='failed', processed_at=timezone.now(), failure_reason=data.get('reason', '')
+    )
+    Order.objects.filter(pk=order.pk, payment_status='pending').update(payment_status='failed')
+
+
+def refund_created(webhook, data, order):
+    payment = Payment.objects.select_related('order').get(transaction_id=data['transaction_id'])
+    refund, created = Refund.objects.get_or_create(
+        gateway_refund_id=data['refund_id'],
+        defaults={
+            'original_payment': payment,
+            'order': payment.order,
+            'amount': Decimal(str(data['amount'])),
+            'reason': data.get('reason', ''),
+            'gateway_response': data,
+        },
+    )
+    if Refund.objects.filter(pk=refund.pk).exclude(status='completed').update(
+        status='completed', processed_at=timezone.now()
+    ):
+        add_spend(payment.order_id, -refund.amount)
+    refunded = payment.refunds.filter(status='completed').aggregate(total=Sum('amount'))['total'] or 0
+    Order.objects.filter(pk=payment.order_id).update(
+        payment_status='refunded' if refunded >= payment.amount else 'partially_refunded'
+    )
+
+
+HANDLERS = {
+    'payment.succeeded': payment_succeeded,
+    'payment.failed': payment_failed,
+    'refund.created': refund_created,
+}
+
+
+def retry_delay(attempts):
+    """Seconds to wait after an event has failed ``attempts`` times"""
+    return settings.PAYMENT_WEBHOOK_RETRY_DELAY * 2 ** (attempts - 1)
+
+
+def due_webhooks(now):
+    """Pending events that are due and not queued behind an event waiting for a retry"""
+    waiting = PaymentWebhook.objects.filter(
+        order_number=OuterRef('order_number'), pk__lt=OuterRef('pk'), status='pending', next_attempt_at__gt=now
+    )
+    return (
+        PaymentWebhook.objects
+        .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now), status='pending')
+        .filter(Q(order_number='') | ~Exists(waiting))
+        .order_by('pk')
+    )
+
+
+def handle(webhook, order, now):
+    """Run one event's handler and record the outcome on ``webhook``; returns whether it succeeded"""
+    handler = HANDLERS.get(webhook.event_type)
+    webhook.attempts += 1
+    webhook.updated_at = timezone.now()
+    if handler is None:
+        webhook.status = 'ignored'
+        return True
+    try:
+        with transaction.atomic():
+            handler(webhook, webhook.data.get('data') or {}, order)
+    except Exception as e:
+        logger.warning('Payment webhook %s failed (attempt %d)', webhook.webhook_id, webhook.attempts, exc_info=True)
+        webhook.error_message = f'{e.__class__.__name__}: {e}'
+        if webhook.attempts >= settings.PAYMENT_WEBHOOK_MAX_ATTEMPTS:
+            webhook.status = 'failed'
+            return True
+        webhook.next_attempt_at = now + timedelta(seconds=retry_delay(webhook.attempts))
+        return False
+    webhook.status = 'processed'
+    webhook.processed_at = webhook.updated_at
+    webhook.error_message = ''
+    return True
+
+
+def process_batch(batch_size=None, now=None):
+    """
+    Process up to ``batch_size`` due webhooks; returns how many were handled
+
+    Events for one order are handled in ``pk`` order. An order's remaining
+    events are left for a later batch when one of them is waiting for a retry,
+    or when an earlier one is held by another worker.
+    """
+    batch_size = batch_size or settings.PAYMENT_WEBHOOK_BATCH_SIZE
+    now = now or timezone.now()
+    with transaction.atomic():
+        webhooks = due_webhooks(now)
+        if connection.features.has_select_for_update_skip_locked:
+            webhooks = webhooks.select_for_update(skip_locked=True)
+        webhooks = list(webhooks[:batch_size])
+
+        order_numbers = {webhook.order_number for webhook in webhooks if webhook.order_number}
+        orders = Order.objects.in_bulk(order_numbers, field_name='order_number') if order_numbers else {}
+
+        # Earlier events skipped because another worker has them locked
+        held = {}
+        if order_numbers:
+            for order_number, pk in (
+                PaymentWebhook.objects
+                .filter(status='pending', order_number__in=order_numbers, pk__lt=webhooks[-1].pk)
+                .exclude(pk__in=[webhook.pk for webhook in webhooks])
+                .values_list('order_number', 'pk')
+            ):
+                held[order_number] = min(pk, held.get(order_number, pk))
+
+        handled = []
+        for webhook in webhooks:
+            if webhook.order_number and webhook.pk > held.get(webhook.order_number, webhook.pk):
+                continue
+            handled.append(webhook)
+            if not handle(webhook, orders.get(webhook.order_number), now) and webhook.order_number:
+                held[webhook.order_number] = webhook.pk
+
+        if handled:
+            PaymentWebhook.objects.bulk_update(handled, [
+                'status', 'attempts', 'error_message', 'processed_at', 'next_attempt_at', 'updated_at',
+            ])
+    return len(handled)
+
+
+def drain(time_limit=None):
+    """
+    Process batches until nothing is due or ``time_limit`` seconds have passed
+
+    Returns how many webhooks were handled.
+    """
+    started = time.monotonic()
+    handled = 0
+    while True:
+        count = process_batch()
+        handled += count
+        if not count or (time_limit and time.monotonic() - started > time_limit):
+            return handled
@@ -2,8 +2,11 @@ from django.contrib import admin
 from django.utils.html import format_html
 from .models import (
     Product, ProductImage, ProductVariant, 
-    ProductAttribute, ProductAttributeValue, ProductVariantAttribute
+    ProductAttribute, ProductAttributeValue, ProductVariantAttribute,
+    StockReservation
 )
+from .flash import disable_flash, enable_flash
+from .inventory import release_reservations
 
 
 class ProductImageInline(admin.TabularInline):
@@ -18,18 +21,42 @@ class ProductVariantInline(admin.TabularInline):
     fields = ['name', 'sku', 'price', 'stock_quantity', 'is_active']
 
 
+class FlashSaleAdminMixin:
+    """
+    Actions switching products or variants in and out of flash mode
+    """
+    actions = ['start_flash_sale', 'end_flash_sale']
+    
+    def get_readonly_fields(self, request, obj=None):
+        fields = super().get_readonly_fields(request, obj)
+        # The counters own the stock during a flash sale
+        if obj and obj.flash_sale:
+            fields = [*fields, 'stock_quantity']
+        return fields
+    
+    @admin.action(description='Start flash sale')
+    def start_flash_sale(self, request, queryset):
+        for obj in queryset:
+            enable_flash(obj)
+    
+    @admin.action(description='End flash sale')
+    def end_flash_sale(self, request, queryset):
+        for obj in queryset:
+            disable_flash(obj)
+
+
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(FlashSaleAdminMixin, admin.ModelAdmin):
     list_display = [
         'name', 'category', 'price', 'status', 'stock_quantity', 
         'is_featured', 'sales_count', 'created_at'
     ]
     list_filter = [
         'status', 'is_featured', 'requires_shipping', 'is_digital',
-        'category', 'created_at'
+        'flash_sale', 'category', 'created_at'
     ]
     search_fields = ['name', 'description', 'sku']
-    readonly_fields = ['created_at', 'updated_at', 'view_count', 'sales_count']
+    readonly_fields = ['created_at', 'updated_at', 'view_count', 'sales_count', 'flash_sale']
     prepopulated_fields = {'slug': ('name',)}
     inlines = [ProductImageInline, ProductVariantInline]
     
@@ -46,7 +73,7 @@ class ProductAdmin(admin.ModelAdmin):
         ('Inventory', {
             'fields': (
                 'sku', 'barcode', 'track_inventory', 'stock_quantity', 
-                'low_stock_threshold'
+                'low_stock_threshold', 'flash_sale'
             ),
             'classes': ('collapse',)
         }),
@@ -95,14 +122,32 @@ class ProductImageAdmin(admin.ModelAdmin):
 
 
 @admin.register(ProductVariant)
-class ProductVariantAdmin(admin.ModelAdmin):
+class ProductVariantAdmin(FlashSaleAdminMixin, admin.ModelAdmin):
     list_display = [
         'product', 'name', 'sku', 'effective_price', 'stock_quantity', 
-        'is_active', 'created_at'
+        'flash_sale', 'is_active', 'created_at'
     ]
-    list_filter = ['is_active', 'created_at']
+    list_filter = ['is_active', 'flash_sale', 'created_at']
     search_fields = ['product__name', 'name', 'sku']
-    readonly_fields = ['created_at', 'updated_at']
+    readonly_fields = ['created_at', 'updated_at', 'flash_sale']
+
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ['reference', 'product', 'variant', 'quantity', 'expires_at', 'created_at']
+    list_filter = ['expires_at']
+    search_fields = ['reference', 'product__name']
+    readonly_fields = ['reference', 'product', 'variant', 'quantity', 'expires_at', 'created_at']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def delete_model(self, request, obj):
+        # Deleting a hold hands its stock back
+        release_reservations(StockReservation.objects.filter(pk=obj.pk))
+    
+    def delete_queryset(self, request, queryset):
+        release_reservations(queryset)
 
 
 @admin.register(ProductAttribute)
@@ -0,0 +1,104 @@
+"""
+Product cards rendered once and cached.
+
+Listing pages render their product cards with ``render_cards``. It looks up
+the cards of the whole page in one ``cache.get_many`` and renders only the
+ones that missed. Primary images are then fetched for those products alone.
+
+A card's key holds everything its markup depends on:
+
+- a hash of the card template, so a deploy that changes it starts afresh;
+- the product id and its ``updated_at``, which every ``Product.save()``
+  moves, and which the image and variant signals touch as well;
+- a hash of the fields the cards render, and of the category when it was
+  loaded with the product, because ``update()`` calls and category edits
+  do not move ``updated_at``;
+- whether the product is in stock, as stock changes are written with
+  ``update()`` too.
+
+Stale cards are therefore never looked up again. They expire after
+PRODUCT_CARD_CACHE_TIMEOUT instead of being deleted.
+"""
+import hashlib
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import prefetch_related_objects
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+from .models import Product
+
+
+CARD_FIELDS = ('name', 'slug', 'short_description', 'price', 'compare_at_price', 'is_featured', 'primary_image_id')
+
+class CardStats:
+    """
+    Card cache hits and misses in this process
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def reset(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+
+stats = CardStats()
+
+
+@lru_cache(maxsize=None)
+def template_version(template_name):
+    source = get_template(template_name).template.source
+    return hashlib.md5(source.encode(), usedforsecurity=False).hexdigest()[:8]
+
+
+def card_fields(product):
+    """Hash of the values the cards show, wherever they were written from"""
+    values = [getattr(product, field) for field in CARD_FIELDS]
+    if Product.category.is_cached(product) and product.category is not None:
+        values += [product.category.name, product.category.updated_at]
+    return hashlib.md5(repr(values).encode(), usedforsecurity=False).hexdigest()[:12]
+
+
+def card_key(template_name, product):
+    version = int(product.updated_at.timestamp() * 1000000)
+    return (
+        f'product_card:{template_name}:{template_version(template_name)}:'
+        f'{product.pk}:{version}:{card_fields(product)}:{int(product.is_in_stock)}'
+    )
+
+
+def render_cards(products, template_name):
+    """The rendered card of each product, in order"""
+    products = list(products)
+    if not products:
+        return []
+    keys = [card_key(template_name, product) for product in products]
+    cards = cache.get_many(keys)
+
+    missing = [(key, product) for key, product in zip(keys, products) if key not in cards]
+    if missing:
+        prefetch_related_objects([product for key, product in missing], 'primary_image')
+        template = get_template(template_name)
+        rendered = {key: template.render({'product': product}) for key, product in missing}
+        cache.set_many(rendered, settings.PRODUCT_CARD_CACHE_TIMEOUT)
+        cards.update(rendered)
+    stats.record(len(products) - len(missing), len(missing))
+
+    return [mark_safe(cards[key]) for key in keys]
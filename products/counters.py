@@ -0,0 +1,241 @@
+"""
+Write-behind counters for ``Product.view_count`` and ``Product.sales_count``.
+
+Page views and sales do not touch the product row. They add to a buffer, and
+the buffer is flushed in batches: one bulk UPDATE per few hundred products,
+taking row locks in primary key order. A flash sale on one product then costs
+a row lock per flush instead of one per request.
+
+``RedisCounterBuffer`` keeps the pending increments in a Redis hash shared by
+every worker. The ``flush_product_counters`` Celery task drains it on the beat
+schedule. ``LocalCounterBuffer`` is used when Redis is not the cache. It keeps
+the increments in sharded in-process dicts, and each process flushes its own
+buffer every ``PRODUCT_COUNTER_FLUSH_INTERVAL`` seconds while it handles
+requests, and again at exit.
+
+Either way, the columns used by ``sort=popular`` and ``sort=rating`` lag by
+at most one flush interval.
+
+A Redis batch is renamed aside and given an id before it is written. The id is
+recorded as an ``AppliedBatch`` in the transaction that writes the batch. If a
+flush dies after that commit but before the batch is deleted, the next flush
+finds the id recorded and only deletes the batch, so nothing counts twice.
+"""
+import atexit
+import logging
+import threading
+import time
+import uuid
+from datetime import timedelta
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import Case, F, PositiveIntegerField, Value, When
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import AppliedBatch, Product
+
+
+COUNTER_FIELDS = ('view_count', 'sales_count')
+FLUSH_BATCH_SIZE = 500
+BATCH_FIELD = 'batch'
+BATCH_RETENTION = timedelta(days=7)
+
+logger = logging.getLogger('xcommerce')
+
+
+def flush_interval():
+    return getattr(settings, 'PRODUCT_COUNTER_FLUSH_INTERVAL', 10)
+
+
+def claim_batch(batch_id):
+    """
+    Record ``batch_id`` as applied in the current transaction
+
+    Returns False, recording nothing, if it already was.
+    """
+    AppliedBatch.objects.filter(applied_at__lt=timezone.now() - BATCH_RETENTION).delete()
+    try:
+        with transaction.atomic():
+            AppliedBatch.objects.create(batch_id=batch_id)
+    except IntegrityError:
+        return False
+    return True
+
+
+def apply_deltas(deltas, batch_id=None):
+    """
+    Add ``{(product_id, field): amount}`` to the product rows
+
+    With a ``batch_id``, a batch already applied is skipped. Returns the
+    number of products updated.
+    """
+    by_product = {}
+    for (product_id, field), amount in deltas.items():
+        if amount and field in COUNTER_FIELDS:
+            by_product.setdefault(product_id, {})[field] = amount
+
+    # One transaction, so a failed flush can be retried without double counting
+    product_ids = sorted(by_product)
+    updated = 0
+    with transaction.atomic():
+        if batch_id and not claim_batch(batch_id):
+            return 0
+        for start in range(0, len(product_ids), FLUSH_BATCH_SIZE):
+            chunk = product_ids[start:start + FLUSH_BATCH_SIZE]
+            updates = {}
+            for field in COUNTER_FIELDS:
+                whens = [
+                    When(pk=product_id, then=F(field) + Value(by_product[product_id][field]))
+                    for product_id in chunk if field in by_product[product_id]
+                ]
+                if whens:
+                    updates[field] = Case(*whens, default=F(field), output_field=PositiveIntegerField())
+            updated += Product.objects.filter(pk__in=chunk).update(**updates)
+    return updated
+
+
+class BaseCounterBuffer:
+    """
+    Interface shared by the counter buffers
+    """
+
+    def incr(self, product_id, field, amount=1):
+        """Buffer an increment of ``field`` on one product"""
+        raise NotImplementedError
+
+    def flush(self):
+        """Write the buffered increments and return the number of products updated"""
+        raise NotImplementedError
+
+
+class RedisCounterBuffer(BaseCounterBuffer):
+    """
+    Increments held in a Redis hash, drained by the Celery beat task
+    """
+    key = 'product_counters'
+    lock_timeout = 300
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+
+    @property
+    def client(self):
+        from django_redis import get_redis_connection
+        return get_redis_connection(self.alias)
+
+    @property
+    def flushing_key(self):
+        return f'{self.key}:flushing'
+
+    def incr(self, product_id, field, amount=1):
+        self.client.hincrby(self.key, f'{product_id}:{field}', amount)
+
+    def flush(self):
+        from redis.exceptions import ResponseError
+
+        if not cache.add(f'{self.key}:flush_lock', 1, self.lock_timeout):
+            return 0
+        try:
+            client = self.client
+            # A leftover batch means the last flush died before finishing; retry it first
+            if not client.exists(self.flushing_key):
+                try:
+                    client.rename(self.key, self.flushing_key)
+                except ResponseError:
+                    return 0
+
+            # Kept across retries of this batch, so it is applied at most once
+            client.hsetnx(self.flushing_key, BATCH_FIELD, uuid.uuid4().hex)
+
+            deltas, batch_id = {}, None
+            for name, amount in client.hgetall(self.flushing_key).items():
+                name = name.decode()
+                if name == BATCH_FIELD:
+                    batch_id = amount.decode()
+                    continue
+                product_id, field = name.split(':', 1)
+                deltas[(int(product_id), field)] = int(amount)
+
+            updated = apply_deltas(deltas, batch_id)
+            client.delete(self.flushing_key)
+            return updated
+        finally:
+            cache.delete(f'{self.key}:flush_lock')
+
+
+class LocalCounterBuffer(BaseCounterBuffer):
+    """
+    Increments held in this process, split over locked shards
+
+    Requests on different products rarely wait on the same shard lock.
+    """
+    shard_count = 16
+
+    def __init__(self):
+        self._locks = [threading.Lock() for _ in range(self.shard_count)]
+        self._counts = [{} for _ in range(self.shard_count)]
+        self._flush_lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+        atexit.register(self.flush)
+
+    def incr(self, product_id, field, amount=1):
+        self._add(product_id, field, amount)
+        if time.monotonic() - self._flushed_at >= flush_interval():
+            self.flush(blocking=False)
+
+    def _add(self, product_id, field, amount):
+        shard = product_id % self.shard_count
+        key = (product_id, field)
+        with self._locks[shard]:
+            counts = self._counts[shard]
+            counts[key] = counts.get(key, 0) + amount
+
+    def _drain(self):
+        deltas = {}
+        for shard, lock in enumerate(self._locks):
+            with lock:
+                counts, self._counts[shard] = self._counts[shard], {}
+            deltas.update(counts)
+        return deltas
+
+    def flush(self, blocking=True):
+        if not self._flush_lock.acquire(blocking=blocking):
+            return 0
+        try:
+            self._flushed_at = time.monotonic()
+            deltas = self._drain()
+            if not deltas:
+                return 0
+            try:
+                return apply_deltas(deltas)
+            except DatabaseError:
+                logger.exception('Failed to flush %d product counters; keeping them for the next flush', len(deltas))
+                for (product_id, field), amount in deltas.items():
+                    self._add(product_id, field, amount)
+                return 0
+        finally:
+            self._flush_lock.release()
+
+
+@lru_cache(maxsize=None)
+def get_counter_buffer():
+    """Return the configured counter buffer, using Redis when it is the cache backend"""
+    backend_path = getattr(settings, 'PRODUCT_COUNTER_BACKEND', '')
+    if backend_path:
+        return import_string(backend_path)()
+    if settings.CACHES['default']['BACKEND'].startswith('django_redis.'):
+        return RedisCounterBuffer()
+    return LocalCounterBuffer()
+
+
+def record_view(product_id):
+    get_counter_buffer().incr(product_id, 'view_count')
+
+
+def record_sale(product_id, quantity=1):
+    get_counter_buffer().incr(product_id, 'sales_count', quantity)
+
@@ -0,0 +1,381 @@
+"""
+Facet counts for the product catalog.
+
+Each facet value (a category, a price bucket, an attribute value, in stock,
+featured) owns a bitmap of active product ids, held as a Python int with bit
+``n`` set for product ``n``. Counting "Red (124)" for any filter combination
+is then a handful of ANDs and popcounts in memory instead of one GROUP BY
+query per facet.
+
+Counts follow the usual disjunctive rules. Values inside a facet are ORed,
+facets are ANDed, and each facet's counts ignore that facet's own selection,
+so picking "Red" still shows how many products are "Blue".
+
+Product saves refresh a product's bits through the change log. Stock also
+moves through bulk UPDATEs in ``products.inventory`` and ``products.flash``;
+those call ``record_stock_changes`` so the in-stock bitmap follows products
+whose stock crosses zero.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Q
+
+from core.local_index import ProcessLocalIndex
+from .models import Product, ProductVariantAttribute
+
+
+if hasattr(int, 'bit_count'):
+    popcount = int.bit_count
+else:
+    def popcount(bitmap):
+        return bin(bitmap).count('1')
+
+
+def to_bitmap(ids):
+    """Build a bitmap from an iterable of product ids"""
+    ids = list(ids)
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for product_id in ids:
+        buffer[product_id >> 3] |= 1 << (product_id & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+def price_buckets():
+    """Return ``(key, label, low, high)`` for each configured price bucket"""
+    bounds = [Decimal(str(bound)) for bound in getattr(settings, 'CATALOG_PRICE_BUCKETS', [25, 50, 100, 200])]
+    buckets = []
+    low = None
+    for high in bounds + [None]:
+        if low is None:
+            key, label = f'0-{high}', f'Under ${high}'
+        elif high is None:
+            key, label = f'{low}-', f'${low} & Above'
+        else:
+            key, label = f'{low}-{high}', f'${low} - ${high}'
+        buckets.append((key, label, low, high))
+        low = high
+    return buckets
+
+
+def bucket_for_price(price):
+    """Return the key of the price bucket containing ``price``"""
+    for key, label, low, high in price_buckets():
+        if (low is None or price >= low) and (high is None or price < high):
+            return key
+    return None
+
+
+class FacetSelection:
+    """
+    Facet values picked in the catalog query string
+    """
+
+    def __init__(self, price=(), attributes=(), in_stock=False, featured=False):
+        self.price = set(price)
+        self.attributes = set(attributes)
+        self.in_stock = in_stock
+        self.featured = featured
+
+    @classmethod
+    def from_querydict(cls, data):
+        valid_buckets = {key for key, label, low, high in price_buckets()}
+        attributes = set()
+        for value in data.getlist('attr'):
+            try:
+                attributes.add(int(value))
+            except ValueError:
+                pass
+        return cls(
+            price=[key for key in data.getlist('price') if key in valid_buckets],
+            attributes=attributes,
+            in_stock=data.get('in_stock') == '1',
+            featured=data.get('featured') == '1',
+        )
+
+    @property
+    def is_empty(self):
+        return not (self.price or self.attributes or self.in_stock or self.featured)
+
+    def filter_queryset(self, queryset):
+        """Apply the selection to a Product queryset"""
+        if self.price:
+            condition = Q()
+            for key, label, low, high in price_buckets():
+                if key in self.price:
+                    bucket = Q()
+                    if low is not None:
+                        bucket &= Q(price__gte=low)
+                    if high is not None:
+                        bucket &= Q(price__lt=high)
+                    condition |= bucket
+            queryset = queryset.filter(condition)
+
+        if self.attributes:
+            links = ProductVariantAttribute.objects.filter(
+                value_id__in=self.attributes, variant__is_active=True
+            ).values_list('attribute_id', 'value_id')
+            by_attribute = {}
+            for attribute_id, value_id in links.distinct():
+                by_attribute.setdefault(attribute_id, set()).add(value_id)
+            for value_ids in by_attribute.values():
+                queryset = queryset.filter(pk__in=ProductVariantAttribute.objects.filter(
+                    value_id__in=value_ids, variant__is_active=True
+                ).values('variant__product_id'))
+
+        if self.in_stock:
+            queryset = queryset.filter(Q(track_inventory=False) | Q(stock_quantity__gt=0))
+
+        if self.featured:
+            queryset = queryset.filter(is_featured=True)
+
+        return queryset
+
+
+class FacetIndex(ProcessLocalIndex):
+    """
+    Bitmaps of active product ids for every facet value
+    """
+    name = 'product_facets'
+
+    def __init__(self):
+        super().__init__()
+        self._reset()
+
+    def _reset(self):
+        self.all = 0
+        self.categories = {}
+        self.price = {}
+        self.attributes = {}
+        self.value_attribute = {}
+        self.in_stock = 0
+        self.featured = 0
+        # Products sorted by (price, id), for min/max price filters
+        self.sorted_prices = array('d')
+        self.sorted_ids = array('q')
+        # The same products sorted by id, to find their place in the above
+        self.ids = array('q')
+        self.prices = array('d')
+        self._range_cache = {}
+
+    def build(self):
+        products = Product.objects.filter(status='active').values_list(
+            'id', 'category_id', 'price', 'is_featured', 'track_inventory', 'stock_quantity'
+        )
+        members = {'all': [], 'in_stock': [], 'featured': []}
+        categories = {}
+        price = {}
+        priced = []
+        for product_id, category_id, product_price, featured, track_inventory, stock in products.iterator():
+            members['all'].append(product_id)
+            if category_id:
+                categories.setdefault(category_id, []).append(product_id)
+            price.setdefault(bucket_for_price(product_price), []).append(product_id)
+            priced.append((float(product_price), product_id))
+            if featured:
+                members['featured'].append(product_id)
+            if not track_inventory or stock > 0:
+                members['in_stock'].append(product_id)
+
+        extra_categories = Product.categories.through.objects.filter(
+            product__status='active'
+        ).values_list('product_id', 'category_id')
+        for product_id, category_id in extra_categories.iterator():
+            categories.setdefault(category_id, []).append(product_id)
+
+        attributes = {}
+        value_attribute = {}
+        links = ProductVariantAttribute.objects.filter(
+            variant__is_active=True, variant__product__status='active'
+        ).values_list('variant__product_id', 'attribute_id', 'value_id')
+        for product_id, attribute_id, value_id in links.iterator():
+            attributes.setdefault(value_id, []).append(product_id)
+            value_attribute[value_id] = attribute_id
+
+        self._reset()
+        self.all = to_bitmap(members['all'])
+        self.in_stock = to_bitmap(members['in_stock'])
+        self.featured = to_bitmap(members['featured'])
+        self.categories = {key: to_bitmap(ids) for key, ids in categories.items()}
+        self.price = {key: to_bitmap(ids) for key, ids in price.items()}
+        self.attributes = {key: to_bitmap(ids) for key, ids in attributes.items()}
+        self.value_attribute = value_attribute
+        priced.sort()
+        self.sorted_prices = array('d', (p for p, product_id in priced))
+        self.sorted_ids = array('q', (product_id for p, product_id in priced))
+        priced.sort(key=lambda entry: entry[1])
+        self.ids = array('q', (product_id for p, product_id in priced))
+        self.prices = array('d', (p for p, product_id in priced))
+
+    def apply_changes(self, product_ids):
+        product_ids = set(product_ids)
+        self._range_cache = {}
+        self._remove(product_ids)
+
+        products = Product.objects.filter(pk__in=product_ids, status='active').prefetch_related('categories')
+        links = ProductVariantAttribute.objects.filter(
+            variant__product_id__in=product_ids, variant__is_active=True
+        ).values_list('variant__product_id', 'attribute_id', 'value_id')
+        values_by_product = {}
+        for product_id, attribute_id, value_id in links:
+            values_by_product.setdefault(product_id, set()).add((attribute_id, value_id))
+
+        for product in products:
+            bit = 1 << product.pk
+            self.all |= bit
+            category_ids = {category.pk for category in product.categories.all()}
+            if product.category_id:
+                category_ids.add(product.category_id)
+            for category_id in category_ids:
+                self.categories[category_id] = self.categories.get(category_id, 0) | bit
+            bucket = bucket_for_price(product.price)
+            self.price[bucket] = self.price.get(bucket, 0) | bit
+            for attribute_id, value_id in values_by_product.get(product.pk, ()):
+                self.attributes[value_id] = self.attributes.get(value_id, 0) | bit
+                self.value_attribute[value_id] = attribute_id
+            if product.is_in_stock:
+                self.in_stock |= bit
+            if product.is_featured:
+                self.featured |= bit
+
+            product_price = float(product.price)
+            index = bisect_left(self.ids, product.pk)
+            self.ids.insert(index, product.pk)
+            self.prices.insert(index, product_price)
+            position = self._price_position(product.pk, product_price)
+            self.sorted_prices.insert(position, product_price)
+            self.sorted_ids.insert(position, product.pk)
+
+    def _price_position(self, product_id, price):
+        """Where ``(price, product_id)`` sits in the price-sorted arrays"""
+        start = bisect_left(self.sorted_prices, price)
+        end = bisect_right(self.sorted_prices, price, start)
+        return bisect_left(self.sorted_ids, product_id, start, end)
+
+    def _remove(self, product_ids):
+        """Take products out of every bitmap, in one pass over the bitmaps for the whole batch"""
+        mask = to_bitmap(product_ids)
+        if not self.all & mask:
+            return
+        keep = ~mask
+        self.all &= keep
+        for bitmaps in (self.categories, self.price, self.attributes):
+            for key, bitmap in list(bitmaps.items()):
+                if bitmap & mask:
+                    bitmap &= keep
+                    if bitmap:
+                        bitmaps[key] = bitmap
+                    else:
+                        # As after a build, values left with no products are not listed
+                        del bitmaps[key]
+        self.in_stock &= keep
+        self.featured &= keep
+
+        for product_id in product_ids:
+            index = bisect_left(self.ids, product_id)
+            if index == len(self.ids) or self.ids[index] != product_id:
+                continue
+            position = self._price_position(product_id, self.prices[index])
+            del self.ids[index]
+            del self.prices[index]
+            del self.sorted_prices[position]
+            del self.sorted_ids[position]
+
+    def price_range(self, min_price=None, max_price=None):
+        """Bitmap of products priced within ``[min_price, max_price]``"""
+        key = (min_price, max_price)
+        if key not in self._range_cache:
+            start = 0 if min_price is None else bisect_left(self.sorted_prices, float(min_price))
+            end = len(self.sorted_prices) if max_price is None else bisect_right(self.sorted_prices, float(max_price))
+            if len(self._range_cache) > 32:
+                self._range_cache = {}
+            self._range_cache[key] = to_bitmap(self.sorted_ids[start:end])
+        return self._range_cache[key]
+
+    def counts(self, selection, category_id=None, min_price=None, max_price=None, restrict_ids=None):
+        """
+        Count matching products per facet value
+
+        ``restrict_ids`` limits counting to a set of product ids, such as the
+        results of a text search.
+        """
+        self.ensure_ready()
+        with self._lock:
+            return self._counts(selection, category_id, min_price, max_price, restrict_ids)
+
+    def _counts(self, selection, category_id, min_price, max_price, restrict_ids):
+        base = self.all
+        if restrict_ids is not None:
+            base &= to_bitmap(restrict_ids)
+        if min_price is not None or max_price is not None:
+            base &= self.price_range(min_price, max_price)
+
+        category = self.categories.get(category_id, 0) if category_id else None
+        price = None
+        if selection.price:
+            price = 0
+            for key in selection.price:
+                price |= self.price.get(key, 0)
+        attribute_groups = {}
+        for value_id in selection.attributes:
+            attribute_id = self.value_attribute.get(value_id)
+            attribute_groups[attribute_id] = attribute_groups.get(attribute_id, 0) | self.attributes.get(value_id, 0)
+        in_stock = self.in_stock if selection.in_stock else None
+        featured = self.featured if selection.featured else None
+
+        def narrowed(*skip):
+            bitmap = base
+            constraints = [('category', category), ('price', price), ('in_stock', in_stock), ('featured', featured)]
+            constraints += [(('attribute', attribute_id), group) for attribute_id, group in attribute_groups.items()]
+            for name, constraint in constraints:
+                if constraint is not None and name not in skip:
+                    bitmap &= constraint
+            return bitmap
+
+        without_category = narrowed('category')
+        without_price = narrowed('price')
+        matching = narrowed()
+
+        without_attribute = {}
+        attributes = {}
+        for value_id, bitmap in self.attributes.items():
+            attribute_id = self.value_attribute[value_id]
+            if attribute_id not in without_attribute:
+                without_attribute[attribute_id] = narrowed(('attribute', attribute_id))
+            count = popcount(bitmap & without_attribute[attribute_id])
+            if count:
+                attributes[value_id] = count
+
+        return {
+            'total': popcount(matching),
+            'categories': {
+                key: count for key, count in (
+                    (key, popcount(bitmap & without_category)) for key, bitmap in self.categories.items()
+                ) if count
+            },
+            'price': {key: popcount(bitmap & without_price) for key, bitmap in self.price.items()},
+            'attributes': attributes,
+            'in_stock': popcount(self.in_stock & narrowed('in_stock')),
+            'featured': popcount(self.featured & narrowed('featured')),
+        }
+
+
+facet_index = FacetIndex()
+
+
+def record_stock_changes(model, deltas):
+    """
+    Refresh the in-stock bit of products whose stock just crossed zero
+
+    ``deltas`` maps primary keys to the change just applied to their
+    ``stock_quantity``. Variant stock does not feed the facet.
+    """
+    if model is not Product or not deltas:
+        return
+    for product_id, stock in Product.objects.filter(pk__in=list(deltas)).values_list('pk', 'stock_quantity'):
+        if (stock > 0) != (stock - deltas[product_id] > 0):
+            facet_index.record_change(product_id)
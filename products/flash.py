@@ -0,0 +1,530 @@
+"""
+Flash mode: sell hot products and variants from sharded counters.
+
+A conditional UPDATE never oversells, but every buyer of the same product
+waits on that one row lock. Flash mode takes the row off the checkout path.
+``enable_flash`` copies the row's stock into ``FLASH_STOCK_SHARDS`` counters.
+Checkout then takes stock from a random shard, moving to the next one when a
+shard runs dry, and never touches the row. The sold quantities are written
+back to ``stock_quantity`` in batches by the ``reconcile_flash_stock`` task.
+
+Each take is pending until the order's transaction commits. A take whose
+order rolled back is never confirmed, and goes back on sale after
+``FLASH_STOCK_PENDING_TIMEOUT`` seconds. While flash mode is on,
+``stock_quantity`` equals the counters' stock plus pending takes plus sales
+not yet reconciled.
+
+Reconciling moves sales into ``flushing`` counters and notes what it is about
+to write in a journal in the cache, under a batch id. The id is recorded in
+the transaction that writes the rows. A reconcile that dies after that commit
+leaves the journal behind. The next one then clears the flushing counters
+without writing the batch again, so stock is never taken off twice.
+
+``RedisFlashStock`` keeps the counters in Redis. Each take, confirmation and
+release is one Lua script on one shard. Each shard's keys share a hash slot,
+so shards spread across a Redis cluster. ``LocalFlashStock`` keeps them in
+this process behind one lock per shard. It is only correct for a single
+process, and is meant for tests and development without Redis.
+"""
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils.module_loading import import_string
+
+from .counters import claim_batch
+from .facets import facet_index, record_stock_changes
+from .models import Product, ProductVariant
+
+
+MODELS = {'product': Product, 'variant': ProductVariant}
+RECONCILE_BATCH_SIZE = 500
+RECONCILE_LOCK = 'flash_stock:reconcile_lock'
+RECONCILE_JOURNAL = 'flash_stock:reconcile_journal'
+
+
+class SoldOut(Exception):
+    """
+    Raised when the counters hold less than requested
+    """
+
+
+def flash_key(obj):
+    """Counter key of a product or variant, such as ``'variant:12'``"""
+    return f"{'variant' if isinstance(obj, ProductVariant) else 'product'}:{obj.pk}"
+
+
+def pending_timeout():
+    return getattr(settings, 'FLASH_STOCK_PENDING_TIMEOUT', 60)
+
+
+class BaseFlashStock:
+    """
+    Sharded stock counters
+
+    Subclasses store, per shard, the stock on sale, the confirmed sales not
+    yet reconciled and the pending takes, plus a ``flushing`` copy of sales or
+    stock being written to the database.
+    """
+
+    def items(self):
+        """Return ``{key: shard_count}`` for every key with counters"""
+        raise NotImplementedError
+
+    def shard_count(self, key):
+        return self.items().get(key, 0)
+
+    def load(self, key, quantity, shards):
+        """Add ``quantity`` to the key's counters, spread over its shards"""
+        raise NotImplementedError
+
+    def _take(self, key, shard, quantity, token):
+        """Take up to ``quantity`` from one shard as pending, returning the amount taken"""
+        raise NotImplementedError
+
+    def _settle(self, key, shard, token, confirm):
+        """Move a pending take to sold, or back to stock"""
+        raise NotImplementedError
+
+    def take(self, key, quantity):
+        """
+        Take ``quantity`` as one pending take and return it
+
+        Raises ``SoldOut``, taking nothing, if the shards hold less than
+        ``quantity`` between them.
+        """
+        shards = self.shard_count(key)
+        token = uuid.uuid4().hex
+        taken, remaining = [], quantity
+        start = random.randrange(shards) if shards else 0
+        for offset in range(shards):
+            shard = (start + offset) % shards
+            amount = self._take(key, shard, remaining, token)
+            if amount:
+                taken.append(shard)
+                remaining -= amount
+            if not remaining:
+                return key, token, taken
+        self.release((key, token, taken))
+        raise SoldOut(key)
+
+    def confirm(self, take):
+        """Count a pending take as sold"""
+        key, token, shards = take
+        for shard in shards:
+            self._settle(key, shard, token, True)
+
+    def release(self, take):
+        """Put a pending take back on sale"""
+        key, token, shards = take
+        for shard in shards:
+            self._settle(key, shard, token, False)
+
+    def give(self, key, quantity):
+        """Put ``quantity`` back on sale"""
+        self.load(key, quantity, self.shard_count(key) or 1)
+
+    def expire(self, key, before):
+        """Put takes left pending since before ``before`` back on sale"""
+        raise NotImplementedError
+
+    def drain(self, key, field):
+        """
+        Move ``'sold'`` or ``'stock'`` into its flushing counter and return the total
+
+        The total includes anything left over from a reconcile that failed.
+        """
+        raise NotImplementedError
+
+    def drained(self, key, field):
+        """Forget the flushing counter once it is in the database"""
+        raise NotImplementedError
+
+    def has_pending(self, key):
+        raise NotImplementedError
+
+    def forget(self, key):
+        """Drop every counter of the key"""
+        raise NotImplementedError
+
+
+class RedisFlashStock(BaseFlashStock):
+    """
+    Counters in Redis, changed by Lua scripts
+    """
+    registry = 'flash_stock:items'
+
+    TAKE = """
+    local available = tonumber(redis.call('GET', KEYS[1]) or '0')
+    local taken = math.min(available, tonumber(ARGV[1]))
+    if taken > 0 then
+        redis.call('DECRBY', KEYS[1], taken)
+        redis.call('HSET', KEYS[2], ARGV[2], taken .. ':' .. ARGV[3])
+    end
+    return taken
+    """
+    SETTLE = """
+    local entry = redis.call('HGET', KEYS[1], ARGV[1])
+    if not entry then
+        return 0
+    end
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    local quantity = tonumber(string.match(entry, '^(%d+)'))
+    redis.call('INCRBY', KEYS[2], quantity)
+    return quantity
+    """
+    EXPIRE = """
+    local entries = redis.call('HGETALL', KEYS[1])
+    local released = 0
+    for i = 1, #entries, 2 do
+        local quantity, at = string.match(entries[i + 1], '^(%d+):(.+)$')
+        if tonumber(at) < tonumber(ARGV[1]) then
+            redis.call('HDEL', KEYS[1], entries[i])
+            redis.call('INCRBY', KEYS[2], tonumber(quantity))
+            released = released + tonumber(quantity)
+        end
+    end
+    return released
+    """
+    DRAIN = """
+    local amount = tonumber(redis.call('GET', KEYS[1]) or '0')
+    if amount ~= 0 then
+        redis.call('INCRBY', KEYS[2], amount)
+        redis.call('SET', KEYS[1], 0)
+    end
+    return tonumber(redis.call('GET', KEYS[2]) or '0')
+    """
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+        self._scripts = {}
+
+    @property
+    def client(self):
+        from django_redis import get_redis_connection
+        return get_redis_connection(self.alias)
+
+    def script(self, name):
+        if name not in self._scripts:
+            self._scripts[name] = self.client.register_script(getattr(self, name))
+        return self._scripts[name]
+
+    def shard_key(self, key, shard, field):
+        # The braces keep one shard's keys in one cluster hash slot
+        return f'flash_stock:{{{key}:{shard}}}:{field}'
+
+    def items(self):
+        return {name.decode(): int(shards) for name, shards in self.client.hgetall(self.registry).items()}
+
+    def shard_count(self, key):
+        shards = self.client.hget(self.registry, key)
+        return int(shards) if shards else 0
+
+    def load(self, key, quantity, shards):
+        client = self.client
+        client.hsetnx(self.registry, key, shards)
+        shards = int(client.hget(self.registry, key))
+        pipe = client.pipeline()
+        for shard in range(shards):
+            share = quantity // shards + (1 if shard < quantity % shards else 0)
+            if share:
+                pipe.incrby(self.shard_key(key, shard, 'stock'), share)
+        pipe.execute()
+
+    def _take(self, key, shard, quantity, token):
+        return int(self.script('TAKE')(
+            keys=[self.shard_key(key, shard, 'stock'), self.shard_key(key, shard, 'pending')],
+            args=[quantity, token, time.time()],
+        ))
+
+    def _settle(self, key, shard, token, confirm):
+        self.script('SETTLE')(
+            keys=[self.shard_key(key, shard, 'pending'), self.shard_key(key, shard, 'sold' if confirm else 'stock')],
+            args=[token],
+        )
+
+    def expire(self, key, before):
+        return sum(
+            int(self.script('EXPIRE')(
+                keys=[self.shard_key(key, shard, 'pending'), self.shard_key(key, shard, 'stock')], args=[before],
+            ))
+            for shard in range(self.shard_count(key))
+        )
+
+    def drain(self, key, field):
+        return sum(
+            int(self.script('DRAIN')(
+                keys=[self.shard_key(key, shard, field), self.shard_key(key, shard, f'flushing_{field}')],
+            ))
+            for shard in range(self.shard_count(key))
+        )
+
+    def drained(self, key, field):
+        keys = [self.shard_key(key, shard, f'flushing_{field}') for shard in range(self.shard_count(key))]
+        if keys:
+            # One DEL per shard, as the keys live in different hash slots
+            pipe = self.client.pipeline()
+            for name in keys:
+                pipe.delete(name)
+            pipe.execute()
+
+    def has_pending(self, key):
+        return any(self.client.hlen(self.shard_key(key, shard, 'pending')) for shard in range(self.shard_count(key)))
+
+    def forget(self, key):
+        pipe = self.client.pipeline()
+        for shard in range(self.shard_count(key)):
+            for field in ('stock', 'sold', 'pending', 'flushing_sold', 'flushing_stock'):
+                pipe.delete(self.shard_key(key, shard, field))
+        pipe.hdel(self.registry, key)
+        pipe.execute()
+
+
+class LocalFlashStock(BaseFlashStock):
+    """
+    Counters in this process, one lock per shard
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._shards = {}
+
+    def _shard(self, key, shard):
+        shards = self._shards[key]
+        return shards[shard]['lock'], shards[shard]
+
+    def items(self):
+        with self._lock:
+            return {key: len(shards) for key, shards in self._shards.items()}
+
+    def load(self, key, quantity, shards):
+        with self._lock:
+            if key not in self._shards:
+                self._shards[key] = [
+                    {
+                        'lock': threading.Lock(), 'stock': 0, 'sold': 0, 'pending': {},
+                        'flushing_sold': 0, 'flushing_stock': 0,
+                    }
+                    for _ in range(shards)
+                ]
+        shards = len(self._shards[key])
+        for shard in range(shards):
+            share = quantity // shards + (1 if shard < quantity % shards else 0)
+            lock, counters = self._shard(key, shard)
+            with lock:
+                counters['stock'] += share
+
+    def _take(self, key, shard, quantity, token):
+        lock, counters = self._shard(key, shard)
+        with lock:
+            taken = min(counters['stock'], quantity)
+            if taken > 0:
+                counters['stock'] -= taken
+                counters['pending'][token] = (taken, time.time())
+            return max(taken, 0)
+
+    def _settle(self, key, shard, token, confirm):
+        lock, counters = self._shard(key, shard)
+        with lock:
+            entry = counters['pending'].pop(token, None)
+            if entry:
+                counters['sold' if confirm else 'stock'] += entry[0]
+
+    def expire(self, key, before):
+        released = 0
+        for shard in range(self.shard_count(key)):
+            lock, counters = self._shard(key, shard)
+            with lock:
+                for token, (quantity, at) in list(counters['pending'].items()):
+                    if at < before:
+                        del counters['pending'][token]
+                        counters['stock'] += quantity
+                        released += quantity
+        return released
+
+    def drain(self, key, field):
+        total = 0
+        for shard in range(self.shard_count(key)):
+            lock, counters = self._shard(key, shard)
+            with lock:
+                counters[f'flushing_{field}'] += counters[field]
+                counters[field] = 0
+                total += counters[f'flushing_{field}']
+        return total
+
+    def drained(self, key, field):
+        for shard in range(self.shard_count(key)):
+            lock, counters = self._shard(key, shard)
+            with lock:
+                counters[f'flushing_{field}'] = 0
+
+    def has_pending(self, key):
+        return any(self._shard(key, shard)[1]['pending'] for shard in range(self.shard_count(key)))
+
+    def forget(self, key):
+        with self._lock:
+            self._shards.pop(key, None)
+
+
+@lru_cache(maxsize=None)
+def get_flash_stock():
+    """Return the configured flash counters, using Redis when it is the cache backend"""
+    backend_path = getattr(settings, 'FLASH_STOCK_BACKEND', '')
+    if backend_path:
+        return import_string(backend_path)()
+    if settings.CACHES['default']['BACKEND'].startswith('django_redis.'):
+        return RedisFlashStock()
+    return LocalFlashStock()
+
+
+@contextmanager
+def reconcile_lock(timeout=300, wait=True):
+    """Serialise reconciling with switching flash mode on and off"""
+    while not cache.add(RECONCILE_LOCK, 1, timeout):
+        if not wait:
+            yield False
+            return
+        time.sleep(0.05)
+    try:
+        yield True
+    finally:
+        cache.delete(RECONCILE_LOCK)
+
+
+def enable_flash(obj, shards=None):
+    """
+    Put a product or variant in flash mode and copy its stock to the counters
+
+    Holds on the row are released first, so all of its stock goes on sale.
+    """
+    from .inventory import release_reservations
+
+    model = type(obj)
+    with reconcile_lock():
+        with transaction.atomic():
+            row = model.objects.select_for_update().get(pk=obj.pk)
+            if row.flash_sale:
+                return
+            release_reservations(row.reservations.all())
+            row.refresh_from_db(fields=['stock_quantity'])
+            model.objects.filter(pk=row.pk).update(flash_sale=True)
+            key, stock = flash_key(row), max(row.stock_quantity, 0)
+            shards = shards or getattr(settings, 'FLASH_STOCK_SHARDS', 8)
+            # The counters only fill once the flag is committed, so a failed
+            # switch never leaves stock counted twice
+            transaction.on_commit(lambda: get_flash_stock().load(key, stock, shards))
+    obj.flash_sale = True
+
+
+def disable_flash(obj):
+    """
+    Take a product or variant out of flash mode
+
+    The row's stock becomes what is left on the counters. Takes still pending
+    are added back if their orders fail, and ignored if they succeed.
+    """
+    model = type(obj)
+    with reconcile_lock():
+        with transaction.atomic():
+            updated = model.objects.filter(pk=obj.pk, flash_sale=True).update(flash_sale=False, stock_quantity=0)
+            if updated and model is Product:
+                facet_index.record_change(obj.pk)
+        if updated:
+            _reconcile()
+    obj.flash_sale = False
+
+
+def _apply(model, deltas):
+    """Add ``{pk: delta}`` to ``stock_quantity`` in batches, in primary key order"""
+    ids = sorted(deltas)
+    for start in range(0, len(ids), RECONCILE_BATCH_SIZE):
+        chunk = ids[start:start + RECONCILE_BATCH_SIZE]
+        stock = Case(
+            *[When(pk=pk, then=F('stock_quantity') + Value(deltas[pk])) for pk in chunk],
+            default=F('stock_quantity'), output_field=IntegerField(),
+        )
+        model.objects.filter(pk__in=chunk).update(stock_quantity=stock)
+        record_stock_changes(model, {pk: deltas[pk] for pk in chunk})
+
+
+def _drain(counters):
+    """
+    Move every key's sales, or returned stock, into its flushing counters
+
+    Returns the journal of what to write, or None if there are no counters.
+    """
+    keys = list(counters.items())
+    if not keys:
+        return None
+
+    by_kind = {}
+    for key in keys:
+        kind, pk = key.split(':')
+        by_kind.setdefault(kind, []).append(int(pk))
+    active = {
+        f'{kind}:{pk}'
+        for kind, ids in by_kind.items()
+        for pk in MODELS[kind].objects.filter(pk__in=ids, flash_sale=True).values_list('pk', flat=True)
+    }
+
+    before = time.time() - pending_timeout()
+    deltas, drained = {}, []
+    for key in keys:
+        counters.expire(key, before)
+        kind, pk = key.split(':')
+        if key in active:
+            # Sales come off the row
+            amount, field = -counters.drain(key, 'sold'), 'sold'
+        else:
+            # Flash mode is off: stock coming back from failed orders returns to the row
+            amount, field = counters.drain(key, 'stock'), 'stock'
+            counters.drain(key, 'sold')
+            drained.append((key, 'sold'))
+        drained.append((key, field))
+        if amount:
+            deltas.setdefault(kind, {})[int(pk)] = amount
+    return {'batch': uuid.uuid4().hex, 'keys': keys, 'active': sorted(active), 'deltas': deltas, 'drained': drained}
+
+
+def _write(counters, journal):
+    """Write a drained batch to the rows once, then clear its flushing counters"""
+    with transaction.atomic():
+        if claim_batch(journal['batch']):
+            for kind, kind_deltas in journal['deltas'].items():
+                _apply(MODELS[kind], kind_deltas)
+
+    for key, field in journal['drained']:
+        counters.drained(key, field)
+    cache.delete(RECONCILE_JOURNAL)
+    active = set(journal['active'])
+    for key in journal['keys']:
+        if key not in active and not counters.has_pending(key):
+            counters.forget(key)
+    return sum(len(kind_deltas) for kind_deltas in journal['deltas'].values())
+
+
+def _reconcile():
+    counters = get_flash_stock()
+    # Finish the batch of a reconcile that died part way before draining more
+    journal = cache.get(RECONCILE_JOURNAL)
+    if journal is not None:
+        _write(counters, journal)
+
+    journal = _drain(counters)
+    if journal is None:
+        return 0
+    cache.set(RECONCILE_JOURNAL, journal, None)
+    return _write(counters, journal)
+
+
+def reconcile():
+    """Write flash sales back to ``stock_quantity``, returning the number of rows updated"""
+    with reconcile_lock(wait=False) as locked:
+        return _reconcile() if locked else 0
@@ -0,0 +1,41 @@
+"""
+Primary product images.
+
+A product's primary image is the one flagged ``is_primary``. Without a flag
+it is the first image by ``sort_order``. It is resolved when images change,
+not when pages are shown, and stored in ``Product.primary_image``. Listing
+pages therefore join one image per product, e.g. with
+``select_related('primary_image')``, instead of prefetching whole galleries.
+
+The image signals keep the pointer current and leave at most one image of a
+product flagged primary.
+"""
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from .models import Product, ProductImage
+
+
+def primary_image_id():
+    """Subquery of the primary image id of the outer product"""
+    return Subquery(
+        ProductImage.objects.filter(product=OuterRef('pk')).order_by('-is_primary', 'sort_order', 'pk').values('pk')[:1]
+    )
+
+
+def make_primary(image):
+    """Unflag the other images of ``image``'s product"""
+    ProductImage.objects.filter(product_id=image.product_id, is_primary=True).exclude(pk=image.pk).update(
+        is_primary=False
+    )
+
+
+def refresh_primary_images(product_ids):
+    """Re-resolve the primary image of some products, in one query"""
+    # updated_at versions the cached product cards
+    Product.objects.filter(pk__in=product_ids).update(primary_image=primary_image_id(), updated_at=timezone.now())
+
+
+def ordered_images(product):
+    """``product``'s images, primary first; uses prefetched images if present"""
+    return sorted(product.images.all(), key=lambda image: (not image.is_primary, image.sort_order, image.pk))
@@ -0,0 +1,426 @@
+"""
+Bulk catalog import.
+
+``manage.py import_catalog`` loads products and variants from CSV or JSON
+Lines files of any size. Each row is one product. In CSV, a row may also carry
+one variant of it (the ``variant_`` columns); a product with several variants
+repeats its product columns on each row. In JSON Lines, a product lists its
+variants under ``"variants"``::
+
+    slug,name,price,category,variant_sku,variant_name,attribute:color
+    tee,Tee,19.00,shirts,TEE-R,Red,Red
+    tee,Tee,19.00,shirts,TEE-B,Blue,Blue
+
+    {"slug": "tee", "name": "Tee", "price": "19.00", "category": "shirts",
+     "variants": [{"sku": "TEE-R", "name": "Red", "attributes": {"color": "Red"}}]}
+
+Products are matched on ``slug`` and variants on ``sku``. A match is updated
+and anything else is created, with one ``bulk_create(update_conflicts=True)``
+per table and chunk. Stock is only set on products and variants that are
+created; existing stock moves through ``products.inventory``. Attribute
+values are added or changed, never removed.
+
+The file is read through a pipeline of generators: rows are parsed, cleaned,
+grouped into chunks and written one chunk at a time. Memory therefore stays
+flat however long the file is. Categories, attributes and attribute values
+are looked up in maps held in memory; the categories and attributes a file
+names but the database lacks are created on first sight.
+
+Bulk writes send no signals. Each chunk therefore does what the product
+signals would have done: it reindexes search and recomputes the carts holding
+its products. Once it commits, its typeahead and facet refreshes are
+published. ``updated_at`` is written with every upsert, which moves the
+product cards on.
+"""
+import csv
+import io
+import json
+import sys
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils.text import slugify
+
+from cart.models import Cart
+from core.models import Category
+
+from .facets import facet_index
+from .models import Product, ProductAttribute, ProductAttributeValue, ProductVariant, ProductVariantAttribute
+from .search import FIELD_WEIGHTS, get_search_backend
+from .typeahead import typeahead_index
+
+
+# field: parser; name and price are required, the rest are written when the file has them
+PRODUCT_FIELDS = {
+    'name': str,
+    'description': str,
+    'short_description': str,
+    'price': Decimal,
+    'compare_at_price': Decimal,
+    'cost_price': Decimal,
+    'sku': str,
+    'barcode': str,
+    'track_inventory': bool,
+    'stock_quantity': int,
+    'low_stock_threshold': int,
+    'weight': Decimal,
+    'status': str,
+    'is_featured': bool,
+    'requires_shipping': bool,
+    'is_digital': bool,
+    'meta_title': str,
+    'meta_description': str,
+}
+VARIANT_FIELDS = {
+    'name': str,
+    'price': Decimal,
+    'compare_at_price': Decimal,
+    'stock_quantity': int,
+    'weight': Decimal,
+    'is_active': bool,
+}
+# Never overwritten on existing rows
+CREATE_ONLY_FIELDS = {'stock_quantity'}
+
+ATTRIBUTE_PREFIX = 'attribute:'
+VARIANT_PREFIX = 'variant_'
+TRUE = {'1', 'true', 'yes', 'y', 't'}
+FALSE = {'0', 'false', 'no', 'n', 'f', ''}
+
+
+class InvalidRow(Exception):
+    """
+    Raised for a row that cannot be imported
+    """
+
+    def __init__(self, line, message):
+        super().__init__(f'Line {line}: {message}')
+        self.line = line
+
+
+class CatalogRow:
+    """
+    One product of an import file, with the variants found on its line
+    """
+    __slots__ = ('line', 'slug', 'category', 'fields', 'variants')
+
+    def __init__(self, line, slug, category, fields, variants):
+        self.line = line
+        self.slug = slug
+        self.category = category
+        self.fields = fields
+        # [(sku, fields, {attribute name: value})]
+        self.variants = variants
+
+
+def parse_value(parser, value):
+    if isinstance(value, str):
+        value = value.strip()
+    if value is None or (value == '' and parser is not str):
+        return None
+    if parser is bool:
+        if isinstance(value, bool):
+            return value
+        if str(value).lower() not in TRUE | FALSE:
+            raise ValueError(f'{value!r} is not a yes/no value')
+        return str(value).lower() in TRUE
+    if parser is Decimal:
+        try:
+            return Decimal(str(value))
+        except InvalidOperation:
+            raise ValueError(f'{value!r} is not a number') from None
+    return parser(value)
+
+
+def parse_fields(line, record, fields, model):
+    parsed = {}
+    for name, parser in fields.items():
+        if name in record:
+            try:
+                value = parse_value(parser, record[name])
+            except (TypeError, ValueError) as e:
+                raise InvalidRow(line, f'{name}: {e}') from None
+            null = model._meta.get_field(name).null
+            if value == '' and null:
+                # Blank SKUs and barcodes must not collide on their unique indexes
+                value = None
+            if value is not None or null:
+                # Blank cells of required fields leave the field's default
+                parsed[name] = value
+    return parsed
+
+
+def open_text(path):
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig')
+    return open(path, encoding='utf-8-sig', newline='')
+
+
+def read_jsonl(handle):
+    for line, text in enumerate(handle, 1):
+        if text.strip():
+            try:
+                yield line, json.loads(text)
+            except json.JSONDecodeError as e:
+                yield line, InvalidRow(line, f'invalid JSON: {e}')
+
+
+def read_records(handle, format):
+    if format == 'csv':
+        reader = csv.DictReader(handle)
+        for record in reader:
+            yield reader.line_num, nest_csv_record(record)
+    else:
+        yield from read_jsonl(handle)
+
+
+def nest_csv_record(record):
+    """Move a CSV row's variant and attribute columns under ``variants``, like JSON Lines"""
+    variant, attributes, product = {}, {}, {}
+    for key, value in record.items():
+        if key is None:
+            continue
+        if key.startswith(VARIANT_PREFIX):
+            variant[key[len(VARIANT_PREFIX):]] = value
+        elif key.startswith(ATTRIBUTE_PREFIX):
+            if value:
+                attributes[key[len(ATTRIBUTE_PREFIX):]] = value
+        else:
+            product[key] = value
+    if variant.get('sku'):
+        variant['attributes'] = attributes
+        product['variants'] = [variant]
+    return product
+
+
+def clean(line, record):
+    """Turn a parsed record into a ``CatalogRow``; raises ``InvalidRow``"""
+    if isinstance(record, InvalidRow):
+        raise record
+    if not isinstance(record, dict):
+        raise InvalidRow(line, 'expected an object')
+    fields = parse_fields(line, record, PRODUCT_FIELDS, Product)
+    if not fields.get('name'):
+        raise InvalidRow(line, 'name is required')
+    if fields.get('price') is None:
+        raise InvalidRow(line, 'price is required')
+    if fields.get('status', 'draft') not in dict(Product.STATUS_CHOICES):
+        raise InvalidRow(line, f"unknown status {fields['status']!r}")
+    slug = slugify(record.get('slug') or fields['name'])
+    if not slug:
+        raise InvalidRow(line, 'slug is empty')
+
+    variants = []
+    for variant in record.get('variants') or []:
+        sku = str(variant.get('sku') or '').strip()
+        if not sku:
+            raise InvalidRow(line, 'variant sku is required')
+        variant_fields = parse_fields(line, variant, VARIANT_FIELDS, ProductVariant)
+        variant_fields.setdefault('name', sku)
+        attributes = {
+            str(name).strip(): str(value).strip()
+            for name, value in (variant.get('attributes') or {}).items()
+            if str(value).strip()
+        }
+        variants.append((sku, variant_fields, attributes))
+    category = slugify(record.get('category') or '') or None
+    return CatalogRow(line, slug, category, fields, variants)
+
+
+def read_rows(path, format, on_error):
+    """Stream the ``CatalogRow``s of a file; invalid rows are passed to ``on_error``"""
+    with open_text(path) as handle:
+        for line, record in read_records(handle, format):
+            try:
+                yield clean(line, record)
+            except InvalidRow as e:
+                on_error(e)
+
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class ChunkResult:
+    """
+    What importing one chunk wrote
+    """
+    __slots__ = ('first_line', 'last_line', 'products', 'variants', 'product_ids', 'error')
+
+    def __init__(self, first_line, last_line, products=0, variants=0, product_ids=(), error=None):
+        self.first_line = first_line
+        self.last_line = last_line
+        self.products = products
+        self.variants = variants
+        self.product_ids = product_ids
+        self.error = error
+
+
+class CatalogImporter:
+    """
+    Upserts chunks of ``CatalogRow``s, resolving names through in-memory maps
+    """
+
+    def __init__(self):
+        self.categories = {}
+        self.attributes = {}
+        self.values = {}
+        self.search_backend = get_search_backend()
+
+    def load(self):
+        """Fill the lookup maps from the database"""
+        self.categories = dict(Category.objects.values_list('slug', 'pk'))
+        self.attributes = dict(ProductAttribute.objects.values_list('name', 'pk'))
+        self.values = {
+            (attribute_id, value): pk
+            for pk, attribute_id, value in ProductAttributeValue.objects.values_list('pk', 'attribute_id', 'value')
+        }
+
+    def category_ids(self, slugs):
+        missing = sorted(set(slugs) - set(self.categories) - {None})
+        if missing:
+            Category.objects.bulk_create(
+                [Category(slug=slug, name=slug.replace('-', ' ').title()) for slug in missing], ignore_conflicts=True
+            )
+            self.categories.update(Category.objects.filter(slug__in=missing).values_list('slug', 'pk'))
+        return self.categories
+
+    def attribute_ids(self, names):
+        missing = sorted(set(names) - set(self.attributes))
+        if missing:
+            ProductAttribute.objects.bulk_create(
+                [ProductAttribute(name=name, display_name=name.replace('_', ' ').title()) for name in missing],
+                ignore_conflicts=True,
+            )
+            self.attributes.update(ProductAttribute.objects.filter(name__in=missing).values_list('name', 'pk'))
+        return self.attributes
+
+    def value_ids(self, pairs):
+        missing = sorted(set(pairs) - set(self.values))
+        if missing:
+            ProductAttributeValue.objects.bulk_create(
+                [ProductAttributeValue(attribute_id=attribute_id, value=value) for attribute_id, value in missing],
+                update_conflicts=True, unique_fields=['attribute', 'value'], update_fields=['updated_at'],
+            )
+            lookup = Q()
+            for attribute_id, value in missing:
+                lookup |= Q(attribute_id=attribute_id, value=value)
+            self.values.update(
+                ((attribute_id, value), pk)
+                for pk, attribute_id, value in ProductAttributeValue.objects.filter(lookup).values_list(
+                    'pk', 'attribute_id', 'value'
+                )
+            )
+        return self.values
+
+    def merge(self, rows):
+        """One row per slug and one variant per sku; later rows win"""
+        products, variants = {}, {}
+        for row in rows:
+            products[row.slug] = row
+            for sku, fields, attributes in row.variants:
+                variants[sku] = (row.slug, fields, attributes)
+        return products, variants
+
+    def upsert_products(self, products):
+        category_ids = self.category_ids(row.category for row in products.values())
+        fields = set()
+        objects = []
+        for slug in sorted(products):
+            row = products[slug]
+            fields.update(row.fields)
+            objects.append(Product(slug=slug, category_id=category_ids.get(row.category), **row.fields))
+        if any(row.category for row in products.values()):
+            fields.add('category')
+        Product.objects.bulk_create(
+            objects, update_conflicts=True, unique_fields=['slug'],
+            update_fields=sorted(fields - CREATE_ONLY_FIELDS) + ['updated_at'],
+        )
+        return dict(Product.objects.filter(slug__in=list(products)).values_list('slug', 'pk'))
+
+    def upsert_variants(self, variants, product_ids):
+        fields = set()
+        objects = []
+        for sku in sorted(variants):
+            slug, variant_fields, attributes = variants[sku]
+            fields.update(variant_fields)
+            objects.append(ProductVariant(product_id=product_ids[slug], sku=sku, **variant_fields))
+        ProductVariant.objects.bulk_create(
+            objects, update_conflicts=True, unique_fields=['sku'],
+            update_fields=sorted(fields - CREATE_ONLY_FIELDS) + ['product', 'updated_at'],
+        )
+        ids = dict(ProductVariant.objects.filter(sku__in=list(variants)).values_list('sku', 'pk'))
+
+        attribute_ids = self.attribute_ids(
+            name for slug, variant_fields, attributes in variants.values() for name in attributes
+        )
+        value_ids = self.value_ids(
+            (attribute_ids[name], value)
+            for slug, variant_fields, attributes in variants.values()
+            for name, value in attributes.items()
+        )
+        links = [
+            ProductVariantAttribute(
+                variant_id=ids[sku], attribute_id=attribute_ids[name], value_id=value_ids[attribute_ids[name], value]
+            )
+            for sku in sorted(variants)
+            for name, value in variants[sku][2].items()
+        ]
+        ProductVariantAttribute.objects.bulk_create(
+            links, update_conflicts=True, unique_fields=['variant', 'attribute'], update_fields=['value'],
+        )
+        return len(objects)
+
+    def import_chunk(self, rows):
+        """Upsert a chunk in one transaction and refresh what depends on it"""
+        products, variants = self.merge(rows)
+        with transaction.atomic():
+            product_ids = self.upsert_products(products)
+            variant_count = self.upsert_variants(variants, product_ids) if variants else 0
+            # Index the saved rows: columns missing from the file kept their stored values
+            saved = Product.objects.filter(pk__in=list(product_ids.values())).only(
+                'pk', 'status', *(field for field, weight in FIELD_WEIGHTS)
+            )
+            self.search_backend.index_products(saved)
+            Cart.recalculate_totals(Cart.objects.filter(items__product_id__in=list(product_ids.values())))
+        return ChunkResult(
+            rows[0].line, rows[-1].line, len(product_ids), variant_count, sorted(product_ids.values())
+        )
+
+
+class IndexChanges:
+    """
+    Publishes the typeahead and facet changes of each committed chunk
+
+    Each chunk is published as soon as it commits, so an import that stops part
+    way still refreshes what it wrote. Once more than ``max_replay`` products
+    have changed, the indexes are invalidated instead and later chunks publish
+    nothing, since a rebuild is cheaper than replaying every change.
+    """
+
+    def __init__(self):
+        self.limit = min(typeahead_index.max_replay, facet_index.max_replay)
+        self.product_ids = set()
+        self.overflowed = False
+
+    def add(self, product_ids):
+        if self.overflowed:
+            return
+        self.product_ids.update(product_ids)
+        if len(self.product_ids) > self.limit:
+            self.overflowed = True
+            self.product_ids = set()
+            for index in (typeahead_index, facet_index):
+                index.invalidate()
+            return
+        for index in (typeahead_index, facet_index):
+            for product_id in sorted(product_ids):
+                index.record_change(product_id)
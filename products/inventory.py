@@ -0,0 +1,283 @@
+"""
+Stock bookkeeping for products and variants.
+
+A cart line takes stock from its variant when it has one, and otherwise from
+the product if the product tracks inventory. Stock is taken with one
+conditional UPDATE per table for the whole cart, whatever its size.
+The UPDATE only applies when ``stock_quantity >= n`` for every row, so stock
+never goes negative however many checkouts race for it.
+
+Checkout can also hold stock for a while with ``reserve_stock``. A hold takes
+its quantity out of ``stock_quantity`` straight away and records a
+``StockReservation``. The hold is then either claimed by the order
+(``claim_reserved_stock``), or released when it expires by the
+``release_expired_reservations`` task. ``stock_quantity`` is therefore the
+stock still available to sell.
+
+Rows in flash mode (see ``products.flash``) are not touched by checkout. Their
+stock is taken from sharded counters instead, and they are never held.
+
+To rule out deadlocks between concurrent carts, every writer locks rows in the
+same order: reservations first, then products by primary key, then variants
+by primary key.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Case, F, Q, When
+from django.utils import timezone
+
+from .facets import record_stock_changes
+from .flash import SoldOut, get_flash_stock
+from .models import Product, ProductVariant, StockReservation
+
+
+class InsufficientStock(Exception):
+    """
+    Raised when one or more lines ask for more than is in stock
+    """
+
+    def __init__(self, names):
+        self.names = names
+        super().__init__(f"Not enough stock for {', '.join(names)}")
+
+
+def stock_demand(lines):
+    """
+    Sum ``(product, variant, quantity)`` lines into the rows they draw from
+
+    Returns ``({product_id: quantity}, {variant_id: quantity})``.
+    """
+    products, variants = {}, {}
+    for product, variant, quantity in lines:
+        if variant is not None:
+            variants[variant.pk] = variants.get(variant.pk, 0) + quantity
+        elif product.track_inventory:
+            products[product.pk] = products.get(product.pk, 0) + quantity
+    return products, variants
+
+
+def _lock(products=(), variants=()):
+    """Lock product rows, then variant rows, in primary key order"""
+    if not connection.features.has_select_for_update:
+        return
+    for model, ids in ((Product, products), (ProductVariant, variants)):
+        if ids:
+            list(model.objects.select_for_update().filter(pk__in=ids).order_by('pk').values_list('pk', flat=True))
+
+
+def _update_stock(model, quantities, sign):
+    """Change the stock of rows not in flash mode, returning the number changed"""
+    ids = sorted(quantities)
+    stock = Case(
+        *[When(pk=pk, then=F('stock_quantity') + sign * quantities[pk]) for pk in ids], default=F('stock_quantity')
+    )
+    if sign > 0:
+        updated = model.objects.filter(pk__in=ids, flash_sale=False).update(stock_quantity=stock)
+    else:
+        condition = Q()
+        for pk in ids:
+            condition |= Q(pk=pk, stock_quantity__gte=quantities[pk])
+        updated = model.objects.filter(condition, flash_sale=False).update(stock_quantity=stock)
+    record_stock_changes(model, {pk: sign * quantity for pk, quantity in quantities.items()})
+    return updated
+
+
+def _flash_ids(model, ids):
+    return set(model.objects.filter(pk__in=ids, flash_sale=True).values_list('pk', flat=True))
+
+
+def _decrement(demand, flash_ids, use_flash):
+    """
+    One attempt at taking ``demand`` out of stock
+
+    Returns ``(model, ids)`` of the rows that fell short, or ``None``, and
+    whether that was because flash mode was switched on or off meanwhile.
+    """
+    kinds = ('product', 'variant')
+    in_db = [
+        {pk: quantity for pk, quantity in quantities.items() if pk not in flash}
+        for quantities, flash in zip(demand, flash_ids)
+    ]
+    takes = []
+    with transaction.atomic():
+        _lock(*in_db)
+        for model, quantities in zip((Product, ProductVariant), in_db):
+            # Decrement every row in one statement, or none of them
+            if quantities and _update_stock(model, quantities, -1) != len(quantities):
+                switched = bool(_flash_ids(model, quantities))
+                transaction.set_rollback(True)
+                return (model, quantities), switched
+
+        if use_flash:
+            counters = get_flash_stock()
+            for kind, model, quantities, flash in zip(kinds, (Product, ProductVariant), demand, flash_ids):
+                for pk in sorted(flash & set(quantities)):
+                    try:
+                        takes.append(counters.take(f'{kind}:{pk}', quantities[pk]))
+                    except SoldOut:
+                        for take in takes:
+                            counters.release(take)
+                        switched = not _flash_ids(model, [pk])
+                        transaction.set_rollback(True)
+                        return (model, {pk: quantities[pk]}), switched
+            if takes:
+                # Until the order commits the takes are pending; a rolled back
+                # order's takes expire back onto the counters
+                def confirm():
+                    for take in takes:
+                        counters.confirm(take)
+                transaction.on_commit(confirm)
+    return None, False
+
+
+def decrement_stock(lines, flash=True):
+    """
+    Take ``(product, variant, quantity)`` lines out of stock
+
+    Rows in flash mode are taken from the ``products.flash`` counters, or
+    skipped when ``flash`` is false. Raises ``InsufficientStock`` naming the
+    short lines, and leaves stock untouched, if any row holds less than
+    requested. Returns the ``(products, variants)`` quantities taken from the
+    rows themselves.
+    """
+    demand = stock_demand(lines)
+    flash_ids = (
+        {product.pk for product, variant, quantity in lines if variant is None and product.flash_sale},
+        {variant.pk for product, variant, quantity in lines if variant is not None and variant.flash_sale},
+    )
+    short, switched = _decrement(demand, flash_ids, flash)
+    if switched:
+        # Flash mode changed since the lines were loaded
+        flash_ids = (_flash_ids(Product, demand[0]), _flash_ids(ProductVariant, demand[1]))
+        short, switched = _decrement(demand, flash_ids, flash)
+
+    if short:
+        model, quantities = short
+        rows = model.objects.filter(pk__in=quantities).values_list('pk', 'stock_quantity', 'flash_sale')
+        short_ids = [pk for pk, stock, in_flash in rows if in_flash or stock < quantities[pk]]
+        names = {product.pk: product.name for product, variant, quantity in lines}
+        if model is ProductVariant:
+            names = {
+                variant.pk: f'{product.name} - {variant.name}'
+                for product, variant, quantity in lines if variant is not None
+            }
+        raise InsufficientStock([names[pk] for pk in short_ids] or ['this order'])
+
+    return tuple(
+        {pk: quantity for pk, quantity in quantities.items() if pk not in flash}
+        for quantities, flash in zip(demand, flash_ids)
+    )
+
+
+def _lock_holds(reservations):
+    """Lock and return the rows of the ``reservations`` queryset"""
+    if connection.features.has_select_for_update_skip_locked:
+        # Holds being released elsewhere right now are left to that process
+        reservations = reservations.select_for_update(skip_locked=True)
+    return list(reservations.order_by('pk').values_list('pk', 'product_id', 'variant_id', 'quantity'))
+
+
+def _held_stock(holds):
+    products, variants = {}, {}
+    for pk, product_id, variant_id, quantity in holds:
+        if variant_id is not None:
+            variants[variant_id] = variants.get(variant_id, 0) + quantity
+        else:
+            products[product_id] = products.get(product_id, 0) + quantity
+    return products, variants
+
+
+def _return_holds(holds):
+    """Delete locked holds and put their stock back, once"""
+    if not holds:
+        return 0
+    if StockReservation.objects.filter(pk__in=[hold[0] for hold in holds]).delete()[0] != len(holds):
+        raise DatabaseError('Stock reservations were released by another process')
+    for kind, model, quantities in zip(('product', 'variant'), (Product, ProductVariant), _held_stock(holds)):
+        if quantities and _update_stock(model, quantities, 1) != len(quantities):
+            # Rows switched to flash mode since the hold was made take it back on their counters
+            for pk in _flash_ids(model, quantities):
+                transaction.on_commit(
+                    lambda key=f'{kind}:{pk}', quantity=quantities[pk]: get_flash_stock().give(key, quantity)
+                )
+    return len(holds)
+
+
+def release_reservations(reservations):
+    """
+    Delete the ``reservations`` queryset and put its stock back
+
+    Returns the number of holds released. Holds locked by another process are
+    skipped where the database supports it, and a hold deleted elsewhere in
+    the meantime raises ``DatabaseError``, so stock is never returned twice.
+    """
+    with transaction.atomic():
+        holds = _lock_holds(reservations)
+        _lock(*_held_stock(holds))
+        return _return_holds(holds)
+
+
+def _swap_holds(reference, products, variants):
+    """Put back the holds under ``reference`` before new stock is taken"""
+    holds = _lock_holds(StockReservation.objects.filter(reference=reference))
+    held_products, held_variants = _held_stock(holds)
+    # Lock everything both steps touch up front to keep the lock order
+    _lock(set(products) | set(held_products), set(variants) | set(held_variants))
+    _return_holds(holds)
+
+
+def reserve_stock(reference, lines, ttl=None):
+    """
+    Hold ``(product, variant, quantity)`` lines for ``ttl`` seconds
+
+    Any earlier holds under ``reference`` are released first, so calling this
+    again refreshes the hold to match the current lines. Raises
+    ``InsufficientStock`` and holds nothing if stock is short.
+    """
+    ttl = ttl if ttl is not None else getattr(settings, 'STOCK_RESERVATION_TTL', 15 * 60)
+    expires_at = timezone.now() + timedelta(seconds=ttl)
+    with transaction.atomic():
+        _swap_holds(reference, *stock_demand(lines))
+        # Flash sale rows are not held; they go to whoever orders first
+        products, variants = decrement_stock(lines, flash=False)
+        variant_products = {variant.pk: product.pk for product, variant, quantity in lines if variant is not None}
+        return StockReservation.objects.bulk_create(
+            [
+                StockReservation(reference=reference, product_id=pk, quantity=quantity, expires_at=expires_at)
+                for pk, quantity in products.items()
+            ] + [
+                StockReservation(
+                    reference=reference, product_id=variant_products[pk], variant_id=pk,
+                    quantity=quantity, expires_at=expires_at,
+                )
+                for pk, quantity in variants.items()
+            ]
+        )
+
+
+def claim_reserved_stock(reference, lines):
+    """
+    Take ``lines`` out of stock, using up the holds under ``reference``
+
+    The holds are returned and the lines taken in one transaction, so held
+    stock cannot be sold to anyone else in between. Lines that were never
+    held, or whose hold expired, are taken from what is left.
+    """
+    with transaction.atomic():
+        _swap_holds(reference, *stock_demand(lines))
+        decrement_stock(lines)
+
+
+def release_expired_reservations(now=None, batch_size=500):
+    """Return expired holds to stock in short transactions, returning how many were released"""
+    now = now or timezone.now()
+    expired = StockReservation.objects.filter(expires_at__lte=now)
+    released = 0
+    while True:
+        ids = list(expired.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        count = release_reservations(expired.filter(pk__in=ids)) if ids else 0
+        released += count
+        if not count or len(ids) < batch_size:
+            return released
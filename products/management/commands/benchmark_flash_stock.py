@@ -0,0 +1,96 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+
+from products.flash import SoldOut, disable_flash, enable_flash, get_flash_stock, reconcile
+from products.inventory import InsufficientStock, decrement_stock
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Compare checkout throughput on one hot product with and without flash mode'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16, help='Concurrent buyers')
+        parser.add_argument('--units', type=int, default=5000, help='Stock to sell out')
+        parser.add_argument('--shards', type=int, default=8, help='Counters per product in flash mode')
+
+    def sell_out(self, buy, threads):
+        """Run ``buy`` from every thread until it sells out; returns (units sold, seconds, retries)"""
+        sold, retries = [], []
+        lock = threading.Lock()
+
+        def buyer():
+            mine = busy = 0
+            try:
+                while True:
+                    try:
+                        buy()
+                        mine += 1
+                    except (InsufficientStock, SoldOut):
+                        break
+                    except OperationalError:
+                        busy += 1
+                        time.sleep(0.001)
+            finally:
+                connections.close_all()
+            with lock:
+                sold.append(mine)
+                retries.append(busy)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for _ in range(threads):
+                pool.submit(buyer)
+        return sum(sold), time.perf_counter() - started, sum(retries)
+
+    def report(self, label, units, sold, elapsed, retries):
+        if sold != units:
+            raise CommandError(f'{label}: sold {sold} of {units} units')
+        self.stdout.write(f'{label:<34}{sold / elapsed:>10.0f} units/s  ({retries} lock retries)')
+
+    def handle(self, *args, **options):
+        threads, units, shards = options['threads'], options['units'], options['shards']
+        counters = get_flash_stock()
+        self.stdout.write(f'{counters.__class__.__name__}, {threads} threads, {units} units\n')
+
+        # Counters alone, without checkout around them
+        for count in (1, shards):
+            key = f'benchmark:{uuid.uuid4().hex[:8]}'
+            counters.load(key, units, count)
+            sold, elapsed, retries = self.sell_out(lambda: counters.confirm(counters.take(key, 1)), threads)
+            counters.drain(key, 'sold')
+            counters.forget(key)
+            self.report(f'Counters, {count} shard(s)', units, sold, elapsed, retries)
+
+        product = Product.objects.create(
+            name='Flash benchmark product',
+            slug=f'flash-benchmark-{uuid.uuid4().hex[:8]}',
+            description='Synthetic product for benchmark_flash_stock',
+            price=Decimal('10.00'),
+            stock_quantity=units,
+            status='active',
+        )
+        try:
+            lines = [(product, None, 1)]
+            sold, elapsed, retries = self.sell_out(lambda: decrement_stock(lines), threads)
+            self.report('Checkout, single row UPDATE', units, sold, elapsed, retries)
+
+            Product.objects.filter(pk=product.pk).update(stock_quantity=units)
+            enable_flash(product, shards=shards)
+            sold, elapsed, retries = self.sell_out(lambda: decrement_stock(lines), threads)
+            self.report(f'Checkout, flash mode ({shards} shards)', units, sold, elapsed, retries)
+
+            reconcile()
+            disable_flash(product)
+            product.refresh_from_db()
+            if product.stock_quantity != 0:
+                raise CommandError(f'Reconciled stock is {product.stock_quantity}, expected 0')
+            self.stdout.write('Reconciled stock:                 0')
+        finally:
+            product.delete()
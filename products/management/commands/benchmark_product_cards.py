@@ -0,0 +1,65 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from products.cards import stats
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Compare CPU time of listing pages with their product cards cached and uncached'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=20, help='Requests per page and mode to average over')
+
+    def get_client(self):
+        host = next((h for h in settings.ALLOWED_HOSTS if h and h != '*' and not h.startswith('.')), 'testserver')
+        return Client(SERVER_NAME=host)
+
+    def measure(self, client, url, cold):
+        if cold:
+            # Moving updated_at is what a product save does: every card misses
+            Product.objects.filter(status='active').update(updated_at=timezone.now())
+        with CaptureQueriesContext(connection) as queries:
+            started = time.process_time()
+            response = client.get(url, secure=not settings.DEBUG)
+            elapsed = time.process_time() - started
+        if response.status_code != 200:
+            raise CommandError(f'{url} returned {response.status_code}')
+        return elapsed * 1000, len(queries)
+
+    def handle(self, *args, **options):
+        if not Product.objects.filter(status='active').exists():
+            raise CommandError('Needs at least one active product')
+
+        client = self.get_client()
+        pages = [
+            ('Home', reverse('core:home')),
+            ('Catalog', reverse('products:catalog')),
+        ]
+
+        self.stdout.write('Average per request')
+        self.stdout.write(
+            f'{"Page":<10}{"Uncached CPU ms":>17}{"Cached CPU ms":>15}{"Queries":>12}{"Hit ratio":>11}'
+        )
+        for name, url in pages:
+            results = {}
+            for cold in (True, False):
+                self.measure(client, url, cold)
+                stats.reset()
+                runs = [self.measure(client, url, cold) for _ in range(options['requests'])]
+                results[cold] = (
+                    sum(ms for ms, queries in runs) / len(runs),
+                    sum(queries for ms, queries in runs) / len(runs),
+                    stats.hit_ratio,
+                )
+            self.stdout.write(
+                f'{name:<10}{results[True][0]:>17.2f}{results[False][0]:>15.2f}'
+                f'{f"{results[True][1]:.0f} / {results[False][1]:.0f}":>12}{results[False][2]:>11.0%}'
+            )
@@ -0,0 +1,95 @@
+import json
+import random
+import statistics
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from products.typeahead import TypeaheadIndex, product_keys
+
+
+ADJECTIVES = [
+    'red', 'blue', 'green', 'black', 'white', 'premium', 'classic', 'organic', 'wireless', 'vintage',
+    'slim', 'heavy', 'compact', 'deluxe', 'smart', 'waterproof', 'leather', 'cotton', 'wooden', 'steel',
+]
+NOUNS = [
+    'shirt', 'headphones', 'backpack', 'lamp', 'kettle', 'sneakers', 'jacket', 'watch', 'speaker', 'mug',
+    'chair', 'desk', 'blender', 'camera', 'charger', 'wallet', 'scarf', 'bottle', 'keyboard', 'tent',
+]
+SUFFIXES = ['', 'pro', 'mini', 'max', 'plus', 'xl', 'lite', '2', '3', 'edition']
+
+
+class Command(BaseCommand):
+    help = 'Measure typeahead index memory and suggestion latency on a synthetic catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1000000, help='Synthetic catalog size')
+        parser.add_argument('--queries', type=int, default=20000, help='Suggestion lookups to time')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument(
+            '--trace-memory', action='store_true',
+            help='Also report Python heap usage with tracemalloc (slows the build down considerably)',
+        )
+
+    def synthetic_entries(self, count, rng):
+        for product_id in range(1, count + 1):
+            name = ' '.join(filter(None, [
+                rng.choice(ADJECTIVES), rng.choice(ADJECTIVES), rng.choice(NOUNS), rng.choice(SUFFIXES),
+            ]))
+            sku = f'SKU-{product_id:08d}'
+            fragment = json.dumps({
+                'id': product_id,
+                'name': name.title(),
+                'slug': f'{name.replace(" ", "-")}-{product_id}',
+                'price': f'{rng.randint(100, 99999) / 100:.2f}',
+                'image': f'/media/products/{product_id}.jpg',
+                'category': rng.choice(NOUNS).title(),
+            }).encode('utf-8')
+            yield product_id, rng.randint(0, 10000), product_keys(name, sku), fragment
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        index = TypeaheadIndex()
+
+        if options['trace_memory']:
+            tracemalloc.start()
+        started = time.perf_counter()
+        index.load(self.synthetic_entries(options['products'], rng))
+        build_seconds = time.perf_counter() - started
+        if options['trace_memory']:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        # Skip the shared cache round-trip; this measures the lookup itself
+        index._built = True
+        index._checked_at = float('inf')
+
+        vocabulary = ADJECTIVES + NOUNS
+        queries = []
+        for _ in range(options['queries']):
+            word = rng.choice(vocabulary)
+            if rng.random() < 0.3:
+                word = f'{word} {rng.choice(vocabulary)}'
+            queries.append(word[:rng.randint(2, len(word))])
+
+        timings = []
+        for query in queries:
+            started = time.perf_counter()
+            index.suggest(query, limit=10)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+
+        def percentile(p):
+            return timings[min(len(timings) - 1, int(len(timings) * p))]
+
+        self.stdout.write(f"Products:          {options['products']:,}")
+        self.stdout.write(f'Build time:        {build_seconds:.1f}s')
+        self.stdout.write(f'Index size:        {index.memory_bytes / 2 ** 20:.1f} MiB')
+        if options['trace_memory']:
+            self.stdout.write(f'Python heap:       {current / 2 ** 20:.1f} MiB (peak {peak / 2 ** 20:.1f} MiB during build)')
+        self.stdout.write(f'Lookups:           {len(timings):,}')
+        self.stdout.write(
+            f'Latency (ms):      p50 {statistics.median(timings):.3f}  '
+            f'p95 {percentile(0.95):.3f}  p99 {percentile(0.99):.3f}  max {timings[-1]:.3f}'
+        )
@@ -0,0 +1,68 @@
+import multiprocessing
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from PIL import Image
+
+from products.models import ProductImage
+from products.renditions import generate, needs_renditions
+
+
+def run_worker(image_ids):
+    """Generate the renditions of a chunk of images in a separate process"""
+    connections.close_all()
+    done, failures = 0, []
+    for image in ProductImage.objects.filter(pk__in=image_ids):
+        try:
+            generate(image)
+            done += 1
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            # Missing or unreadable uploads are reported, not fatal
+            failures.append(f'Image {image.pk} ({image.image.name}): {e}')
+    connections.close_all()
+    return done, failures
+
+
+class Command(BaseCommand):
+    help = 'Generate the resized copies of product images, across a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Worker processes')
+        parser.add_argument('--chunk-size', type=int, default=20, help='Images handed to a worker at once')
+        parser.add_argument('--all', action='store_true', help='Regenerate images that already have renditions')
+
+    def pending_chunks(self, chunk_size, regenerate):
+        chunk = []
+        images = ProductImage.objects.exclude(image='').only('pk', 'image', 'renditions').order_by('pk')
+        for image in images.iterator(chunk_size=2000):
+            if regenerate or needs_renditions(image):
+                chunk.append(image.pk)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def handle(self, *args, **options):
+        chunks = list(self.pending_chunks(options['chunk_size'], options['all']))
+        processes = max(1, options['processes'])
+
+        started = time.perf_counter()
+        if processes == 1:
+            results = [run_worker(chunk) for chunk in chunks]
+        else:
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(processes) as pool:
+                results = pool.map(run_worker, chunks, chunksize=1)
+        elapsed = time.perf_counter() - started
+
+        done = sum(result[0] for result in results)
+        failures = [failure for result in results for failure in result[1]]
+        for failure in failures:
+            self.stderr.write(failure)
+        rate = done / elapsed if elapsed else 0
+        self.stdout.write(f'Processes:         {processes}')
+        self.stdout.write(f'Images:            {done} in {elapsed:.1f}s ({len(failures)} failed)')
+        self.stdout.write(f'Throughput:        {rate:.1f} images/s, {rate / processes:.1f} images/s per process')
@@ -0,0 +1,114 @@
+import multiprocessing
+import os
+import resource
+import time
+from collections import deque
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, connections, reset_queries
+
+from products.importer import CatalogImporter, ChunkResult, IndexChanges, chunked, read_rows
+
+
+# Loaded before the pool forks, so every worker starts with the lookup maps
+importer = None
+
+
+def run_chunk(rows):
+    """Import one chunk; database errors are reported rather than raised, so the other chunks go on"""
+    # With DEBUG on, the query log would otherwise hold the last few thousand bulk INSERTs
+    reset_queries()
+    try:
+        return importer.import_chunk(rows)
+    except DatabaseError as e:
+        return ChunkResult(rows[0].line, rows[-1].line, error=str(e))
+
+
+class Command(BaseCommand):
+    help = 'Create or update products and variants from CSV or JSON Lines files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', metavar='PATH', help="CSV or JSON Lines files; '-' reads stdin")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='File format (default: from the extension)')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Products written per transaction')
+        parser.add_argument('--processes', type=int, default=1, help='Worker processes writing chunks')
+
+    def file_format(self, path, format):
+        if format:
+            return format
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.csv':
+            return 'csv'
+        if extension in ('.jsonl', '.ndjson'):
+            return 'jsonl'
+        raise CommandError(f'Cannot tell the format of {path}; pass --format')
+
+    def rows(self, paths, format):
+        for path in paths:
+            for row in read_rows(path, self.file_format(path, format), self.invalid_row):
+                self.read += 1
+                yield row
+
+    def invalid_row(self, error):
+        self.invalid += 1
+        self.stderr.write(str(error))
+
+    def results(self, chunks, processes):
+        """Import the chunks in order, with at most two per worker in flight so reading never runs ahead"""
+        if processes == 1:
+            yield from map(run_chunk, chunks)
+            return
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(processes, initializer=connections.close_all) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(run_chunk, (chunk,)))
+                if len(pending) >= processes * 2:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+    def handle(self, *args, **options):
+        global importer
+        for path in options['paths']:
+            self.file_format(path, options['format'])
+            if path != '-' and not os.path.exists(path):
+                raise CommandError(f'No such file: {path}')
+
+        processes = max(1, options['processes'])
+        if processes > 1 and connection.vendor == 'sqlite':
+            self.stderr.write('SQLite takes one writer at a time; importing in this process')
+            processes = 1
+
+        importer = CatalogImporter()
+        importer.load()
+        changes = IndexChanges()
+        self.read = self.invalid = 0
+        products = variants = failed = 0
+
+        started = time.perf_counter()
+        chunks = chunked(self.rows(options['paths'], options['format']), options['chunk_size'])
+        for result in self.results(chunks, processes):
+            if result.error:
+                failed += 1
+                self.stderr.write(f'Lines {result.first_line}-{result.last_line} were not imported: {result.error}')
+                continue
+            products += result.products
+            variants += result.variants
+            # Published per chunk, so an import that stops part way is still indexed
+            changes.add(result.product_ids)
+            if options['verbosity'] > 1:
+                self.stdout.write(f'Up to line {result.last_line}: {products} products, {variants} variants')
+        elapsed = time.perf_counter() - started
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        self.stdout.write(f'Database:          {connection.vendor}, {processes} process(es)')
+        self.stdout.write(f'Rows:              {self.read}')
+        self.stdout.write(f'Products:          {products}')
+        self.stdout.write(f'Variants:          {variants}')
+        self.stdout.write(f'Invalid rows:      {self.invalid}')
+        self.stdout.write(f'Failed chunks:     {failed}')
+        self.stdout.write(f'Elapsed:           {elapsed:.1f}s ({self.read / elapsed if elapsed else 0:.0f} rows/s)')
+        self.stdout.write(f'Peak memory:       {peak:.0f} MiB (this process)')
+        if failed:
+            raise CommandError('Some chunks failed; imports are upserts, so the same files can be imported again')
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from products.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the product search index from scratch'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Products indexed per batch')
+    
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        started = time.monotonic()
+        indexed = backend.rebuild(chunk_size=options['chunk_size'])
+        elapsed = time.monotonic() - started
+        
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {indexed} products with {backend.__class__.__name__} in {elapsed:.1f}s'
+        ))
@@ -0,0 +1,152 @@
+import multiprocessing
+import random
+import time
+import uuid
+from collections import Counter
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+
+from products.inventory import (
+    InsufficientStock, claim_reserved_stock, decrement_stock, release_expired_reservations,
+    release_reservations, reserve_stock,
+)
+from products.models import Product, StockReservation
+
+
+MAX_RETRIES = 100
+
+
+def attempt(rng, reference, lines, hold_seconds):
+    """Buy ``lines`` one of three ways, returning True if they were sold"""
+    roll = rng.random()
+    if roll < 0.3:
+        decrement_stock(lines)
+        return True
+    reserve_stock(reference, lines, ttl=hold_seconds)
+    time.sleep(rng.random() * hold_seconds * 2)
+    if roll < 0.8:
+        claim_reserved_stock(reference, lines)
+        return True
+    if roll < 0.9:
+        release_reservations(StockReservation.objects.filter(reference=reference))
+    # Otherwise the checkout is abandoned and its hold left to the sweeper
+    return False
+
+
+def run_worker(args):
+    """Hammer the shared products from a separate process and report what was sold"""
+    run, worker, product_ids, attempts, max_lines, hold_seconds = args
+    connections.close_all()
+    rng = random.Random(f'{run}-{worker}')
+    products = Product.objects.in_bulk(product_ids)
+    sold, stats = Counter(), Counter()
+
+    for number in range(attempts):
+        # Lines come in random order, so lock ordering is what prevents deadlocks
+        chosen = rng.sample(product_ids, rng.randint(1, min(max_lines, len(product_ids))))
+        lines = [(products[pk], None, rng.randint(1, 3)) for pk in chosen]
+        for retry in range(MAX_RETRIES):
+            try:
+                if attempt(rng, f'stress:{run}:{worker}:{number}', lines, hold_seconds):
+                    for product, variant, quantity in lines:
+                        sold[product.pk] += quantity
+                    stats['orders'] += 1
+                break
+            except InsufficientStock:
+                stats['sold_out'] += 1
+                break
+            except OperationalError as e:
+                stats['deadlocks' if 'deadlock' in str(e).lower() else 'retries'] += 1
+                time.sleep(rng.random() * 0.01)
+        else:
+            stats['gave_up'] += 1
+
+        if rng.random() < 0.05:
+            try:
+                release_expired_reservations()
+                stats['sweeps'] += 1
+            except OperationalError:
+                stats['retries'] += 1
+
+    connections.close_all()
+    return dict(sold), dict(stats)
+
+
+class Command(BaseCommand):
+    help = 'Race checkouts for scarce stock from several processes and verify nothing is oversold'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=8, help='Concurrent worker processes')
+        parser.add_argument('--attempts', type=int, default=200, help='Checkouts tried by each process')
+        parser.add_argument('--products', type=int, default=5, help='Products competed for')
+        parser.add_argument('--stock', type=int, default=100, help='Starting stock of each product')
+        parser.add_argument('--lines', type=int, default=3, help='Most lines in one cart')
+        parser.add_argument('--hold-seconds', type=float, default=0.02, help='Lifetime of each stock hold')
+        parser.add_argument('--keep', action='store_true', help='Keep the synthetic products')
+
+    def handle(self, *args, **options):
+        if connections['default'].vendor == 'sqlite' and connections['default'].is_in_memory_db():
+            raise CommandError('The stress test needs a database that several processes can share')
+
+        run = uuid.uuid4().hex[:8]
+        products = Product.objects.bulk_create([
+            Product(
+                name=f'Stress product {n}',
+                slug=f'stress-{run}-{n}',
+                description='Synthetic product for stress_inventory',
+                price=Decimal('10.00'),
+                stock_quantity=options['stock'],
+                status='active',
+            )
+            for n in range(options['products'])
+        ])
+        product_ids = [product.pk for product in products]
+
+        try:
+            connections.close_all()
+            jobs = [
+                (run, worker, product_ids, options['attempts'], options['lines'], options['hold_seconds'])
+                for worker in range(options['processes'])
+            ]
+            started = time.perf_counter()
+            with multiprocessing.get_context('fork').Pool(options['processes']) as pool:
+                results = pool.map(run_worker, jobs)
+            elapsed = time.perf_counter() - started
+
+            sold, stats = Counter(), Counter()
+            for worker_sold, worker_stats in results:
+                sold.update(worker_sold)
+                stats.update(worker_stats)
+            # Return the holds of abandoned checkouts, as the sweeper eventually would
+            release_reservations(StockReservation.objects.filter(reference__startswith=f'stress:{run}:'))
+            stock = dict(Product.objects.filter(pk__in=product_ids).values_list('pk', 'stock_quantity'))
+
+            tried = options['processes'] * options['attempts']
+            self.stdout.write(f"Processes:         {options['processes']}")
+            self.stdout.write(f'Checkouts tried:   {tried} in {elapsed:.2f}s ({tried / elapsed:.0f}/s)')
+            self.stdout.write(f"Orders placed:     {stats['orders']}")
+            self.stdout.write(f"Sold out:          {stats['sold_out']}")
+            self.stdout.write(f"Lock retries:      {stats['retries']}")
+            self.stdout.write(f"Deadlocks:         {stats['deadlocks']}")
+            self.stdout.write(f"Sweeps:            {stats['sweeps']}")
+            self.stdout.write(f"Units available:   {options['stock'] * len(product_ids)}")
+            self.stdout.write(f'Units sold:        {sum(sold.values())}')
+
+            problems = []
+            for pk in product_ids:
+                if stock[pk] < 0:
+                    problems.append(f'product {pk} has negative stock ({stock[pk]})')
+                if stock[pk] + sold[pk] != options['stock']:
+                    problems.append(
+                        f"product {pk}: {sold[pk]} sold + {stock[pk]} left != {options['stock']} stocked"
+                    )
+            if stats['gave_up']:
+                problems.append(f"{stats['gave_up']} checkouts gave up after {MAX_RETRIES} retries")
+            if problems:
+                raise CommandError('Stock accounting failed:\n' + '\n'.join(problems))
+            self.stdout.write(self.style.SUCCESS('Oversold:          0'))
+        finally:
+            if not options['keep']:
+                Product.objects.filter(pk__in=product_ids).delete()
@@ -0,0 +1,101 @@
+# Generated by Django 5.0.14 on 2026-10-17 01:32
+
+import re
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+SEARCH_VECTOR_SQL = """
+ALTER TABLE products_product ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+    setweight(to_tsvector('simple'::regconfig, coalesce(name, '')), 'A') ||
+    setweight(to_tsvector('simple'::regconfig, coalesce(sku, '')), 'A') ||
+    setweight(to_tsvector('simple'::regconfig, coalesce(short_description, '')), 'B') ||
+    setweight(to_tsvector('simple'::regconfig, coalesce(description, '')), 'D')
+) STORED;
+CREATE INDEX products_product_search_vector_gin ON products_product USING gin (search_vector);
+"""
+
+DROP_SEARCH_VECTOR_SQL = """
+DROP INDEX IF EXISTS products_product_search_vector_gin;
+ALTER TABLE products_product DROP COLUMN IF EXISTS search_vector;
+"""
+
+# A frozen copy of the tokenizer in products.search, so later changes to it
+# do not change what this migration writes
+TOKEN_RE = re.compile(r'\w+')
+FIELD_WEIGHTS = (
+    ('name', 8),
+    ('sku', 8),
+    ('short_description', 4),
+    ('description', 1),
+)
+MAX_TERM_LENGTH = 64
+
+
+def tokenize(text):
+    if not text:
+        return []
+    return [token[:MAX_TERM_LENGTH] for token in TOKEN_RE.findall(text.lower())]
+
+
+def product_terms(product):
+    terms = {}
+    for field, weight in FIELD_WEIGHTS:
+        for token in tokenize(getattr(product, field)):
+            if weight > terms.get(token, 0):
+                terms[token] = weight
+    return terms
+
+
+def add_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(SEARCH_VECTOR_SQL)
+
+
+def drop_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_SEARCH_VECTOR_SQL)
+
+
+def index_existing_products(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        return
+
+    Product = apps.get_model('products', 'Product')
+    ProductSearchTerm = apps.get_model('products', 'ProductSearchTerm')
+    entries = []
+    for product in Product.objects.filter(status='active').iterator(chunk_size=2000):
+        entries.extend(
+            ProductSearchTerm(term=term, product_id=product.pk, weight=weight)
+            for term, weight in product_terms(product).items()
+        )
+        if len(entries) >= 10000:
+            ProductSearchTerm.objects.bulk_create(entries)
+            entries = []
+    ProductSearchTerm.objects.bulk_create(entries)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('weight', models.PositiveSmallIntegerField(default=1)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='products.product')),
+            ],
+            options={
+                'db_table': 'products_search_term',
+                'unique_together': {('term', 'product')},
+            },
+        ),
+        migrations.RunPython(add_search_vector, drop_search_vector),
+        migrations.RunPython(index_existing_products, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.14 on 2026-10-17 02:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0004_stock_reservations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='flash_sale',
+            field=models.BooleanField(default=False, editable=False, help_text='Stock is sold from sharded counters; see products.flash'),
+        ),
+        migrations.AddField(
+            model_name='productvariant',
+            name='flash_sale',
+            field=models.BooleanField(default=False, editable=False, help_text='Stock is sold from sharded counters; see products.flash'),
+        ),
+    ]
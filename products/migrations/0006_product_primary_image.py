@@ -0,0 +1,37 @@
+# Generated by Django 5.0.14 on 2026-10-17 02:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_primary_images(apps, schema_editor):
+    Product = apps.get_model('products', 'Product')
+    ProductImage = apps.get_model('products', 'ProductImage')
+    # Where several images are flagged, the first by sort order stays primary
+    primaries = ProductImage.objects.filter(is_primary=True).order_by('product', 'sort_order', 'pk')
+    seen, extra = set(), []
+    for image_id, product_id in primaries.values_list('pk', 'product_id').iterator():
+        if product_id in seen:
+            extra.append(image_id)
+        seen.add(product_id)
+    ProductImage.objects.filter(pk__in=extra).update(is_primary=False)
+    Product.objects.update(primary_image=Subquery(
+        ProductImage.objects.filter(product=OuterRef('pk')).order_by('-is_primary', 'sort_order', 'pk').values('pk')[:1]
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0005_flash_sale'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='primary_image',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='products.productimage'),
+        ),
+        migrations.RunPython(fill_primary_images, migrations.RunPython.noop),
+    ]
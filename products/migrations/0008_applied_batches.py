@@ -0,0 +1,24 @@
+# Generated by Django 5.0.14 on 2026-10-17 03:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0007_image_renditions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppliedBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batch_id', models.CharField(max_length=64, unique=True)),
+                ('applied_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'db_table': 'products_applied_batch',
+            },
+        ),
+    ]
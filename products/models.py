@@ -36,6 +36,10 @@ class Product(TimeStampedModel):
     track_inventory = models.BooleanField(default=True)
     stock_quantity = models.IntegerField(default=0)
     low_stock_threshold = models.IntegerField(default=5)
+    flash_sale = models.BooleanField(
+        default=False, editable=False,
+        help_text="Stock is sold from sharded counters; see products.flash"
+    )
     
     # Physical properties
     weight = models.DecimalField(max_digits=8, decimal_places=2, blank=True, null=True, help_text="Weight in kg")
@@ -49,6 +53,11 @@ class Product(TimeStampedModel):
     requires_shipping = models.BooleanField(default=True)
     is_digital = models.BooleanField(default=False)
     
+    # Resolved from ProductImage by products.images; listings read this alone
+    primary_image = models.ForeignKey(
+        'ProductImage', on_delete=models.SET_NULL, null=True, blank=True, editable=False, related_name='+'
+    )
+    
     # SEO
     meta_title = models.CharField(max_length=60, blank=True)
     meta_description = models.CharField(max_length=160, blank=True)
@@ -84,6 +93,14 @@ class Product(TimeStampedModel):
     class Meta:
         db_table = 'products_product'
         ordering = ['-created_at']
+        indexes = [
+            # One per catalog sort option, for keyset pagination
+            models.Index(fields=['status', 'name', 'id'], name='products_status_name_idx'),
+            models.Index(fields=['status', 'price', 'id'], name='products_status_price_idx'),
+            models.Index(fields=['status', 'created_at', 'id'], name='products_status_created_idx'),
+            models.Index(fields=['status', 'sales_count', 'id'], name='products_status_sales_idx'),
+            models.Index(fields=['status', 'view_count', 'id'], name='products_status_views_idx'),
+        ]
 
 
 class ProductImage(TimeStampedModel):
@@ -96,6 +113,9 @@ class ProductImage(TimeStampedModel):
     sort_order = models.IntegerField(default=0)
     is_primary = models.BooleanField(default=False)
     
+    # Resized copies written by products.renditions
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
+    
     def __str__(self):
         return f"{self.product.name} - Image {self.sort_order}"
     
@@ -118,6 +138,10 @@ class ProductVariant(TimeStampedModel):
     
     # Inventory
     stock_quantity = models.IntegerField(default=0)
+    flash_sale = models.BooleanField(
+        default=False, editable=False,
+        help_text="Stock is sold from sharded counters; see products.flash"
+    )
     
     # Physical properties
     weight = models.DecimalField(max_digits=8, decimal_places=2, blank=True, null=True)
@@ -140,6 +164,46 @@ class ProductVariant(TimeStampedModel):
         db_table = 'products_product_variant'
 
 
+class StockReservation(models.Model):
+    """
+    Stock held back for a checkout in progress
+
+    The held quantity is already deducted from ``stock_quantity``; releasing
+    the hold puts it back.
+    """
+    reference = models.CharField(max_length=64, db_index=True)
+    product = models.ForeignKey(Product, related_name='reservations', on_delete=models.CASCADE)
+    variant = models.ForeignKey(
+        ProductVariant, related_name='reservations', on_delete=models.CASCADE, blank=True, null=True
+    )
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.reference}: {self.quantity} x {self.product_id}"
+    
+    class Meta:
+        db_table = 'products_stock_reservation'
+
+
+class AppliedBatch(models.Model):
+    """
+    A write-behind batch already written to the database
+
+    Counter flushes and flash stock reconciles record their batch id in the
+    transaction that applies it, so a batch retried after a crash is skipped.
+    """
+    batch_id = models.CharField(max_length=64, unique=True)
+    applied_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    
+    def __str__(self):
+        return self.batch_id
+    
+    class Meta:
+        db_table = 'products_applied_batch'
+
+
 class ProductAttribute(TimeStampedModel):
     """
     Product attributes (color, size, material, etc.)
@@ -181,3 +245,19 @@ class ProductVariantAttribute(models.Model):
     class Meta:
         db_table = 'products_variant_attribute'
         unique_together = ['variant', 'attribute']
+
+
+class ProductSearchTerm(models.Model):
+    """
+    Inverted index entry linking a search term to an active product
+    """
+    term = models.CharField(max_length=64)
+    product = models.ForeignKey(Product, related_name='search_terms', on_delete=models.CASCADE)
+    weight = models.PositiveSmallIntegerField(default=1)
+    
+    def __str__(self):
+        return f"{self.term} → {self.product_id}"
+    
+    class Meta:
+        db_table = 'products_search_term'
+        unique_together = ['term', 'product']
@@ -0,0 +1,202 @@
+"""
+Resized copies of product images, for responsive ``srcset``s.
+
+Every ``ProductImage`` gets a copy of its upload in each format of
+PRODUCT_IMAGE_RENDITION_FORMATS. One copy is made at each width of
+PRODUCT_IMAGE_RENDITION_WIDTHS that is narrower than the original. The
+copies are stored next to the original as ``<name>-<width>w.<ext>`` and
+recorded in ``ProductImage.renditions``::
+
+    {'source': 'products/shoe.jpg', 'width': 3000, 'height': 2000,
+     'files': [{'format': 'webp', 'width': 320, 'height': 213,
+                'name': 'products/shoe-320w.webp', 'url': '/media/products/shoe-320w.webp'}, ...]}
+
+``source`` is the upload the copies were made from. A replaced upload no
+longer matches it and gets new copies.
+
+Saving an image queues ``products.tasks.generate_image_renditions``. The
+``generate_renditions`` command backfills an existing catalog across a
+process pool.
+
+Decoding the original costs the most. JPEGs are therefore decoded straight
+at the largest size needed (``Image.draft``). Each smaller width is then
+resized from the one above it, not from the original.
+"""
+import io
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .models import Product, ProductImage
+
+
+# format: (Pillow format, MIME type, file extension)
+FORMATS = {
+    'avif': ('AVIF', 'image/avif', 'avif'),
+    'webp': ('WEBP', 'image/webp', 'webp'),
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+}
+
+# EXIF orientations that swap width and height
+TRANSPOSED = {5, 6, 7, 8}
+
+
+def rendition_name(source, width, format):
+    return f'{os.path.splitext(source)[0]}-{width}w.{FORMATS[format][2]}'
+
+
+def target_widths(width, widths):
+    """The configured widths below ``width``, widest first; just ``width`` if there are none"""
+    return sorted({w for w in widths if w < width}, reverse=True) or [width]
+
+
+def encode(image, format, quality):
+    if format == 'jpeg' and image.mode != 'RGB':
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A') if image.mode == 'RGBA' else None)
+        image = background
+    options = {'quality': quality}
+    if format == 'jpeg':
+        options.update(optimize=True, progressive=True)
+    elif format == 'avif':
+        options['speed'] = 8
+    buffer = io.BytesIO()
+    image.save(buffer, FORMATS[format][0], **options)
+    return buffer.getvalue()
+
+
+def render(file, widths=None, formats=None, quality=None):
+    """
+    Resize an image file
+
+    Returns ``(width, height, renditions)``, where the size is the original's
+    once EXIF orientation is applied. ``renditions`` is a list of
+    ``(format, width, height, data)``.
+    """
+    widths = widths or settings.PRODUCT_IMAGE_RENDITION_WIDTHS
+    formats = formats or settings.PRODUCT_IMAGE_RENDITION_FORMATS
+    quality = quality or settings.PRODUCT_IMAGE_RENDITION_QUALITY
+
+    with Image.open(file) as image:
+        transposed = image.getexif().get(0x0112) in TRANSPOSED
+        stored_width, stored_height = image.size
+        width, height = (stored_height, stored_width) if transposed else (stored_width, stored_height)
+        targets = target_widths(width, widths)
+
+        # Lets the JPEG decoder scale down by up to 8x while decoding
+        scale = targets[0] / width
+        image.draft('RGB', (max(1, int(stored_width * scale)), max(1, int(stored_height * scale))))
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+        renditions = []
+        for target in targets:
+            size = (target, max(1, round(height * target / width)))
+            if image.size != size:
+                image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+            for format in formats:
+                renditions.append((format, size[0], size[1], encode(image, format, quality[format])))
+    return width, height, renditions
+
+
+def needs_renditions(image):
+    return bool(image.image) and image.renditions.get('source') != image.image.name
+
+
+def delete_renditions(record, storage, keep=()):
+    for file in record.get('files', []):
+        if file['name'] not in keep:
+            storage.delete(file['name'])
+
+
+def generate(image):
+    """Write and record the renditions of a ``ProductImage``; returns the record"""
+    source = image.image.name
+    storage = image.image.storage
+    with storage.open(source, 'rb') as handle:
+        width, height, renditions = render(handle)
+
+    files = []
+    rewritten = set()
+    for format, rendition_width, rendition_height, data in renditions:
+        name = rendition_name(source, rendition_width, format)
+        # Rewritten in place where the storage keeps names, so the URL stays put
+        storage.delete(name)
+        saved = storage.save(name, ContentFile(data))
+        if saved == name:
+            rewritten.add(saved)
+        files.append({
+            'format': format, 'width': rendition_width, 'height': rendition_height,
+            'name': saved, 'url': storage.url(saved),
+        })
+    record = {'source': source, 'width': width, 'height': height, 'files': files}
+
+    if not ProductImage.objects.filter(pk=image.pk, image=source).update(renditions=record):
+        # The upload was replaced or deleted meanwhile; its own task takes over
+        delete_renditions(record, storage)
+        return None
+    delete_renditions(image.renditions, storage, keep=rewritten)
+    image.renditions = record
+    # updated_at versions the cached product cards, which show the renditions
+    Product.objects.filter(pk=image.product_id).update(updated_at=timezone.now())
+    return record
+
+
+def sources(image):
+    """
+    ``(sources, fallback)`` for a ``<picture>`` of a ``ProductImage``
+
+    ``sources`` lists ``(mime type, srcset)`` for every format but JPEG.
+    ``fallback`` is ``(src, srcset)`` for the ``<img>``, using the JPEG
+    renditions, or the original when there are none.
+    """
+    by_format = {}
+    if not needs_renditions(image):
+        for file in image.renditions.get('files', []):
+            by_format.setdefault(file['format'], []).append(file)
+    srcsets = {
+        format: ', '.join(f"{file['url']} {file['width']}w" for file in sorted(files, key=lambda f: f['width']))
+        for format, files in by_format.items()
+    }
+    picture_sources = [
+        (FORMATS[format][1], srcsets[format]) for format in FORMATS if format != 'jpeg' and format in srcsets
+    ]
+    if 'jpeg' in by_format:
+        widest = max(by_format['jpeg'], key=lambda file: file['width'])
+        return picture_sources, (widest['url'], srcsets['jpeg'])
+    return picture_sources, (image.image.url, '')
+
+
+class RenditionReferences:
+    """
+    Media referenced by ``ProductImage.renditions``, for ``core.storage``
+    """
+
+    def names(self):
+        records = ProductImage.objects.exclude(renditions={}).values_list('renditions', flat=True)
+        for record in records.iterator(chunk_size=2000):
+            for file in record.get('files', []):
+                yield file['name']
+
+    def rename(self, renamed):
+        changed = []
+        images = ProductImage.objects.exclude(renditions={}).only('pk', 'renditions')
+        for image in images.iterator(chunk_size=2000):
+            files = image.renditions.get('files', [])
+            source = image.renditions.get('source')
+            if source not in renamed and not any(file['name'] in renamed for file in files):
+                continue
+            if source in renamed:
+                # Keeps the renditions current for the renamed upload
+                image.renditions['source'] = renamed[source]
+            for file in files:
+                if file['name'] in renamed:
+                    file['name'] = renamed[file['name']]
+                    file['url'] = default_storage.url(file['name'])
+            changed.append(image)
+        ProductImage.objects.bulk_update(changed, ['renditions'], batch_size=500)
@@ -0,0 +1,253 @@
+"""
+Product search index.
+
+Both backends answer the same two questions: "which products match this
+query?" (as a queryset filter, for the catalog) and "what are the best N
+matches?" (as ranked ids, for autocomplete). Every query term is treated as a
+prefix so partially typed words match.
+
+``DatabaseSearchBackend`` keeps a tokenized inverted index in the
+``products_search_term`` table and runs on any database, which makes it the
+development default on SQLite. ``PostgresSearchBackend`` queries the
+``search_vector`` tsvector column that migration 0002 adds to
+``products_product`` on PostgreSQL. That column is a generated column covered
+by a GIN index, so the database keeps it in sync by itself.
+"""
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import BooleanField, Case, IntegerField, Max, Q, Sum, When
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from .models import Product, ProductSearchTerm
+
+
+TOKEN_RE = re.compile(r'\w+')
+
+# Matches in the name or SKU count for more than matches in the copy
+FIELD_WEIGHTS = (
+    ('name', 8),
+    ('sku', 8),
+    ('short_description', 4),
+    ('description', 1),
+)
+
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 8
+
+
+def tokenize(text):
+    """Split text into lowercase search terms"""
+    if not text:
+        return []
+    return [token[:MAX_TERM_LENGTH] for token in TOKEN_RE.findall(text.lower())]
+
+
+def parse_query(query):
+    """Return the distinct terms of a user query, in order"""
+    terms = []
+    for token in tokenize(query):
+        if token not in terms:
+            terms.append(token)
+    return terms[:MAX_QUERY_TERMS]
+
+
+def product_terms(product):
+    """Map every term of a product to its highest field weight"""
+    terms = {}
+    for field, weight in FIELD_WEIGHTS:
+        for token in tokenize(getattr(product, field)):
+            if weight > terms.get(token, 0):
+                terms[token] = weight
+    return terms
+
+
+def _prefix_range(term):
+    """
+    Match terms starting with ``term`` as a range so the B-tree index on
+    ``term`` is used, even on SQLite where LIKE is case-insensitive.
+    """
+    upper = term[:-1] + chr(ord(term[-1]) + 1)
+    return Q(term__gte=term, term__lt=upper)
+
+
+class BaseSearchBackend:
+    """
+    Interface shared by the product search backends
+    """
+
+    def index_product(self, product):
+        """Add or refresh a single product after it has been saved"""
+        self.index_products([product])
+
+    def index_products(self, products):
+        """Add or refresh a batch of products"""
+        raise NotImplementedError
+
+    def remove_products(self, product_ids):
+        """Drop products from the index"""
+        raise NotImplementedError
+
+    def rebuild(self, chunk_size=2000):
+        """Reindex every product, returning the number of products indexed"""
+        raise NotImplementedError
+
+    def filter_queryset(self, queryset, query):
+        """Restrict a Product queryset to products matching ``query``"""
+        raise NotImplementedError
+
+    def search(self, query, limit=10):
+        """Return the ids of the best matching active products, best first"""
+        raise NotImplementedError
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    """
+    Inverted index stored in the products_search_term table
+    """
+
+    def index_products(self, products):
+        products = list(products)
+        if not products:
+            return
+
+        entries = []
+        for product in products:
+            if product.status != 'active':
+                continue
+            entries.extend(
+                ProductSearchTerm(term=term, product_id=product.pk, weight=weight)
+                for term, weight in product_terms(product).items()
+            )
+
+        with transaction.atomic():
+            ProductSearchTerm.objects.filter(product_id__in=[p.pk for p in products]).delete()
+            ProductSearchTerm.objects.bulk_create(entries, batch_size=1000)
+
+    def remove_products(self, product_ids):
+        ProductSearchTerm.objects.filter(product_id__in=list(product_ids)).delete()
+
+    def rebuild(self, chunk_size=2000):
+        ProductSearchTerm.objects.all().delete()
+
+        indexed = 0
+        chunk = []
+        products = Product.objects.filter(status='active').only(
+            'id', 'status', *[field for field, weight in FIELD_WEIGHTS]
+        )
+        for product in products.iterator(chunk_size=chunk_size):
+            chunk.append(product)
+            if len(chunk) >= chunk_size:
+                self.index_products(chunk)
+                indexed += len(chunk)
+                chunk = []
+
+        if chunk:
+            self.index_products(chunk)
+            indexed += len(chunk)
+
+        return indexed
+
+    def _matches(self, terms):
+        """
+        Group index entries by product, keeping products that match every
+        query term. One aggregate over index range scans, no table scan.
+        """
+        condition = Q()
+        matched = {}
+        for position, term in enumerate(terms):
+            term_range = _prefix_range(term)
+            condition |= term_range
+            matched[f'matched_{position}'] = Max(
+                Case(When(term_range, then=1), default=0, output_field=IntegerField())
+            )
+
+        return (
+            ProductSearchTerm.objects.filter(condition)
+            .values('product_id')
+            .alias(**matched)
+            .filter(**{name: 1 for name in matched})
+        )
+
+    def filter_queryset(self, queryset, query):
+        terms = parse_query(query)
+        if not terms:
+            return queryset
+        return queryset.filter(pk__in=self._matches(terms).values('product_id'))
+
+    def search(self, query, limit=10):
+        terms = parse_query(query)
+        if not terms:
+            return []
+
+        ranked = (
+            self._matches(terms)
+            .annotate(score=Sum('weight'))
+            .order_by('-score', 'product_id')
+            .values_list('product_id', flat=True)
+        )
+        return list(ranked[:limit])
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    Full-text search on the generated ``products_product.search_vector`` column
+    """
+    config = 'simple'
+
+    def _tsquery(self, terms):
+        return ' & '.join(f'{term}:*' for term in terms)
+
+    def _match(self, terms):
+        return RawSQL(
+            'products_product.search_vector @@ to_tsquery(%s::regconfig, %s)',
+            (self.config, self._tsquery(terms)),
+            output_field=BooleanField(),
+        )
+
+    def index_products(self, products):
+        # The generated column is maintained by PostgreSQL on every write
+        pass
+
+    def remove_products(self, product_ids):
+        pass
+
+    def rebuild(self, chunk_size=2000):
+        return Product.objects.filter(status='active').count()
+
+    def filter_queryset(self, queryset, query):
+        terms = parse_query(query)
+        if not terms:
+            return queryset
+        return queryset.filter(self._match(terms))
+
+    def search(self, query, limit=10):
+        terms = parse_query(query)
+        if not terms:
+            return []
+
+        rank = RawSQL(
+            'ts_rank(products_product.search_vector, to_tsquery(%s::regconfig, %s))',
+            (self.config, self._tsquery(terms)),
+        )
+        ranked = (
+            Product.objects.filter(self._match(terms), status='active')
+            .annotate(rank=rank)
+            .order_by('-rank', 'pk')
+            .values_list('pk', flat=True)
+        )
+        return list(ranked[:limit])
+
+
+@lru_cache(maxsize=None)
+def get_search_backend():
+    """Return the configured search backend, picking one by database vendor by default"""
+    backend_path = getattr(settings, 'PRODUCT_SEARCH_BACKEND', '')
+    if backend_path:
+        return import_string(backend_path)()
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    return DatabaseSearchBackend()
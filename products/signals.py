@@ -0,0 +1,108 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from core.storage import is_blob
+
+from .facets import facet_index
+from .images import make_primary, refresh_primary_images
+from .models import Product, ProductImage, ProductVariant, ProductVariantAttribute
+from .renditions import delete_renditions, needs_renditions
+from .search import get_search_backend
+from .tasks import generate_image_renditions
+from .typeahead import typeahead_index
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, raw=False, **kwargs):
+    """Keep the search indexes in sync with product saves"""
+    if raw:
+        return
+    get_search_backend().index_product(instance)
+    typeahead_index.record_change(instance.pk)
+    facet_index.record_change(instance.pk)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    """Drop deleted products from the search indexes"""
+    get_search_backend().remove_products([instance.pk])
+    typeahead_index.record_change(instance.pk)
+    facet_index.record_change(instance.pk)
+
+
+@receiver(post_save, sender=ProductImage)
+def resolve_primary_image(sender, instance, raw=False, **kwargs):
+    """Keep one image primary, point Product.primary_image at it and refresh the suggestion thumbnail"""
+    if raw:
+        return
+    if instance.is_primary:
+        make_primary(instance)
+    refresh_primary_images([instance.product_id])
+    typeahead_index.record_change(instance.product_id)
+
+
+@receiver(post_delete, sender=ProductImage)
+def replace_primary_image(sender, instance, **kwargs):
+    refresh_primary_images([instance.product_id])
+    typeahead_index.record_change(instance.product_id)
+
+
+@receiver(post_save, sender=ProductImage)
+def queue_renditions(sender, instance, raw=False, **kwargs):
+    """Resize new uploads once they are committed"""
+    if raw or not needs_renditions(instance):
+        return
+    transaction.on_commit(lambda: generate_image_renditions.delay(instance.pk))
+
+
+@receiver(post_delete, sender=ProductImage)
+def remove_renditions(sender, instance, **kwargs):
+    if instance.renditions:
+        transaction.on_commit(lambda: delete_renditions(instance.renditions, instance.image.storage))
+    if instance.image and is_blob(instance.image.name):
+        # Only releases a reference; the blob may be shared with other images
+        transaction.on_commit(lambda: instance.image.storage.delete(instance.image.name))
+
+
+@receiver(post_save, sender=ProductVariant)
+@receiver(post_delete, sender=ProductVariant)
+def touch_product(sender, instance, raw=False, **kwargs):
+    """Move the product's updated_at, which versions its cached cards"""
+    if raw:
+        return
+    Product.objects.filter(pk=instance.product_id).update(updated_at=timezone.now())
+
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def refresh_product_categories(sender, instance, action, reverse, pk_set, **kwargs):
+    """Refresh category facets when extra categories are linked or unlinked"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        facet_index.record_change(instance.pk)
+    elif pk_set:
+        for product_id in pk_set:
+            facet_index.record_change(product_id)
+    else:
+        facet_index.invalidate()
+
+
+@receiver(post_save, sender=ProductVariant)
+@receiver(post_delete, sender=ProductVariant)
+def refresh_variant_facets(sender, instance, raw=False, **kwargs):
+    """Variants carry the attribute values used by the facets"""
+    if raw:
+        return
+    facet_index.record_change(instance.product_id)
+
+
+@receiver(post_save, sender=ProductVariantAttribute)
+@receiver(post_delete, sender=ProductVariantAttribute)
+def refresh_variant_attribute_facets(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    product_id = ProductVariant.objects.filter(pk=instance.variant_id).values_list('product_id', flat=True).first()
+    if product_id:
+        facet_index.record_change(product_id)
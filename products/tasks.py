@@ -0,0 +1,31 @@
+from xcommerce.celery import app
+
+from . import flash, inventory, renditions
+from .counters import get_counter_buffer
+from .models import ProductImage
+
+
+@app.task(ignore_result=True)
+def flush_product_counters():
+    """Write buffered view and sales counts to the product rows"""
+    return get_counter_buffer().flush()
+
+
+@app.task(ignore_result=True)
+def release_expired_reservations():
+    """Return stock held by abandoned checkouts"""
+    return inventory.release_expired_reservations()
+
+
+@app.task(ignore_result=True)
+def reconcile_flash_stock():
+    """Write flash sale stock changes back to the product and variant rows"""
+    return flash.reconcile()
+
+
+@app.task(ignore_result=True)
+def generate_image_renditions(image_id):
+    """Write the resized copies of a newly uploaded product image"""
+    image = ProductImage.objects.filter(pk=image_id).first()
+    if image is not None and renditions.needs_renditions(image):
+        renditions.generate(image)
@@ -0,0 +1,35 @@
+from django import template
+
+from products.renditions import sources
+
+
+register = template.Library()
+
+
+@register.inclusion_tag('components/picture.html')
+def picture(image, alt='', css_class='', sizes='100vw', loading=''):
+    """
+    A ``<picture>`` of a ``ProductImage`` offering every rendition
+
+    Browsers pick the first format they support and the smallest width that
+    fills ``sizes``. Images without renditions yet show the original.
+    """
+    picture_sources, (src, srcset) = sources(image)
+    return {
+        'sources': picture_sources,
+        'src': src,
+        'srcset': srcset,
+        'sizes': sizes,
+        'alt': alt or image.alt_text,
+        'css_class': css_class,
+        'loading': loading,
+    }
+
+
+@register.simple_tag
+def srcset(image, format='jpeg'):
+    """The ``srcset`` of one rendition format of a ``ProductImage``"""
+    picture_sources, (src, jpeg_srcset) = sources(image)
+    if format == 'jpeg':
+        return jpeg_srcset
+    return next((value for mime_type, value in picture_sources if mime_type.endswith(f'/{format}')), '')
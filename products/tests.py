@@ -1,3 +1,352 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from core.models import Category
+from .cards import card_key, render_cards
+from .counters import apply_deltas
+from .facets import FacetIndex, FacetSelection, facet_index
+from .flash import LocalFlashStock, SoldOut, disable_flash, enable_flash, flash_key, get_flash_stock, reconcile
+from .importer import CatalogImporter, IndexChanges, clean
+from .inventory import (
+    InsufficientStock, claim_reserved_stock, decrement_stock, release_expired_reservations, reserve_stock,
+)
+from .models import Product, ProductVariant, StockReservation
+from .search import get_search_backend
+from .typeahead import SCAN_LIMIT, TypeaheadIndex, normalize, product_keys
+
+
+class TypeaheadTests(TestCase):
+    def ready_index(self, entries):
+        index = TypeaheadIndex()
+        index.load(entries)
+        index._built = True
+        index._checked_at = float('inf')
+        return index
+
+    def test_short_prefix_returns_best_sellers(self):
+        entries = []
+        for product_id in range(1, SCAN_LIMIT * 4):
+            name = f'shirt {product_id:04d}'
+            # Best sellers sort last by key, beyond the keys a capped scan would reach
+            fragment = json.dumps({'id': product_id}).encode('utf-8')
+            entries.append((product_id, product_id % 500, product_keys(name, f'S-{product_id}'), fragment))
+        index = self.ready_index(entries)
+
+        for query in ['s', 'sh', 'shirt 0', 's-1']:
+            prefix = normalize(query)
+            matches = [entry for entry in entries if any(key.startswith(prefix) for key in entry[2])]
+            expected = [entry[0] for entry in sorted(matches, key=lambda entry: (-entry[1], entry[0]))[:10]]
+            got = [json.loads(fragment)['id'] for fragment in index.suggest(query)]
+            self.assertEqual(got, expected, query)
+
+    @mock.patch('products.typeahead.GARBAGE_MIN_SLOTS', 3)
+    def test_repeated_changes_trigger_rebuild(self):
+        products = [
+            Product.objects.create(
+                name=f'Lamp {n}', slug=f'lamp-{n}', description='', price=Decimal('5.00'), status='active'
+            )
+            for n in range(4)
+        ]
+        index = TypeaheadIndex()
+        index.warm()
+        for _ in range(3):
+            index.apply_changes([products[0].pk])
+        self.assertEqual(index._state.dead_slots, 3)
+        self.assertFalse(index._built)
+
+        index.ensure_ready()
+        self.assertEqual(index._state.dead_slots, 0)
+        self.assertEqual(len(index.suggest('lamp')), 4)
+
+
+class FacetIndexTests(TestCase):
+    def setUp(self):
+        self.products = [
+            Product.objects.create(
+                name=f'Chair {n}', slug=f'chair-{n}', description='', price=Decimal(price), status='active',
+                stock_quantity=stock, track_inventory=True,
+            )
+            for n, (price, stock) in enumerate([('30.00', 1), ('30.00', 4), ('80.00', 0), ('120.00', 2)])
+        ]
+
+    def snapshot(self, index):
+        return (
+            index.all, index.in_stock, index.featured, index.categories, index.price, index.attributes,
+            list(index.sorted_prices), list(index.sorted_ids), list(index.ids), list(index.prices),
+        )
+
+    def test_changes_match_a_fresh_build(self):
+        index = FacetIndex()
+        index.warm()
+        first, second, third, fourth = self.products
+        Product.objects.filter(pk=first.pk).update(price=Decimal('120.00'))
+        Product.objects.filter(pk=third.pk).update(status='draft')
+        Product.objects.filter(pk=fourth.pk).update(price=Decimal('30.00'), is_featured=True)
+        index.apply_changes([first.pk, third.pk, fourth.pk])
+        index.apply_changes([second.pk])
+
+        fresh = FacetIndex()
+        fresh.warm()
+        self.assertEqual(self.snapshot(index), self.snapshot(fresh))
+        self.assertEqual(index.counts(FacetSelection(), max_price=50)['total'], 2)
+
+    def test_stock_updates_refresh_in_stock_counts(self):
+        facet_index.warm()
+        self.assertEqual(facet_index.counts(FacetSelection())['in_stock'], 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            decrement_stock([(self.products[0], None, 1)])
+        self.assertEqual(facet_index.counts(FacetSelection())['in_stock'], 2)
+        self.assertEqual(
+            FacetSelection(in_stock=True).filter_queryset(Product.objects.filter(status='active')).count(), 2
+        )
+
+
+class CounterFlushTests(TestCase):
+    def test_batch_is_applied_once(self):
+        product = Product.objects.create(name='Lamp', slug='lamp', description='', price=Decimal('10.00'))
+        deltas = {(product.pk, 'view_count'): 3, (product.pk, 'sales_count'): 1}
+
+        self.assertEqual(apply_deltas(deltas, 'batch-1'), 1)
+        # A flush retried after its commit replays the same batch
+        self.assertEqual(apply_deltas(deltas, 'batch-1'), 0)
+        product.refresh_from_db()
+        self.assertEqual((product.view_count, product.sales_count), (3, 1))
+
+
+class FlashStockTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        get_flash_stock.cache_clear()
+        self.addCleanup(get_flash_stock.cache_clear)
+        self.product = Product.objects.create(
+            name='Kettle', slug='kettle', description='', price=Decimal('25.00'), status='active',
+            stock_quantity=10, track_inventory=True,
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            enable_flash(self.product, shards=2)
+        self.counters = get_flash_stock()
+        self.key = flash_key(self.product)
+
+    def shard_totals(self, field):
+        return sum(self.counters._shard(self.key, shard)[1][field] for shard in range(2))
+
+    def test_take_spans_shards_or_takes_nothing(self):
+        take = self.counters.take(self.key, 7)
+        self.assertEqual(self.shard_totals('stock'), 3)
+        with self.assertRaises(SoldOut):
+            self.counters.take(self.key, 4)
+        self.assertEqual(self.shard_totals('stock'), 3)
+
+        self.counters.release(take)
+        self.assertEqual(self.shard_totals('stock'), 10)
+
+    def test_checkout_sales_reach_the_row_on_reconcile(self):
+        self.product.refresh_from_db()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(decrement_stock([(self.product, None, 4)]), ({}, {}))
+        self.assertEqual(self.shard_totals('sold'), 4)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 10)
+
+        self.assertEqual(reconcile(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 6)
+        self.assertEqual(self.shard_totals('sold'), 0)
+
+    @override_settings(FLASH_STOCK_PENDING_TIMEOUT=-1)
+    def test_rolled_back_takes_go_back_on_sale(self):
+        self.product.refresh_from_db()
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                decrement_stock([(self.product, None, 4)])
+                raise RuntimeError
+        self.assertEqual(self.shard_totals('stock'), 6)
+
+        reconcile()
+        self.assertEqual(self.shard_totals('stock'), 10)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 10)
+
+    def test_disable_keeps_what_is_left_on_the_counters(self):
+        self.counters.confirm(self.counters.take(self.key, 3))
+        pending = self.counters.take(self.key, 2)
+        disable_flash(self.product)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.flash_sale, self.product.stock_quantity), (False, 5))
+
+        # The pending order failed: its stock comes back to the row
+        self.counters.release(pending)
+        reconcile()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 7)
+        self.assertNotIn(self.key, self.counters.items())
+
+    def test_reconcile_retried_after_commit_takes_stock_once(self):
+        self.counters.confirm(self.counters.take(self.key, 3))
+
+        with mock.patch.object(LocalFlashStock, 'drained', side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                reconcile()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 7)
+
+        reconcile()
+        reconcile()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 7)
+        self.assertEqual(self.shard_totals('flushing_sold'), 0)
+
+
+class ProductCardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Kitchen', slug='kitchen')
+        self.product = Product.objects.create(
+            name='Kettle', slug='kettle', description='', price=Decimal('25.00'), status='active',
+            category=self.category,
+        )
+
+    def render(self):
+        product = Product.objects.select_related('category').get(pk=self.product.pk)
+        return render_cards([product], 'components/product_card.html')[0]
+
+    def test_bulk_updates_render_fresh_cards(self):
+        self.assertNotIn('$40.00', self.render())
+        Product.objects.filter(pk=self.product.pk).update(compare_at_price=Decimal('40.00'))
+        self.assertIn('$40.00', self.render())
+
+    def test_category_changes_move_the_key(self):
+        first = Product.objects.select_related('category').get(pk=self.product.pk)
+        Category.objects.filter(pk=self.category.pk).update(name='Cookware')
+        second = Product.objects.select_related('category').get(pk=self.product.pk)
+        self.assertNotEqual(
+            card_key('components/product_card.html', first), card_key('components/product_card.html', second)
+        )
+
+
+class CatalogImportTests(TestCase):
+    def rows(self, *records):
+        return [clean(line, record) for line, record in enumerate(records, 1)]
+
+    def test_upsert_updates_matches_and_keeps_their_stock(self):
+        Product.objects.create(name='Tee', slug='tee', description='', price=Decimal('19.00'), stock_quantity=5)
+        importer = CatalogImporter()
+        importer.load()
+        importer.import_chunk(self.rows(
+            {'slug': 'tee', 'name': 'Tee', 'price': '21.00', 'stock_quantity': '99', 'status': 'active'},
+            {
+                'slug': 'mug', 'name': 'Enamel Mug', 'price': '9.00', 'stock_quantity': '3', 'status': 'active',
+                'category': 'Kitchen', 'variants': [{'sku': 'MUG-B', 'name': 'Blue', 'attributes': {'color': 'Blue'}}],
+            },
+        ))
+
+        tee, mug = Product.objects.get(slug='tee'), Product.objects.get(slug='mug')
+        self.assertEqual((tee.price, tee.stock_quantity), (Decimal('21.00'), 5))
+        self.assertEqual((mug.stock_quantity, mug.category.slug), (3, 'kitchen'))
+        variant = ProductVariant.objects.get(sku='MUG-B')
+        self.assertEqual(
+            list(variant.attributes.values_list('attribute__name', 'value__value')), [('color', 'Blue')]
+        )
+        self.assertEqual(get_search_backend().search('enamel'), [mug.pk])
+
+    def test_interrupted_import_publishes_committed_chunks(self):
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(handle, 'w') as f:
+            f.write('slug,name,price\ntee,Tee,19.00\nmug,Mug,9.00\n')
+
+        real_import_chunk = CatalogImporter.import_chunk
+
+        def import_chunk(importer, rows):
+            if rows[0].slug == 'mug':
+                raise KeyboardInterrupt
+            return real_import_chunk(importer, rows)
+
+        with mock.patch.object(CatalogImporter, 'import_chunk', import_chunk), \
+                mock.patch('products.importer.typeahead_index') as typeahead, \
+                mock.patch('products.importer.facet_index') as facets:
+            typeahead.max_replay = facets.max_replay = 1000
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('import_catalog', path, chunk_size=1, stdout=StringIO())
+
+        tee = Product.objects.get(slug='tee')
+        typeahead.record_change.assert_called_once_with(tee.pk)
+        facets.record_change.assert_called_once_with(tee.pk)
+
+    def test_large_imports_invalidate_the_indexes(self):
+        with mock.patch('products.importer.typeahead_index') as typeahead, \
+                mock.patch('products.importer.facet_index') as facets:
+            typeahead.max_replay = facets.max_replay = 2
+            changes = IndexChanges()
+            changes.add([1, 2])
+            changes.add([3])
+            changes.add([4])
+
+        self.assertEqual(typeahead.record_change.call_count, 2)
+        typeahead.invalidate.assert_called_once_with()
+        facets.invalidate.assert_called_once_with()
+
+
+class InventoryTests(TestCase):
+    def setUp(self):
+        self.kettle = Product.objects.create(
+            name='Kettle', slug='kettle', description='', price=Decimal('25.00'), stock_quantity=5,
+            track_inventory=True,
+        )
+        self.mug = Product.objects.create(
+            name='Mug', slug='mug', description='', price=Decimal('8.00'), stock_quantity=1, track_inventory=True,
+        )
+        self.blue = ProductVariant.objects.create(product=self.mug, name='Blue', sku='MUG-B', stock_quantity=2)
+
+    def stock(self):
+        return (
+            Product.objects.get(pk=self.kettle.pk).stock_quantity,
+            Product.objects.get(pk=self.mug.pk).stock_quantity,
+            ProductVariant.objects.get(pk=self.blue.pk).stock_quantity,
+        )
+
+    def test_short_line_takes_nothing(self):
+        with self.assertRaises(InsufficientStock) as raised:
+            decrement_stock([(self.kettle, None, 2), (self.mug, None, 2)])
+        self.assertEqual(raised.exception.names, ['Mug'])
+        self.assertEqual(self.stock(), (5, 1, 2))
+
+    def test_variant_lines_take_from_the_variant(self):
+        decrement_stock([(self.mug, self.blue, 2)])
+        self.assertEqual(self.stock(), (5, 1, 0))
+        # The stale objects still say 2 are left; the conditional update does not
+        with self.assertRaisesMessage(InsufficientStock, 'Mug - Blue'):
+            decrement_stock([(self.mug, self.blue, 1)])
+        self.assertEqual(self.stock(), (5, 1, 0))
+
+    def test_claim_uses_the_hold(self):
+        reserve_stock('cart-1', [(self.kettle, None, 3)])
+        reserve_stock('cart-1', [(self.kettle, None, 4)])
+        self.assertEqual(self.stock()[0], 1)
+        with self.assertRaises(InsufficientStock):
+            decrement_stock([(self.kettle, None, 2)])
+
+        claim_reserved_stock('cart-1', [(self.kettle, None, 4)])
+        self.assertEqual(self.stock()[0], 1)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_expired_holds_return_to_stock_once(self):
+        reserve_stock('cart-1', [(self.kettle, None, 3)], ttl=0)
+        self.assertEqual(release_expired_reservations(now=timezone.now()), 1)
+        self.assertEqual(release_expired_reservations(now=timezone.now()), 0)
+        self.assertEqual(self.stock()[0], 5)
+
+        # The order still goes through, from the stock now on sale
+        claim_reserved_stock('cart-1', [(self.kettle, None, 3)])
+        self.assertEqual(self.stock()[0], 2)
@@ -0,0 +1,350 @@
+"""
+In-memory typeahead index for the product search autocomplete.
+
+Every active product gets one key per word of its name, covering that word and
+the words after it ("red cotton shirt", "cotton shirt", "shirt"), plus one key
+for its SKU. The keys are kept sorted, so a query is answered by bisecting to
+the first key that starts with the normalized query and scanning forward.
+
+To stay compact on large catalogs, the bulk of the keys lives in a ``_Segment``.
+A segment packs all keys into a single bytes blob with array offsets, so each
+key does not cost a separate Python object. Products that change after the
+build go into a small sorted ``delta`` list, and their old slot is marked dead.
+Dead slots keep their fragment bytes until the next build, so the index
+rebuilds when the delta grows past ``DELTA_LIMIT`` or when dead slots or their
+fragments make up more than ``GARBAGE_RATIO`` of the state.
+
+A short prefix such as "s" can match a large share of the catalog, so scanning
+its keys in order and ranking only the first few would miss the best sellers.
+Instead, the build records the ``TOP_SLOTS`` best ranked slots of every prefix
+that matches more than ``SCAN_LIMIT`` keys; other prefixes are scanned in full.
+
+Each slot also holds the product's JSON suggestion fragment, encoded in
+advance, so ``/products/search/`` can assemble a response without touching the
+database.
+"""
+import json
+import logging
+from array import array
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.db import DatabaseError
+
+from core.local_index import ProcessLocalIndex
+from .models import Product
+from .search import tokenize
+
+
+KEY_LENGTH = 32
+MAX_KEYS_PER_PRODUCT = 8
+SCAN_LIMIT = 256
+TOP_SLOTS = 32
+DELTA_LIMIT = 50000
+GARBAGE_RATIO = 0.25
+GARBAGE_MIN_SLOTS = 1000
+
+logger = logging.getLogger('xcommerce')
+
+
+def normalize(text):
+    """Lowercase and collapse text the same way for keys and queries"""
+    return ' '.join(tokenize(text)).encode('utf-8')[:KEY_LENGTH]
+
+
+def product_keys(name, sku=None):
+    """Return the distinct typeahead keys for a product name and SKU"""
+    words = tokenize(name)
+    keys = {
+        ' '.join(words[start:]).encode('utf-8')[:KEY_LENGTH]
+        for start in range(min(len(words), MAX_KEYS_PER_PRODUCT))
+    }
+    if sku:
+        keys.add(normalize(sku))
+    keys.discard(b'')
+    return keys
+
+
+def product_fragment(product):
+    """Pre-encode the suggestion payload for a product"""
+    return json.dumps({
+        'id': product.id,
+        'name': product.name,
+        'slug': product.slug,
+        'price': str(product.price),
+        'image': product.primary_image.image.url if product.primary_image else None,
+        'category': product.category.name if product.category else 'Uncategorized',
+    }).encode('utf-8')
+
+
+class _Segment:
+    """
+    Immutable sorted run of keys packed into one bytes blob
+
+    Indexing returns the key bytes, so the segment can be passed to ``bisect``.
+    """
+
+    def __init__(self, pairs):
+        blob = bytearray()
+        self.offsets = array('Q', [0])
+        self.slots = array('Q')
+        for key, slot in pairs:
+            blob += key
+            self.offsets.append(len(blob))
+            self.slots.append(slot)
+        self.blob = bytes(blob)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __getitem__(self, index):
+        return self.blob[self.offsets[index]:self.offsets[index + 1]]
+
+
+class _State:
+    """
+    One complete copy of the index, swapped in atomically on rebuild
+    """
+
+    def __init__(self):
+        self.segment = _Segment([])
+        self.delta = []
+        self.main_ids = array('q')
+        self.delta_slots = {}
+        self.slot_product = array('q')
+        self.slot_rank = array('q')
+        self.slot_keys = {}
+        self.dead = bytearray()
+        self.dead_slots = 0
+        self.dead_bytes = 0
+        self.top_slots = {}
+        self.fragment_blob = bytearray()
+        self.fragment_offsets = array('Q', [0])
+        self.complete = True
+
+    def add(self, product_id, rank, fragment):
+        slot = len(self.slot_product)
+        self.slot_product.append(product_id)
+        self.slot_rank.append(rank)
+        self.dead.append(0)
+        self.fragment_blob += fragment
+        self.fragment_offsets.append(len(self.fragment_blob))
+        return slot
+
+    def kill(self, slot):
+        if self.dead[slot]:
+            return
+        self.dead[slot] = 1
+        self.dead_slots += 1
+        self.dead_bytes += self.fragment_offsets[slot + 1] - self.fragment_offsets[slot]
+
+    def order(self, slot):
+        """Sort key putting the most popular slots first"""
+        return -self.slot_rank[slot], self.slot_product[slot]
+
+    def fragment(self, slot):
+        return bytes(self.fragment_blob[self.fragment_offsets[slot]:self.fragment_offsets[slot + 1]])
+
+    def slot_for(self, product_id):
+        slot = self.delta_slots.get(product_id)
+        if slot is not None:
+            return slot
+        index = bisect_left(self.main_ids, product_id)
+        if index < len(self.main_ids) and self.main_ids[index] == product_id:
+            return index
+        return None
+
+    def collect_top_slots(self, start, end, depth):
+        """
+        Return the best ranked slots among segment keys ``start:end``, which share
+        their first ``depth`` bytes, recording them for prefixes too long to scan
+        """
+        segment = self.segment
+        candidates = set()
+        index = start
+        while index < end:
+            key = segment[index]
+            if len(key) == depth:
+                candidates.add(segment.slots[index])
+                index += 1
+                continue
+            # UTF-8 never contains 0xff, so the next byte value bounds the child range
+            child = key[:depth + 1]
+            child_end = bisect_left(segment, child[:-1] + bytes([child[-1] + 1]), index, end)
+            if child_end - index > SCAN_LIMIT:
+                candidates.update(self.collect_top_slots(index, child_end, depth + 1))
+            else:
+                candidates.update(segment.slots[index:child_end])
+            index = child_end
+
+        top = array('q', sorted(candidates, key=self.order)[:TOP_SLOTS])
+        if depth:
+            self.top_slots[segment[start][:depth]] = top
+        return top
+
+    @property
+    def has_garbage(self):
+        """True once dead slots or their fragments take up too much of the state"""
+        if self.dead_slots < GARBAGE_MIN_SLOTS:
+            return False
+        return (
+            self.dead_slots > GARBAGE_RATIO * len(self.slot_product)
+            or self.dead_bytes > GARBAGE_RATIO * len(self.fragment_blob)
+        )
+
+    @property
+    def memory_bytes(self):
+        arrays = (
+            self.segment.offsets, self.segment.slots, self.main_ids,
+            self.slot_product, self.slot_rank, self.fragment_offsets,
+            *self.top_slots.values(),
+        )
+        return (
+            len(self.segment.blob) + len(self.fragment_blob) + len(self.dead)
+            + sum(len(prefix) for prefix in self.top_slots)
+            + sum(a.itemsize * len(a) for a in arrays)
+        )
+
+
+class TypeaheadIndex(ProcessLocalIndex):
+    """
+    Prefix index over active product names and SKUs
+    """
+    name = 'product_typeahead'
+
+    def __init__(self):
+        super().__init__()
+        self._state = _State()
+
+    @property
+    def max_products(self):
+        return getattr(settings, 'PRODUCT_TYPEAHEAD_MAX_PRODUCTS', 250000)
+
+    @property
+    def is_complete(self):
+        """False when the memory budget left part of the catalog out"""
+        return self._state.complete
+
+    @property
+    def memory_bytes(self):
+        return self._state.memory_bytes
+
+    def load(self, entries, complete=True):
+        """
+        Replace the index with ``entries``, an iterable of
+        ``(product_id, rank, keys, fragment)`` tuples sorted by product id
+        """
+        state = _State()
+        pairs = []
+        for product_id, rank, keys, fragment in entries:
+            slot = state.add(product_id, rank, fragment)
+            state.main_ids.append(product_id)
+            pairs.extend((key, slot) for key in keys)
+        pairs.sort()
+        state.segment = _Segment(pairs)
+        if len(state.segment) > SCAN_LIMIT:
+            state.collect_top_slots(0, len(state.segment), 0)
+        state.complete = complete
+        self._state = state
+
+    def build(self):
+        queryset = (
+            Product.objects.filter(status='active')
+            .select_related('category', 'primary_image')
+            .order_by('-sales_count', 'pk')
+        )
+        limit = self.max_products
+        entries = [
+            (product.pk, product.sales_count, product_keys(product.name, product.sku), product_fragment(product))
+            for product in queryset[:limit + 1].iterator(chunk_size=2000)
+        ]
+        complete = len(entries) <= limit
+        entries = sorted(entries[:limit], key=lambda entry: entry[0])
+        self.load(entries, complete=complete)
+
+    def apply_changes(self, product_ids):
+        products = Product.objects.filter(pk__in=product_ids, status='active').select_related(
+            'category', 'primary_image'
+        ).in_bulk()
+
+        for product_id in product_ids:
+            self._remove(product_id)
+            product = products.get(product_id)
+            if product is not None:
+                self._add(product)
+
+        if len(self._state.delta) > DELTA_LIMIT or self._state.has_garbage:
+            self._built = False
+
+    def _remove(self, product_id):
+        state = self._state
+        slot = state.slot_for(product_id)
+        if slot is None:
+            return
+        state.kill(slot)
+        state.delta_slots.pop(product_id, None)
+        for key in state.slot_keys.pop(slot, ()):
+            index = bisect_left(state.delta, (key, slot))
+            if index < len(state.delta) and state.delta[index] == (key, slot):
+                del state.delta[index]
+
+    def _add(self, product):
+        state = self._state
+        keys = product_keys(product.name, product.sku)
+        slot = state.add(product.pk, product.sales_count, product_fragment(product))
+        state.delta_slots[product.pk] = slot
+        state.slot_keys[slot] = keys
+        for key in keys:
+            insort(state.delta, (key, slot))
+
+    def suggest(self, query, limit=10):
+        """Return pre-encoded JSON fragments for the best matches, most popular first"""
+        self.ensure_ready()
+        prefix = normalize(query)
+        if not prefix:
+            return []
+
+        state = self._state
+        candidates = set()
+
+        # Live slots outside the recorded top rank below every live slot in it,
+        # so it answers the query unless too many of its slots have died
+        top = state.top_slots.get(prefix)
+        if top is not None:
+            top = [slot for slot in top if not state.dead[slot]]
+        if top is not None and (len(top) >= limit or len(state.top_slots[prefix]) < TOP_SLOTS):
+            candidates.update(top)
+        else:
+            segment = state.segment
+            index = bisect_left(segment, prefix)
+            while index < len(segment):
+                if not segment[index].startswith(prefix):
+                    break
+                slot = segment.slots[index]
+                if not state.dead[slot]:
+                    candidates.add(slot)
+                index += 1
+
+        index = bisect_left(state.delta, (prefix,))
+        while index < len(state.delta):
+            key, slot = state.delta[index]
+            if not key.startswith(prefix):
+                break
+            candidates.add(slot)
+            index += 1
+
+        ranked = sorted(candidates, key=state.order)
+        return [state.fragment(slot) for slot in ranked[:limit]]
+
+
+typeahead_index = TypeaheadIndex()
+
+
+def warm_on_start():
+    """Build the typeahead index when a worker boots, if enabled"""
+    if not getattr(settings, 'PRODUCT_TYPEAHEAD_WARM_ON_START', False):
+        return
+    try:
+        typeahead_index.warm()
+    except DatabaseError:
+        logger.warning('Skipped typeahead warm-up: database is not ready', exc_info=True)
@@ -2,20 +2,34 @@ from django.shortcuts import render, get_object_or_404
 from django.views.generic import ListView, DetailView
 from django.db.models import Q, Avg, Count, F
 from django.core.paginator import Paginator
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.db import models
-from .models import Product, ProductImage
+from core.pagination import CursorPaginationMixin
+from .cards import render_cards
+from .counters import record_view
+from .facets import FacetSelection, facet_index, price_buckets
+from .images import ordered_images
+from .models import Product, ProductImage, ProductAttributeValue
+from .search import get_search_backend
+from .typeahead import product_fragment, typeahead_index
 from core.models import Category
 
 
-class ProductCatalogView(ListView):
+class ProductCatalogView(CursorPaginationMixin, ListView):
     model = Product
     template_name = 'products/catalog.html'
     context_object_name = 'products'
     paginate_by = 12
     
+    def get_price_bound(self, name):
+        try:
+            return float(self.request.GET.get(name, ''))
+        except ValueError:
+            return None
+    
     def get_queryset(self):
-        queryset = Product.objects.filter(status='active').select_related('category').prefetch_related('images')
+        # Images are fetched by render_cards, only for cards missing from the cache
+        queryset = Product.objects.filter(status='active').select_related('category')
         
         # Category filtering
         category_slug = self.request.GET.get('category')
@@ -26,27 +40,21 @@ class ProductCatalogView(ListView):
         # Search filtering
         search_query = self.request.GET.get('search')
         if search_query:
-            queryset = queryset.filter(
-                Q(name__icontains=search_query) |
-                Q(description__icontains=search_query) |
-                Q(short_description__icontains=search_query)
-            )
+            queryset = get_search_backend().filter_queryset(queryset, search_query)
         
         # Price filtering
-        min_price = self.request.GET.get('min_price')
-        max_price = self.request.GET.get('max_price')
+        min_price = self.get_price_bound('min_price')
+        max_price = self.get_price_bound('max_price')
         
-        if min_price:
-            try:
-                queryset = queryset.filter(price__gte=float(min_price))
-            except ValueError:
-                pass
+        if min_price is not None:
+            queryset = queryset.filter(price__gte=min_price)
                 
-        if max_price:
-            try:
-                queryset = queryset.filter(price__lte=float(max_price))
-            except ValueError:
-                pass
+        if max_price is not None:
+            queryset = queryset.filter(price__lte=max_price)
+        
+        # Facet filtering
+        self.facet_selection = FacetSelection.from_querydict(self.request.GET)
+        queryset = self.facet_selection.filter_queryset(queryset)
         
         # Sorting
         sort_by = self.request.GET.get('sort', 'name')
@@ -59,10 +67,11 @@ class ProductCatalogView(ListView):
             'rating': '-view_count',  # Placeholder for rating
         }
         
-        if sort_by in sort_options:
-            queryset = queryset.order_by(sort_options[sort_by])
-        else:
-            queryset = queryset.order_by('name')
+        sort_field = sort_options.get(sort_by, 'name')
+        
+        # The id tiebreaker makes the order total, which cursor pagination needs
+        tiebreaker = '-id' if sort_field.startswith('-') else 'id'
+        queryset = queryset.order_by(sort_field, tiebreaker)
         
         return queryset
     
@@ -80,10 +89,14 @@ class ProductCatalogView(ListView):
             context['current_category'] = None
         
         # Get all categories for filter
-        context['categories'] = Category.objects.filter(is_active=True).order_by('sort_order', 'name')
+        context['categories'] = list(Category.objects.filter(is_active=True).order_by('sort_order', 'name'))
         
-        # Get total products count
-        context['total_products'] = self.get_queryset().count()
+        # The paginator has already counted the filtered queryset
+        paginator = context['paginator']
+        context['total_products'] = paginator.count if paginator else len(context['object_list'])
+        context['product_cards'] = render_cards(context['object_list'], 'components/product_card.html')
+        
+        context['facets'] = self.get_facets(context['categories'], context['current_category'])
         
         # Current filters for display
         context['current_filters'] = {
@@ -94,6 +107,49 @@ class ProductCatalogView(ListView):
         }
         
         return context
+    
+    def get_facets(self, categories, current_category):
+        """Facet values with in-memory counts for the current filters"""
+        selection = self.facet_selection
+        search_query = self.request.GET.get('search')
+        restrict_ids = get_search_backend().search(search_query, limit=None) if search_query else None
+        
+        counts = facet_index.counts(
+            selection,
+            category_id=current_category.pk if current_category else None,
+            min_price=self.get_price_bound('min_price'),
+            max_price=self.get_price_bound('max_price'),
+            restrict_ids=restrict_ids,
+        )
+        
+        for category in categories:
+            category.facet_count = counts['categories'].get(category.pk, 0)
+        
+        price = [
+            {'key': key, 'label': label, 'count': counts['price'].get(key, 0), 'selected': key in selection.price}
+            for key, label, low, high in price_buckets()
+        ]
+        
+        attributes = {}
+        value_ids = set(counts['attributes']) | selection.attributes
+        values = ProductAttributeValue.objects.filter(pk__in=value_ids).select_related('attribute').order_by(
+            'attribute__display_name', 'value'
+        )
+        for value in values:
+            group = attributes.setdefault(value.attribute_id, {'attribute': value.attribute, 'values': []})
+            group['values'].append({
+                'value': value,
+                'count': counts['attributes'].get(value.pk, 0),
+                'selected': value.pk in selection.attributes,
+            })
+        
+        return {
+            'total': counts['total'],
+            'price': price,
+            'attributes': list(attributes.values()),
+            'in_stock': {'count': counts['in_stock'], 'selected': selection.in_stock},
+            'featured': {'count': counts['featured'], 'selected': selection.featured},
+        }
 
 
 class ProductDetailView(DetailView):
@@ -110,8 +166,8 @@ class ProductDetailView(DetailView):
     
     def get_object(self, queryset=None):
         obj = super().get_object(queryset)
-        # Increment view count
-        Product.objects.filter(pk=obj.pk).update(view_count=models.F('view_count') + 1)
+        # Buffered; written to the product row by the next counter flush
+        record_view(obj.pk)
         return obj
     
     def get_context_data(self, **kwargs):
@@ -121,12 +177,12 @@ class ProductDetailView(DetailView):
         related_products = Product.objects.filter(
             category=self.object.category,
             status='active'
-        ).exclude(pk=self.object.pk).select_related('category').prefetch_related('images')[:4]
+        ).exclude(pk=self.object.pk).select_related('category', 'primary_image')[:4]
         
         context['related_products'] = related_products
         
         # Get product images
-        context['product_images'] = self.object.images.all().order_by('sort_order')
+        context['product_images'] = ordered_images(self.object)
         
         # Get product variants
         context['product_variants'] = self.object.variants.filter(is_active=True)
@@ -141,21 +197,15 @@ def search_products(request):
     if len(query) < 2:
         return JsonResponse({'results': []})
     
-    products = Product.objects.filter(
-        Q(name__icontains=query) | Q(description__icontains=query),
-        status='active'
-    ).select_related('category').prefetch_related('images')[:10]
+    fragments = typeahead_index.suggest(query, limit=10)
     
-    results = []
-    for product in products:
-        image_url = product.images.first().image.url if product.images.first() else None
-        results.append({
-            'id': product.id,
-            'name': product.name,
-            'slug': product.slug,
-            'price': str(product.price),
-            'image': image_url,
-            'category': product.category.name if product.category else 'Uncategorized'
-        })
+    # Products left out by the typeahead memory budget are still searchable
+    if len(fragments) < 10 and not typeahead_index.is_complete:
+        product_ids = get_search_backend().search(query, limit=10)
+        products = Product.objects.filter(pk__in=product_ids, status='active').select_related(
+            'category', 'primary_image'
+        )
+        products = sorted(products, key=lambda product: product_ids.index(product.pk))
+        fragments = [product_fragment(product) for product in products]
     
-    return JsonResponse({'results': results})
+    return HttpResponse(b'{"results": [' + b', '.join(fragments) + b']}', content_type='application/json')
@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'xcommerce.settings')
 
 application = get_asgi_application()
+
+# Build in-memory indexes before the worker takes traffic
+from products.typeahead import warm_on_start  # noqa: E402
+
+warm_on_start()
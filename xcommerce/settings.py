@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 from pathlib import Path
+from decimal import Decimal
 import os
 from decouple import config
 import dj_database_url
@@ -143,6 +144,21 @@ STATICFILES_DIRS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Uploads are stored once per distinct content, under their SHA-256 digest; see core.storage
+STORAGES = {
+    'default': {'BACKEND': 'core.storage.ContentAddressedStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+# Where the database refers to stored files, for counting blob references
+MEDIA_BLOB_REFERENCES = [
+    'core.storage.FileFieldReferences',
+    'products.renditions.RenditionReferences',
+]
+# Unreferenced blobs are kept this long (seconds) before garbage collection removes them
+MEDIA_BLOB_GC_GRACE = config('MEDIA_BLOB_GC_GRACE', default=24 * 60 * 60, cast=int)
+# A blob's content never changes, so it may be cached for good
+MEDIA_BLOB_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -197,6 +213,130 @@ CELERY_RESULT_BACKEND = config('CELERY_RESULT_BACKEND', default='redis://127.0.0
 CELERY_TIMEZONE = 'UTC'
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60
+CELERY_BEAT_SCHEDULE = {
+    'flush-product-counters': {
+        'task': 'products.tasks.flush_product_counters',
+        'schedule': config('PRODUCT_COUNTER_FLUSH_INTERVAL', default=10, cast=int),
+    },
+    'release-expired-stock-reservations': {
+        'task': 'products.tasks.release_expired_reservations',
+        'schedule': config('STOCK_RESERVATION_SWEEP_INTERVAL', default=60, cast=int),
+    },
+    'reconcile-flash-stock': {
+        'task': 'products.tasks.reconcile_flash_stock',
+        'schedule': config('FLASH_STOCK_RECONCILE_INTERVAL', default=5, cast=int),
+    },
+    'process-payment-webhooks': {
+        'task': 'payments.tasks.process_payment_webhooks',
+        'schedule': config('PAYMENT_WEBHOOK_DRAIN_INTERVAL', default=2, cast=int),
+    },
+}
+
+# Product search
+# Dotted path to a products.search backend. Leave empty to use PostgreSQL
+# full-text search on PostgreSQL and the inverted-index table elsewhere.
+PRODUCT_SEARCH_BACKEND = config('PRODUCT_SEARCH_BACKEND', default='')
+
+# Autocomplete suggestions are served from an in-memory index in each worker.
+# The most popular products up to this limit are kept in memory (roughly 350
+# bytes each); the rest are answered by the search backend.
+PRODUCT_TYPEAHEAD_MAX_PRODUCTS = config('PRODUCT_TYPEAHEAD_MAX_PRODUCTS', default=250000, cast=int)
+PRODUCT_TYPEAHEAD_WARM_ON_START = config('PRODUCT_TYPEAHEAD_WARM_ON_START', default=True, cast=bool)
+
+# Catalog facets
+# Upper bounds of the price buckets shown in the catalog sidebar
+CATALOG_PRICE_BUCKETS = [25, 50, 100, 200]
+
+# Product image renditions
+# Resized copies of every upload, written by a Celery task; see products.renditions
+PRODUCT_IMAGE_RENDITION_WIDTHS = [160, 320, 640, 1024]
+PRODUCT_IMAGE_RENDITION_FORMATS = ['avif', 'webp', 'jpeg']
+PRODUCT_IMAGE_RENDITION_QUALITY = {'avif': 55, 'webp': 80, 'jpeg': 82}
+
+# Product cards
+# Rendered cards are cached under keys that change with the product, so this
+# only bounds how long outdated cards linger in the cache.
+PRODUCT_CARD_CACHE_TIMEOUT = config('PRODUCT_CARD_CACHE_TIMEOUT', default=24 * 60 * 60, cast=int)
+
+# Shopping cart
+# Where anonymous carts live until checkout or login: in the cache
+# (cart.storage.CacheCartStore) or as rows (cart.storage.DatabaseCartStore)
+CART_ANONYMOUS_STORE = config('CART_ANONYMOUS_STORE', default='cart.storage.CacheCartStore')
+CART_ANONYMOUS_TTL = config('CART_ANONYMOUS_TTL', default=14 * 24 * 60 * 60, cast=int)
+# Seconds the header badge trusts the item count stored in the session
+CART_COUNT_MAX_AGE = 300
+
+# Product view and sales counters
+# Increments are buffered (in Redis when it is the cache, otherwise in each
+# process) and written in batches at most this many seconds apart.
+PRODUCT_COUNTER_BACKEND = config('PRODUCT_COUNTER_BACKEND', default='')
+PRODUCT_COUNTER_FLUSH_INTERVAL = config('PRODUCT_COUNTER_FLUSH_INTERVAL', default=10, cast=int)
+
+# Stock reservations
+# Seconds stock stays held for a customer who opened checkout. Expired holds
+# are returned to stock by the products.tasks sweeper.
+STOCK_RESERVATION_TTL = config('STOCK_RESERVATION_TTL', default=15 * 60, cast=int)
+STOCK_RESERVATION_SWEEP_INTERVAL = config('STOCK_RESERVATION_SWEEP_INTERVAL', default=60, cast=int)
+
+# Flash sales
+# Products and variants switched to flash mode in the admin sell from this many
+# counters (in Redis when it is the cache, otherwise in each process), which
+# are written back to stock_quantity every FLASH_STOCK_RECONCILE_INTERVAL
+# seconds. Takes whose order never commits go back on sale after
+# FLASH_STOCK_PENDING_TIMEOUT seconds.
+FLASH_STOCK_BACKEND = config('FLASH_STOCK_BACKEND', default='')
+FLASH_STOCK_SHARDS = config('FLASH_STOCK_SHARDS', default=8, cast=int)
+FLASH_STOCK_RECONCILE_INTERVAL = config('FLASH_STOCK_RECONCILE_INTERVAL', default=5, cast=int)
+FLASH_STOCK_PENDING_TIMEOUT = config('FLASH_STOCK_PENDING_TIMEOUT', default=60, cast=int)
+
+# Order numbers and refund IDs
+# Dotted path to a core.ids generator. Snowflake IDs lease a worker slot from
+# Redis; set ID_WORKER_ID (0-1023) to pin one per process instead. Without
+# either, processes pick random slots, which may collide.
+ID_GENERATOR = config('ID_GENERATOR', default='core.ids.SnowflakeGenerator')
+ID_WORKER_ID = config('ID_WORKER_ID', default='')
+
+# Shipping and tax
+# Charged where no ShippingRate or TaxRate row covers the destination, and
+# quoted to DEFAULT_SHIPPING_COUNTRY until the customer gives an address.
+# Parcels are charged by the greater of actual and dimensional weight, which
+# is length x width x height in cm divided by SHIPPING_DIM_DIVISOR.
+DEFAULT_SHIPPING_COST = config('DEFAULT_SHIPPING_COST', default='10.00', cast=Decimal)
+DEFAULT_TAX_RATE = config('DEFAULT_TAX_RATE', default='0.08', cast=Decimal)
+DEFAULT_SHIPPING_COUNTRY = config('DEFAULT_SHIPPING_COUNTRY', default='US')
+SHIPPING_DIM_DIVISOR = config('SHIPPING_DIM_DIVISOR', default=5000, cast=int)
+
+# Payment webhooks
+# Events are stored as they arrive and processed in batches every
+# PAYMENT_WEBHOOK_DRAIN_INTERVAL seconds. A failing event is retried after
+# PAYMENT_WEBHOOK_RETRY_DELAY seconds, doubling each time, and given up after
+# PAYMENT_WEBHOOK_MAX_ATTEMPTS. Bodies are signed with HMAC-SHA256 using
+# PAYMENT_WEBHOOK_SECRET; without a secret, unsigned events are accepted in
+# DEBUG only.
+PAYMENT_WEBHOOK_SECRET = config('PAYMENT_WEBHOOK_SECRET', default='')
+PAYMENT_WEBHOOK_BATCH_SIZE = config('PAYMENT_WEBHOOK_BATCH_SIZE', default=200, cast=int)
+PAYMENT_WEBHOOK_DRAIN_INTERVAL = config('PAYMENT_WEBHOOK_DRAIN_INTERVAL', default=2, cast=int)
+PAYMENT_WEBHOOK_RETRY_DELAY = config('PAYMENT_WEBHOOK_RETRY_DELAY', default=30, cast=int)
+PAYMENT_WEBHOOK_MAX_ATTEMPTS = config('PAYMENT_WEBHOOK_MAX_ATTEMPTS', default=8, cast=int)
+
+# Payment gateways
+# Adapter class for each PaymentMethod.provider. Calls time out after
+# PAYMENT_GATEWAY_TIMEOUT seconds (or the method's config 'timeout'), reuse up
+# to PAYMENT_GATEWAY_POOL_SIZE idle connections per host, and stop for
+# PAYMENT_GATEWAY_RESET_TIMEOUT seconds after PAYMENT_GATEWAY_FAILURE_THRESHOLD
+# failures in a row.
+PAYMENT_GATEWAYS = {
+    'mock': 'payments.gateways.MockGateway',
+}
+PAYMENT_GATEWAY_TIMEOUT = config('PAYMENT_GATEWAY_TIMEOUT', default=10, cast=float)
+PAYMENT_GATEWAY_POOL_SIZE = config('PAYMENT_GATEWAY_POOL_SIZE', default=10, cast=int)
+PAYMENT_GATEWAY_FAILURE_THRESHOLD = config('PAYMENT_GATEWAY_FAILURE_THRESHOLD', default=5, cast=int)
+PAYMENT_GATEWAY_RESET_TIMEOUT = config('PAYMENT_GATEWAY_RESET_TIMEOUT', default=30, cast=int)
+
+# Bulk refunds
+# Refunds a run claimed but has not answered for this many seconds are
+# treated as abandoned by a crashed run and sent again.
+REFUND_CLAIM_TIMEOUT = config('REFUND_CLAIM_TIMEOUT', default=10 * 60, cast=int)
 
 # Email configuration
 EMAIL_BACKEND = config('EMAIL_BACKEND', default='django.core.mail.backends.console.EmailBackend')